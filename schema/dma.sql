@@ -1,3 +1,7 @@
+/* Base schema (version 0) of the semaphor-ldap local DB.
+ * Later schema changes are applied by src/db/migrations.py.
+ */
+
 /* Holds the data for LDAP accounts, retrieved from the LDAP server. */
 create table if not exists ldap_account (
     id integer not null primary key,
@@ -0,0 +1,119 @@
+/* Schema of the semaphor-ldap local DB on PostgreSQL,
+ * the equivalent of schema/dma.sql with all its migrations
+ * (src/db/migrations.py), used by src/db/pg_db.py.
+ * There is no incremental backup change tracking, PostgreSQL
+ * DBs are backed up by the PostgreSQL server tools.
+ * Booleans are smallint columns (0/1), as on the SQLite DB.
+ */
+
+create table schema_info (
+    version integer not null
+);
+insert into schema_info (version) values (1);
+
+/* Holds the data for LDAP accounts, retrieved from the LDAP server. */
+create table ldap_account (
+    id serial primary key,
+
+    /* LDAP account unique identifier */
+    uniqueid varchar(128) not null unique,
+    /* LDAP email/username (case insensitive) */
+    email varchar(255) not null,
+    /* LDAP state */
+    enabled smallint not null default 1
+);
+create unique index ix_ldap_account_email on ldap_account(lower(email));
+create index ix_ldap_account_enabled_email
+on ldap_account(enabled, lower(email));
+
+/* Holds the data for Semaphor accounts. */
+create table semaphor_account (
+    /* references ldap_account.id */
+    ldap_account integer not null primary key,
+
+    /* Semaphor account unique identifier */
+    semaphor_guid varchar(52) unique,
+    /* auto-generated Semaphor password */
+    password varchar(32),
+    /* level2 secret in base64 format */
+    L2 varchar(44),
+    /* 0=ldaped/unlocked, 1=full-locked, 2=ldap-locked */
+    lock_state smallint not null,
+
+    constraint state_values check (lock_state >= 0 and lock_state <= 2)
+);
+create index ix_semaphor_account_lock_state
+on semaphor_account(lock_state, semaphor_guid);
+
+/* Persistent snapshot of the LDAP group. */
+create table ldap_snapshot (
+    uniqueid varchar(128) not null primary key,
+    email varchar(255) not null,
+    enabled smallint not null,
+    /* hash of the LDAP entry content, null if not synced yet */
+    content_hash varchar(40),
+    /* whether the entry is present on the LDAP group */
+    present smallint not null default 1,
+    /* entry changed and is not yet reconciled with ldap_account */
+    dirty smallint not null default 1
+);
+create index ix_ldap_snapshot_dirty on ldap_snapshot(dirty);
+create index ix_ldap_snapshot_email on ldap_snapshot(lower(email));
+
+/* uniqueids read from LDAP by the running LDAP snapshot update,
+ * scratch data (not crash safe).
+ */
+create unlogged table ldap_snapshot_seen (
+    uniqueid varchar(128) not null primary key
+);
+
+/* Key/value state of the ldap-sync runs. */
+create table sync_state (
+    key varchar(64) not null primary key,
+    value text
+);
+
+/* Append-only log of account state transitions. */
+create table account_change (
+    seq bigserial primary key,
+    /* references ldap_account.id */
+    ldap_account integer not null,
+    /* created, unlocked, relinked or reenabled */
+    change varchar(16) not null,
+    /* unix time of the change */
+    time bigint not null default extract(epoch from now())::bigint
+);
+create index ix_account_change_time on account_change(time);
+
+create function log_account_change() returns trigger as $$
+begin
+    if TG_TABLE_NAME = 'ldap_account' then
+        insert into account_change (ldap_account, change)
+        values (new.id, TG_ARGV[0]);
+    else
+        insert into account_change (ldap_account, change)
+        values (new.ldap_account, TG_ARGV[0]);
+    end if;
+    return null;
+end;
+$$ language plpgsql;
+
+create trigger tr_account_created
+after insert on semaphor_account
+for each row execute procedure log_account_change('created');
+
+create trigger tr_account_unlocked
+after update of lock_state on semaphor_account
+for each row when (old.lock_state != 0 and new.lock_state = 0)
+execute procedure log_account_change('unlocked');
+
+create trigger tr_account_relinked
+after update of semaphor_guid on semaphor_account
+for each row when (new.semaphor_guid is not null and
+                   old.semaphor_guid is distinct from new.semaphor_guid)
+execute procedure log_account_change('relinked');
+
+create trigger tr_account_reenabled
+after update of enabled on ldap_account
+for each row when (old.enabled = 0 and new.enabled != 0)
+execute procedure log_account_change('reenabled');
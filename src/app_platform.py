@@ -7,6 +7,7 @@ If $APPDATA is the Application data directory for semaphor-ldap,
 then here's the intended directory structure:
 $APPDATA/resources/app/img/bot.jpg
 $APPDATA/resources/app/schema/dma.sql
+$APPDATA/resources/app/schema/dma_pg.sql
 $APPDATA/resources/app/backend/schema/per_local_account.sql
 $APPDATA/resources/app/backend/schema/per_local_account_and_channel.sql
 $APPDATA/resources/app/backend/semaphor-backend
@@ -112,6 +113,17 @@ def get_default_schema_path():
     )
 
 
+def get_default_pg_schema_path():
+    """Returns the path for the Semaphor-LDAP
+    postgresql schema file.
+    """
+    return os.path.join(
+        _APP_OS_PATH_MAP[sys.platform](),
+        _DEFAULT_SCHEMA_DIR,
+        "dma_pg.sql",
+    )
+
+
 def get_default_img_path():
     """Returns the path for the img resource directory."""
     return os.path.join(
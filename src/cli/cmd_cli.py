@@ -72,6 +72,22 @@ class CmdCli(object):
                     exception,
                 ))
             return
+        method_obj = cmd_method.get_cmd_method(method)
+        # Preprocess request
+        args_dict = method_obj.request(args_dict)
+        while args_dict is not None:
+            response_data = self.send_request(method, args_dict)
+            if response_data is None:
+                return
+            # Parse response
+            method_obj.response(response_data)
+            # Paged methods request the next page, if any
+            args_dict = method_obj.next_request(args_dict, response_data)
+
+    def send_request(self, method, args_dict):
+        """Sends a single JSON-RPC request to the server.
+        Returns the JSON-RPC response dict, or None on error.
+        """
         headers = {
             "content-type": "application/json",
             "auth-token": self.auth_token,
@@ -83,9 +99,6 @@ class CmdCli(object):
             "jsonrpc": "2.0",
         }
         LOG.debug("request: %s", payload)
-        method_obj = cmd_method.get_cmd_method(method)
-        # Preprocess request
-        args_dict = method_obj.request(args_dict)
         try:
             response = requests.post(
                 self.server_uri,
@@ -97,12 +110,12 @@ class CmdCli(object):
         except requests.RequestException as req_err:
             LOG.debug("Connection error: %s", req_err)
             print "ERROR: Failed to send request to the server"
-            return
+            return None
         try:
             response_data = json.loads(response.text, encoding="utf-8")
         except ValueError as val_err:
             print "Invalid response: '%s'" % val_err
-            return
+            return None
         if self.request_id != response_data.get("id"):
             print (
                 "Invalid response, request/response "
@@ -111,10 +124,9 @@ class CmdCli(object):
                     response_data.get("id"),
                 ),
             )
-            return
+            return None
         self.request_id += 1
-        # Parse response
-        method_obj.response(response_data)
+        return response_data
 
     def run(self):
         """CmdCli command execution.
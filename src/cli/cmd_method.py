@@ -4,6 +4,7 @@ cmd_method.py
 Command line method classes.
 """
 
+import os
 import sys
 import string
 import getpass
@@ -11,6 +12,7 @@ import getpass
 from flow import Flow
 
 from src import utils
+from src.db import local_db
 
 
 def prompt_password(prompt="Password: "):
@@ -87,6 +89,42 @@ class CmdMethod(object):
         elif "result" in response_dict:
             self.result(response_dict["result"])
 
+    def next_request(self, args_dict, response_dict):
+        """Returns the args dict to request the next page of
+        results to the server, or None if there is nothing else
+        to request (the default).
+        """
+        return None
+
+
+class UserlistPager(object):
+    """Helper to page through the 'db-userlist' method
+    with the 'limit' and 'after' (keyset cursor on email) arguments.
+    If the user did not set a 'limit', then all pages are requested.
+    """
+
+    def __init__(self):
+        self.paged = False
+        self.count = 0
+
+    def request(self, args_dict):
+        """Sets the page size on the request if no 'limit' was set."""
+        if not args_dict.get("limit"):
+            args_dict["limit"] = local_db.USERLIST_PAGE_SIZE
+            self.paged = True
+        return args_dict
+
+    def next_request(self, args_dict, response_dict):
+        """Returns the args dict for the next page, if any."""
+        users = response_dict.get("result")
+        if not users:
+            return None
+        self.count += len(users)
+        if not self.paged or len(users) < int(args_dict["limit"]):
+            return None
+        args_dict["after"] = users[-1]["email"]
+        return args_dict
+
 
 class CheckStatus(CmdMethod):
 
@@ -96,11 +134,15 @@ class CheckStatus(CmdMethod):
 
     def result(self, result_dict):
         print("Server status:\n"
-              "- db = %s\n- flow = %s\n- ldap = %s\n- sync = %s" % (
+              "- db = %s\n- backup = %s\n- maintenance = %s\n"
+              "- flow = %s\n- ldap = %s\n- sync = %s\n- listener = %s" % (
                   result_dict["db"],
+                  result_dict.get("backup", "N/A"),
+                  result_dict.get("maintenance", "N/A"),
                   result_dict["flow"],
                   result_dict["ldap"],
                   result_dict["sync"],
+                  result_dict.get("listener", "N/A"),
               )
               )
 
@@ -202,8 +244,7 @@ class GroupUserlist(CmdMethod):
         )
 
     def result(self, result_dict):
-        users = sorted(result_dict, key=lambda k: k["email"])
-        for user in users:
+        for user in result_dict:
             self.print_user(user)
 
 
@@ -216,9 +257,15 @@ class LogDest(CmdMethod):
 
 class DbUserlist(CmdMethod):
 
+    def __init__(self):
+        self.pager = UserlistPager()
+
     def request(self, args_dict):
         print("Retrieving users from the local database...")
-        return args_dict
+        return self.pager.request(args_dict)
+
+    def next_request(self, args_dict, response_dict):
+        return self.pager.next_request(args_dict, response_dict)
 
     def print_user(self, user):
         print(
@@ -236,14 +283,69 @@ class DbUserlist(CmdMethod):
         )
 
     def result(self, result_dict):
-        users = sorted(result_dict, key=lambda k: k["email"])
-        if not users:
-            print("The local DB is currently empty.")
+        if not result_dict and not self.pager.count:
+            print("No accounts found on the local DB.")
             return
-        for user in users:
+        for user in result_dict:
             self.print_user(user)
 
 
+class DbStats(CmdMethod):
+
+    def request(self, args_dict):
+        print("Getting local DB query statistics...")
+        return args_dict
+
+    def result(self, result_dict):
+        if not result_dict:
+            print("No local DB queries run yet.")
+            return
+        # Queries with the highest total time first
+        for name, stats in sorted(
+                result_dict.items(),
+                key=lambda item: item[1]["total_ms"],
+                reverse=True):
+            print(
+                "%s: count = %d, total = %.1f ms, avg = %.2f ms, "
+                "max = %.1f ms, histogram = %s" % (
+                    name,
+                    stats["count"],
+                    stats["total_ms"],
+                    stats["total_ms"] / stats["count"],
+                    stats["max_ms"],
+                    ", ".join(
+                        "%s: %d" % (label, count)
+                        for label, count in stats["histogram"] if count
+                    ),
+                )
+            )
+
+
+class ExportDb(CmdMethod):
+
+    def request(self, args_dict):
+        # The server may run on another working directory
+        args_dict["filename"] = os.path.abspath(args_dict["filename"])
+        print("Exporting local DB accounts to %s..." % args_dict["filename"])
+        return args_dict
+
+    def result(self, result_dict):
+        print("%d accounts exported." % result_dict)
+
+
+class ImportDb(CmdMethod):
+
+    def request(self, args_dict):
+        # The server may run on another working directory
+        args_dict["filename"] = os.path.abspath(args_dict["filename"])
+        print("Importing local DB accounts from %s..." %
+              args_dict["filename"])
+        return args_dict
+
+    def result(self, result_dict):
+        print("%d accounts imported." % result_dict)
+
+
 class LdapSyncTrigger(CmdMethod):
 
     def request(self, args_dict):
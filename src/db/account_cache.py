@@ -0,0 +1,100 @@
+"""
+account_cache.py
+
+In-process cache of local DB accounts.
+"""
+
+import threading
+from collections import OrderedDict
+
+
+DEFAULT_CACHE_SIZE = 10000
+
+# Returned by 'get' for keys not in the cache
+MISSING = object()
+
+
+class AccountCache(object):
+    """LRU cache of local DB accounts keyed by lowercase email.
+    Unknown accounts are cached as None (negative entries).
+    Every invalidation bumps a generation counter, values read
+    from the DB are only stored if no invalidation happened since
+    the read started (see 'generation' and 'put').
+    """
+
+    def __init__(self, max_size=DEFAULT_CACHE_SIZE):
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.current_generation = 0
+        self.cache_stats = {
+            "hits": 0,
+            "misses": 0,
+        }
+
+    @staticmethod
+    def key(email):
+        """Returns the cache key for the given email."""
+        return email.lower()
+
+    def generation(self):
+        """Returns the current invalidation generation.
+        To be taken before reading the value to cache from the DB.
+        """
+        self.lock.acquire()
+        generation = self.current_generation
+        self.lock.release()
+        return generation
+
+    def get(self, email):
+        """Returns the cached account (or None for unknown accounts),
+        returns MISSING if the email is not cached.
+        """
+        key = self.key(email)
+        self.lock.acquire()
+        account = self.entries.pop(key, MISSING)
+        if account is MISSING:
+            self.cache_stats["misses"] += 1
+        else:
+            # Move to the most recently used position
+            self.entries[key] = account
+            self.cache_stats["hits"] += 1
+        self.lock.release()
+        return account
+
+    def put(self, email, account, generation):
+        """Caches the given account (None for unknown accounts),
+        unless an invalidation happened after 'generation'.
+        """
+        key = self.key(email)
+        self.lock.acquire()
+        if generation == self.current_generation:
+            self.entries.pop(key, None)
+            self.entries[key] = account
+            if len(self.entries) > self.max_size:
+                # Evict the least recently used entry
+                self.entries.popitem(last=False)
+        self.lock.release()
+
+    def invalidate(self, email):
+        """Removes the given email from the cache."""
+        key = self.key(email)
+        self.lock.acquire()
+        self.current_generation += 1
+        self.entries.pop(key, None)
+        self.lock.release()
+
+    def clear(self):
+        """Removes all the entries from the cache."""
+        self.lock.acquire()
+        self.current_generation += 1
+        self.entries.clear()
+        self.lock.release()
+
+    def get_stats(self):
+        """Returns a dict with the cache 'size', 'hits' and 'misses'."""
+        self.lock.acquire()
+        cache_stats = dict(self.cache_stats)
+        cache_stats["size"] = len(self.entries)
+        self.lock.release()
+        return cache_stats
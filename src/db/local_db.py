@@ -4,65 +4,428 @@ local_db.py
 semaphor-ldap local DB functionality.
 """
 
+import os
 import logging
+import json
 import sqlite3
+import threading
+import time
+import Queue
+
 import sqlitebck
 
 from flow import Flow
 
 from src import app_platform
+from src.db import account_cache, migrations, query_stats, storage
 
 
 LOG = logging.getLogger("local_db")
 
 
 BACKUP_FILENAME_SUFFIX = "-backup"
+CHANGESET_FILENAME_SUFFIX = "-changeset"
+EXPORT_FILENAME_SUFFIX = "-export.jsonl"
+CHANGESET_FORMAT = 1
+EXPORT_FORMAT = 1
+SQLITE_FILE_HEADER = "SQLite format 3\0"
+DEFAULT_BUSY_TIMEOUT = 10  # seconds
+WRITE_BATCH_SIZE = 256
+WRITE_BATCH_DELAY = 0.005  # seconds
+DELTA_FETCH_SIZE = 256
+USERLIST_PAGE_SIZE = 1000
+BACKUP_STEP_ROWS = 1000
+BACKUP_STEP_SLEEP = 0.01  # seconds
+DEFAULT_MAINTENANCE_MINUTES = 360
+MAINTENANCE_VACUUM_PAGES = 128
+MAINTENANCE_STEP_SLEEP = 0.05  # seconds
+MAINTENANCE_MAX_TIME = 30  # seconds
+ANALYSIS_LIMIT = 1000
+AUTO_VACUUM_INCREMENTAL = 2
+IMPORT_CHUNK_SIZE = 1000
+ACCOUNT_CHANGE_RETENTION = 7 * 24 * 3600  # seconds
+# uniqueids read from LDAP by the running LDAP snapshot update
+SNAPSHOT_SEEN_TABLE_SQL = """
+    create temp table if not exists ldap_snapshot_seen (
+        uniqueid varchar(128) not null primary key
+    )
+"""
+
+
+def iter_rows(cur, fetch_size=DELTA_FETCH_SIZE):
+    """Yields the rows of the executed cursor 'cur',
+    fetching 'fetch_size' rows at a time.
+    The cursor is closed once all rows were yielded.
+    """
+    try:
+        while True:
+            rows = cur.fetchmany(fetch_size)
+            if not rows:
+                break
+            for row in rows:
+                yield row
+    finally:
+        cur.close()
+
+
+def iter_jsonl(jsonl_file):
+    """Yields the JSON values of the lines of 'jsonl_file'
+    (empty lines are skipped).
+    """
+    for line in jsonl_file:
+        if line.strip():
+            yield json.loads(line)
+
+
+def is_full_backup(backup_filename):
+    """Returns True if the given backup file is a full backup
+    (a SQLite DB file) and False if it is a changeset backup.
+    """
+    with open(backup_filename, "rb") as backup_file:
+        return backup_file.read(len(SQLITE_FILE_HEADER)) == \
+            SQLITE_FILE_HEADER
+
+
+class WriteFuture(object):
+    """Pending result of a write submitted to the 'DBWriter'."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.lock = threading.Lock()
+        self.callbacks = []
+        self.finished = False
+        self.value = None
+        self.error = None
+
+    def add_done_callback(self, callback):
+        """Registers callback(future) to be called once the
+        write is committed (or failed).
+        It is called right away if the write is already done.
+        """
+        self.lock.acquire()
+        if not self.finished:
+            self.callbacks.append(callback)
+            callback = None
+        self.lock.release()
+        if callback:
+            callback(self)
+
+    def _set_done(self):
+        """Runs the done callbacks and wakes up waiters.
+        Callbacks run first, so waiters see their effects
+        (e.g. the account cache invalidation).
+        """
+        self.lock.acquire()
+        self.finished = True
+        callbacks = self.callbacks
+        self.callbacks = []
+        self.lock.release()
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception as exception:
+                LOG.error("write callback failed: %s", exception)
+        self.done.set()
+
+    def set_result(self, value):
+        """Sets the value returned by the write and wakes up waiters."""
+        self.value = value
+        self._set_done()
+
+    def set_error(self, error):
+        """Sets the exception raised by the write and wakes up waiters."""
+        self.error = error
+        self._set_done()
+
+    def result(self):
+        """Waits until the write is committed (or failed).
+        Returns the value returned by the write function, or raises
+        the exception that made the write fail.
+        """
+        self.done.wait()
+        if self.error:
+            raise self.error
+        return self.value
+
 
+class DBWriter(threading.Thread):
+    """Single writer thread for the local DB.
+    Writes submitted from any thread are queued and committed in groups
+    of up to 'batch_size' writes, or whatever was submitted within
+    'batch_delay' seconds from the first write of the group.
+    Each write runs in its own savepoint, so a failing write does not
+    discard the other writes of its group.
+    """
 
-class LocalDB(object):
-    """Encapsulates semaphor-ldap local DB operations."""
+    def __init__(self,
+                 local_db,
+                 batch_size=WRITE_BATCH_SIZE,
+                 batch_delay=WRITE_BATCH_DELAY):
+        super(DBWriter, self).__init__()
+        self.daemon = True
+        self.local_db = local_db
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.queue = Queue.Queue()
+        self.keep_running = threading.Event()
+        self.keep_running.set()
+        self.stats_lock = threading.Lock()
+        self.write_stats = {
+            "writes": 0,
+            "commits": 0,
+        }
+
+    def submit(self, write_func, *args):
+        """Queues write_func(db_conn, *args) for execution on the
+        writer thread. Returns a 'WriteFuture' for its result.
+        """
+        future = WriteFuture()
+        if not self.keep_running.is_set():
+            future.set_error(sqlite3.ProgrammingError("DB writer stopped"))
+            return future
+        self.queue.put((write_func, args, future))
+        return future
 
-    def __init__(self, schema_file_name, db_file_name=""):
+    def stop(self):
+        """Commits pending writes and finishes the writer thread."""
+        self.keep_running.clear()
+        self.queue.put(None)
+
+    def is_idle(self):
+        """Returns True if there are no writes waiting to be committed."""
+        return self.queue.empty()
+
+    def get_write_stats(self):
+        """Returns a dict with the number of 'writes' and 'commits'."""
+        self.stats_lock.acquire()
+        write_stats = dict(self.write_stats)
+        self.stats_lock.release()
+        return write_stats
+
+    def next_batch(self):
+        """Blocks until a write is available and returns it together
+        with the writes submitted within the batch bounds.
+        Returns an empty list when the writer is stopped.
+        """
+        batch = []
+        item = self.queue.get()
+        deadline = time.time() + self.batch_delay
+        while item is not None:
+            batch.append(item)
+            if len(batch) >= self.batch_size:
+                break
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                item = self.queue.get(timeout=timeout)
+            except Queue.Empty:
+                break
+        else:
+            # Stop requested, process the pending writes first
+            self.queue.put(None)
+        return batch
+
+    def commit_batch(self, db_conn, batch):
+        """Executes the given writes in one transaction and
+        resolves their futures once the transaction is committed.
+        """
+        results = []
+        stats = self.local_db.query_stats
+        try:
+            db_conn.execute("begin immediate")
+            for write_func, args, future in batch:
+                db_conn.execute("savepoint write_intent")
+                start_time = time.time()
+                try:
+                    value = write_func(db_conn, *args)
+                except Exception as exception:
+                    db_conn.execute("rollback to write_intent")
+                    results.append((future, None, exception))
+                else:
+                    results.append((future, value, None))
+                # Writes are named after their function, e.g. 'update_lock'
+                stats.record(
+                    write_func.__name__.lstrip("_"),
+                    time.time() - start_time,
+                )
+                db_conn.execute("release write_intent")
+            start_time = time.time()
+            db_conn.execute("commit")
+            stats.record("commit", time.time() - start_time)
+            self.stats_lock.acquire()
+            self.write_stats["writes"] += len(batch)
+            self.write_stats["commits"] += 1
+            self.stats_lock.release()
+        except sqlite3.Error as db_err:
+            LOG.error("db write batch failed: %s", db_err)
+            try:
+                db_conn.execute("rollback")
+            except sqlite3.Error:
+                # No transaction was started
+                pass
+            for _, _, future in batch:
+                future.set_error(db_err)
+            return
+        for future, value, error in results:
+            if error:
+                future.set_error(error)
+            else:
+                future.set_result(value)
+
+    def run(self):
+        """Runs the writer loop."""
+        LOG.info("db writer thread started")
+        db_conn = self.local_db._connect()
+        # Transactions are handled explicitly by commit_batch
+        db_conn.isolation_level = None
+        while True:
+            batch = self.next_batch()
+            if not batch:
+                break
+            self.commit_batch(db_conn, batch)
+        db_conn.close()
+        LOG.info("db writer thread finished")
+
+
+class LocalDB(storage.Storage):
+    """Encapsulates semaphor-ldap local DB operations,
+    the SQLite storage engine.
+    """
+
+    engine = storage.ENGINE_SQLITE
+    supports_backup = True
+
+    # Class of the local DB connections
+    # (the query plan tests use it to record the executed statements)
+    connection_class = sqlite3.Connection
+
+    def __init__(self,
+                 schema_file_name,
+                 db_file_name="",
+                 busy_timeout=DEFAULT_BUSY_TIMEOUT,
+                 account_cache_size=account_cache.DEFAULT_CACHE_SIZE,
+                 slow_query_ms=0):
+        super(LocalDB, self).__init__(account_cache_size, slow_query_ms)
+        self.schema_file_name = schema_file_name
         self.db_file_name = db_file_name or app_platform.local_db_path()
+        self.busy_timeout = busy_timeout
+        self.conn_local = threading.local()
+        self.stats_lock = threading.Lock()
+        self.conn_stats = {
+            "opened": 0,
+            "reused": 0,
+        }
+        self.backup_progress = {
+            "rows": 0,
+            "total_rows": 0,
+            "start_time": None,
+            "end_time": None,
+        }
+        self.maintenance_stats = {
+            "freed_pages": 0,
+            "start_time": None,
+            "end_time": None,
+        }
         LOG.info("using '%s' database", self.db_file_name)
-        db_conn = self._get_connection()
-        with open(schema_file_name, "r") as schema_file:
-            db_conn.executescript(schema_file.read())
-        db_conn.commit()
-        db_conn.close()
+        self._migrate(self._get_connection())
+        self.writer = DBWriter(self)
+        self.writer.start()
 
-    def _get_connection(self):
-        """Returns a connection to the local DB."""
-        db_conn = sqlite3.connect(self.db_file_name)
+    def _migrate(self, db_conn):
+        """Brings the DB schema up to date (see migrations.migrate).
+        DBs created before incremental auto vacuum are switched to it
+        here, so the full VACUUM it needs is not run by the scheduled
+        maintenance.
+        """
+        migrations.migrate(db_conn, self.schema_file_name)
+        auto_vacuum = db_conn.execute("pragma auto_vacuum").fetchone()[0]
+        if auto_vacuum != AUTO_VACUUM_INCREMENTAL:
+            self._enable_incremental_vacuum()
+
+    def _connect(self):
+        """Opens a new connection to the local DB.
+        The DB is set to WAL journal mode, so readers
+        (e.g. bind requests) do not block on writers (e.g. ldap-sync).
+        """
+        db_conn = sqlite3.connect(
+            self.db_file_name,
+            timeout=self.busy_timeout,
+            factory=self.connection_class,
+        )
         db_conn.row_factory = sqlite3.Row
+        # Only applies to new DBs, it must be set before the first write
+        db_conn.execute("pragma auto_vacuum = incremental")
+        db_conn.execute("pragma journal_mode = wal")
         return db_conn
 
+    def _get_connection(self):
+        """Returns the connection to the local DB for the calling thread.
+        The connection is opened on the first call of each thread
+        and reused on subsequent calls.
+        """
+        db_conn = getattr(self.conn_local, "db_conn", None)
+        self.stats_lock.acquire()
+        if db_conn:
+            self.conn_stats["reused"] += 1
+        else:
+            self.conn_stats["opened"] += 1
+        self.stats_lock.release()
+        if not db_conn:
+            db_conn = self._connect()
+            self.conn_local.db_conn = db_conn
+        return db_conn
+
+    def close(self):
+        """Stops the writer thread (after committing pending writes)
+        and closes the connection of the calling thread (if any).
+        """
+        if self.writer.is_alive():
+            self.writer.stop()
+            self.writer.join()
+        db_conn = getattr(self.conn_local, "db_conn", None)
+        if db_conn:
+            db_conn.close()
+            self.conn_local.db_conn = None
+
+    def get_connection_stats(self):
+        """Returns a dict with the connection reuse counters:
+        'opened' (new connections) and 'reused' (connection reuses).
+        """
+        self.stats_lock.acquire()
+        conn_stats = dict(self.conn_stats)
+        self.stats_lock.release()
+        return conn_stats
+
     def check_connection(self):
         """Tries a connection to the DB.
         It throws a sqlite3.Error exception if it failed to connect.
         """
         db_conn = self._get_connection()
-        db_conn.close()
+        db_conn.execute("select 1")
 
+    @query_stats.timed("entries_to_setup")
     def entries_to_setup(self, db_conn):
         """Get accounts that are on LDAP but not on local DB and
         are marked as enabled on LDAP. These accounts should be setup.
         By setup we mean Semaphor-LDAP will create Semaphor accounts
         for them.
+        Only changed (dirty) LDAP snapshot entries are considered.
         """
         cur = db_conn.cursor()
         cur.execute(
-            """select lg.uniqueid, lg.email, lg.enabled
-            from ldap_group lg
-            left join ldap_account la on lg.uniqueid = la.uniqueid
-            where lg.enabled and la.uniqueid is null and
-            not exists(select 1 from ldap_account where email = lg.email)
+            """select ls.uniqueid, ls.email, ls.enabled
+            from ldap_snapshot ls
+            where ls.dirty = 1 and ls.enabled and
+            not exists(select 1 from ldap_account
+                       where uniqueid = ls.uniqueid) and
+            not exists(select 1 from ldap_account where email = ls.email)
+            order by ls.uniqueid
             """,
         )
-        accounts = cur.fetchall()
-        cur.close()
-        return accounts
+        return iter_rows(cur)
 
+    @query_stats.timed("entries_to_retry_setup")
     def entries_to_retry_setup(self, db_conn):
         """Get accounts that are on LDAP and on our DB,
         but they are currently marked as 'ldap lock'ed.
@@ -72,50 +435,41 @@ class LocalDB(object):
         """
         cur = db_conn.cursor()
         cur.execute(
-            """select lg.uniqueid, lg.email, lg.enabled
-            from ldap_group lg
-            left join ldap_account la on lg.uniqueid = la.uniqueid
-            left join semaphor_account sa on la.id = sa.ldap_account
-            where lg.enabled and sa.lock_state = %d
+            """select ls.uniqueid, ls.email, ls.enabled
+            from semaphor_account sa
+            join ldap_account la on la.id = sa.ldap_account
+            join ldap_snapshot ls on ls.uniqueid = la.uniqueid
+            where sa.lock_state = %d and ls.enabled
+            order by ls.uniqueid
             """ % Flow.LDAP_LOCK,
         )
-        accounts = cur.fetchall()
-        cur.close()
-        return accounts
+        return iter_rows(cur)
 
+    @query_stats.timed("entries_to_update_lock")
     def entries_to_update_lock(self, db_conn):
         """Get accounts that we track on our local DB and should
         be 'full lock'ed or unlocked from 'full lock'.
+        Accounts removed from the LDAP group are disabled
+        snapshot entries, so they are also 'full lock'ed.
+        Only changed (dirty) LDAP snapshot entries are considered.
         """
         cur = db_conn.cursor()
         cur.execute(
-            """/* ldaped accounts with 'enabled' mismatch. */
-            select lg.uniqueid as uniqueid, lg.email as email,
-            lg.enabled as enabled, sa.lock_state as lock_state
-            from ldap_group lg
-            left join ldap_account la on lg.uniqueid = la.uniqueid
-            left join semaphor_account sa on la.id = sa.ldap_account
-            where ((not lg.enabled and la.enabled) or
-                   (lg.enabled and not la.enabled))
-
-            union
-
-            /* ldaped accounts not present in ldap but present in our db
-             * and currently enabled
-             */
-            select la.uniqueid as uniqueid, la.email as email, 0 as enabled,
-            sa.lock_state as lock_state
-            from ldap_account la
-            left join ldap_group lg on la.uniqueid = lg.uniqueid
-            left join semaphor_account sa on la.id = sa.ldap_account
-            where la.enabled != 0 and lg.uniqueid is null
+            """select ls.uniqueid as uniqueid, ls.email as email,
+            ls.enabled as enabled, sa.lock_state as lock_state
+            from ldap_snapshot ls
+            join ldap_account la on la.uniqueid = ls.uniqueid
+            left join semaphor_account sa on sa.ldap_account = la.id
+            where ls.dirty = 1 and
+            ((not ls.enabled and la.enabled) or
+             (ls.enabled and not la.enabled))
+            order by ls.uniqueid
             """,
         )
-        accounts = cur.fetchall()
-        cur.close()
-        return accounts
+        return iter_rows(cur)
 
-    def update_uids(self, db_conn):
+    @staticmethod
+    def update_uids(db_conn):
         """Update 'uniqueid's of accounts that don't match our local DB.
         E.g., if we have:
          - LDAP: email=john@example.com, uniqueid=X,
@@ -123,81 +477,199 @@ class LocalDB(object):
         Then this method will update our local DB entry for
         'john@example.com' with 'uniqueid=X'.
         We currently consider the 'email' as the identifier of EndUsers.
+        Only changed (dirty) LDAP snapshot entries are considered.
+        Returns the number of updated accounts.
         """
         cur = db_conn.cursor()
         cur.execute(
-            """select lg.uniqueid, lg.email
-            from ldap_group lg
-            left join ldap_account la on lg.email = la.email
-            where lg.uniqueid != la.uniqueid
-            """,
-        )
-        accounts = cur.fetchall()
-        accounts_values = [
-            (account["uniqueid"], account["email"])
-            for account in accounts
-        ]
-        cur.executemany(
             """update ldap_account
-            set uniqueid = ?
-            where email = ?
+            set uniqueid = (
+                select ls.uniqueid from ldap_snapshot ls
+                where ls.email = ldap_account.email and
+                ls.dirty = 1 and ls.present and
+                ls.uniqueid != ldap_account.uniqueid
+            )
+            where email in (
+                select email from ldap_snapshot
+                where dirty = 1 and present
+            ) and exists(
+                select 1 from ldap_snapshot ls
+                where ls.email = ldap_account.email and
+                ls.dirty = 1 and ls.present and
+                ls.uniqueid != ldap_account.uniqueid
+            )
             """,
-            accounts_values,
         )
-        # Commit to update uniqueids on local DB
-        db_conn.commit()
+        updated_uids = cur.rowcount
         cur.close()
+        return updated_uids
 
-    def delta(self, ldap_accounts):
-        """It will first update (commit) uniqueids
-        on our local db to match LDAP.
-        Then return (not execute) the actions
-        to run for our local DB to match LDAP.
+    def _snapshot_page_hashes(self, uniqueids):
+        """Returns a dict with the content hash of the present
+        LDAP snapshot entries of the given uniqueids.
         """
+        if not uniqueids:
+            return {}
         db_conn = self._get_connection()
         cur = db_conn.cursor()
         cur.execute(
-            """/* Create a temp table w/ same cols as ldap_account */
-            create temporary table ldap_group
-            as select * from ldap_account where 0
+            """select uniqueid, content_hash
+            from ldap_snapshot
+            where present and uniqueid in (%s)
+            """ % ", ".join("?" * len(uniqueids)),
+            uniqueids,
+        )
+        snapshot_hashes = dict(cur.fetchall())
+        cur.close()
+        return snapshot_hashes
+
+    @staticmethod
+    def _begin_snapshot(db_conn):
+        """Starts an LDAP snapshot update, runs on the writer thread.
+        Entries reconciled with ldap_account since the last run are
+        marked as clean (removed entries are deleted).
+        The uniqueids read from LDAP are collected on the
+        'ldap_snapshot_seen' temporary table of the writer connection.
+        """
+        reconciled_cond = """
+            not exists(select 1 from ldap_account la
+                       where la.uniqueid = ldap_snapshot.uniqueid and
+                       la.enabled != ldap_snapshot.enabled) and
+            (not ldap_snapshot.enabled or
+             exists(select 1 from ldap_account la
+                    where la.uniqueid = ldap_snapshot.uniqueid))
+        """
+        cur = db_conn.cursor()
+        cur.execute(
+            """delete from ldap_snapshot
+            where dirty = 1 and not present and %s
+            """ % reconciled_cond,
+        )
+        cur.execute(
+            "update ldap_snapshot set dirty = 0 where dirty = 1 and %s" % (
+                reconciled_cond,
+            ),
+        )
+        cur.execute(SNAPSHOT_SEEN_TABLE_SQL)
+        cur.execute("delete from ldap_snapshot_seen")
+        cur.close()
+        return True
+
+    @staticmethod
+    def _write_snapshot_page(db_conn, changed_values, uniqueids):
+        """Writes a page of the LDAP snapshot update, runs on the
+        writer thread. Changed entries are stored and marked dirty.
+        """
+        cur = db_conn.cursor()
+        cur.executemany(
+            """insert or replace into ldap_snapshot
+            (uniqueid, email, enabled, content_hash, present, dirty)
+            values (?, ?, ?, ?, 1, 1)
             """,
+            changed_values,
         )
-        ldap_account_values = [
-            (ldap_account["uniqueid"], ldap_account["email"],
-             ldap_account["enabled"])
-            for ldap_account in ldap_accounts
-        ]
         cur.executemany(
-            """insert into ldap_group
-            (uniqueid, email, enabled)
-            values (?, ?, ?)
+            "insert or ignore into ldap_snapshot_seen (uniqueid) values (?)",
+            [(uniqueid,) for uniqueid in uniqueids],
+        )
+        cur.close()
+        return True
+
+    @classmethod
+    def _end_snapshot(cls, db_conn):
+        """Finishes the LDAP snapshot update, runs on the writer thread.
+        1. Entries not read from LDAP are disabled and marked dirty.
+        2. ldap_account uniqueids are updated to match the snapshot.
+        Returns a tuple with the number of removed entries
+        and the number of accounts with an updated uniqueid.
+        """
+        cur = db_conn.cursor()
+        cur.execute(
+            """update ldap_snapshot
+            set enabled = 0, content_hash = null, present = 0, dirty = 1
+            where present and uniqueid not in (
+                select uniqueid from ldap_snapshot_seen
+            )
             """,
-            ldap_account_values,
         )
+        removed = cur.rowcount
+        cur.execute("delete from ldap_snapshot_seen")
         cur.close()
+        return removed, cls.update_uids(db_conn)
 
-        # Update uniqueids on local DB first
-        self.update_uids(db_conn)
+    @staticmethod
+    def _write_snapshot_entries(db_conn, changed_values, removed_uniqueids):
+        """Writes the given LDAP snapshot entries, runs on the writer
+        thread. Changed entries are stored and removed entries disabled,
+        both marked dirty.
+        Returns the number of removed entries.
+        """
+        cur = db_conn.cursor()
+        cur.executemany(
+            """insert or replace into ldap_snapshot
+            (uniqueid, email, enabled, content_hash, present, dirty)
+            values (?, ?, ?, ?, 1, 1)
+            """,
+            changed_values,
+        )
+        cur.executemany(
+            """update ldap_snapshot
+            set enabled = 0, content_hash = null, present = 0, dirty = 1
+            where present and uniqueid = ?
+            """,
+            [(uniqueid,) for uniqueid in removed_uniqueids],
+        )
+        removed = cur.rowcount
+        cur.close()
+        return removed
 
+    def delta_changes(self):
+        """Returns (not execute) the actions to run for our local DB
+        to match the LDAP snapshot, see 'delta'.
+        """
         # Determine actions, but we do not execute them
+        db_conn = self._get_connection()
         delta_changes = {}
         delta_changes["setup"] = self.entries_to_setup(db_conn)
         delta_changes["retry_setup"] = self.entries_to_retry_setup(db_conn)
         delta_changes["update_lock"] = self.entries_to_update_lock(db_conn)
 
-        db_conn.close()
-
         # Return actions to the caller
         return delta_changes
 
-    def create_account(self, ldap_data, semaphor_data):
-        """Create account entries with:
-        - ldap_data for ldap_account table.
-        - semaphor_data for semaphor_account table.
+    def retry_delta(self):
+        """Returns (not execute) only the 'retry_setup' actions.
+        Used when the LDAP entries did not change since the last sync.
         """
-        assert(ldap_data)
-        assert(semaphor_data)
         db_conn = self._get_connection()
+        return {
+            "retry_setup": self.entries_to_retry_setup(db_conn),
+        }
+
+    @query_stats.timed("get_sync_state")
+    def get_sync_state(self, key):
+        """Returns the stored value for the given
+        sync state key, or None if not set.
+        """
+        db_conn = self._get_connection()
+        row = db_conn.execute(
+            "select value from sync_state where key = ?",
+            (key,),
+        ).fetchone()
+        return row[0] if row else None
+
+    @staticmethod
+    def _set_sync_state(db_conn, key, value):
+        """Writes the sync state value, runs on the writer thread."""
+        db_conn.execute(
+            "insert or replace into sync_state (key, value) values (?, ?)",
+            (key, value),
+        )
+        return True
+
+    @staticmethod
+    def _create_account(db_conn, ldap_data, semaphor_data):
+        """Writes the account entries, runs on the writer thread."""
         cur = db_conn.cursor()
         # Create entry on the ldap_account table first
         ldap_data_values = (
@@ -227,44 +699,42 @@ class LocalDB(object):
             """,
             semaphor_data_values,
         )
-        db_conn.commit()
+        # Track the account on the LDAP snapshot (if not there yet)
+        cur.execute(
+            """insert or ignore into ldap_snapshot
+            (uniqueid, email, enabled, content_hash, present, dirty)
+            values (?, ?, ?, null, 1, 0)
+            """,
+            ldap_data_values,
+        )
         cur.close()
-        db_conn.close()
         return True
 
-    def get_account(self, username):
-        """Get all available local DB data of the given username.
-        Returns a dict with the following keys:
-        'uniqueid', email', 'enabled',
-        'semaphor_guid', 'password', 'L2' and 'lock_state'.
-        """
+    @query_stats.timed("read_account")
+    def _read_account(self, username):
+        """Reads the account data of the given username from the DB."""
         db_conn = self._get_connection()
         cur = db_conn.cursor()
         cur.execute(
-            "select * from ldap_account where email = ?",
-            (username,),
-        )
-        ldap_account = cur.fetchone()
-        cur.execute(
-            """select semaphor_guid, password, L2, lock_state
-            from semaphor_account
-            where ldap_account = ?
+            """select la.*, sa.semaphor_guid, sa.password, sa.L2,
+            sa.lock_state
+            from ldap_account la
+            left join semaphor_account sa on sa.ldap_account = la.id
+            where la.email = ?
             """,
-            (ldap_account["id"],),
+            (username,),
         )
-        semaphor_account = cur.fetchone()
-        account = {}
-        account.update(ldap_account)
-        account.update(semaphor_account)
+        row_account = cur.fetchone()
         cur.close()
-        db_conn.close()
+        if not row_account:
+            return None
+        account = {}
+        account.update(row_account)
         return account
 
-    def update_semaphor_account(self, username, semaphor_data):
-        """Update 'semaphor_account' DB entry for the given username
-        with the provided 'semaphor_data'.
-        """
-        db_conn = self._get_connection()
+    @staticmethod
+    def _update_semaphor_account(db_conn, username, semaphor_data):
+        """Writes the 'semaphor_account' entry, runs on the writer thread."""
         cur = db_conn.cursor()
         cur.execute(
             "select id from ldap_account where email = ?",
@@ -289,27 +759,22 @@ class LocalDB(object):
                 ldap_account_id[0],
             ),
         )
-        db_conn.commit()
         cur.close()
-        db_conn.close()
         return True
 
-    def update_lock(self, ldap_account):
-        """Updates the 'enabled' state on the 'ldap_account' table
-        for the given account, and also updates the 'lock_state'
-        column of the 'semaphor_account' table.
-        It only updates the semaphor_account.lock_state if it is
-        not ldap-locked.
+    @staticmethod
+    def _update_lock(db_conn, ldap_account):
+        """Writes the lock state update, runs on the writer thread.
+        Returns the local DB email of the account (see 'update_lock').
         """
         uniqueid = ldap_account["uniqueid"]
         enabled = ldap_account["enabled"]
         semaphor_lock_state = \
             Flow.UNLOCK if enabled else Flow.FULL_LOCK
-        db_conn = self._get_connection()
         cur = db_conn.cursor()
         # Get ldap_account entry id
         cur.execute(
-            "select id from ldap_account where uniqueid = ?",
+            "select id, email from ldap_account where uniqueid = ?",
             (uniqueid,),
         )
         row = cur.fetchone()
@@ -319,7 +784,7 @@ class LocalDB(object):
                 uniqueid,
             )
             return False
-        ldap_account_entry_id = row[0]
+        ldap_account_entry_id, email = row
         cur.execute(
             """update ldap_account
             set enabled = ?
@@ -340,30 +805,57 @@ class LocalDB(object):
                     ldap_account_entry_id,
                 ),
             )
-        db_conn.commit()
         cur.close()
-        db_conn.close()
-        return True
+        return email
 
-    def get_db_accounts(self):
-        """Returns all the accounts on the local db."""
+    def iter_db_accounts(self, limit=None, after=None,
+                         lock_state=None, enabled=None):
+        """Same as 'get_db_accounts', but it returns an iterator of row
+        tuples (with the storage.DB_ACCOUNT_COLUMNS values), read
+        DELTA_FETCH_SIZE rows at a time, so large listings are not
+        held in memory.
+        The query runs on the call, the rows are read when iterated.
+        """
+        return iter_rows(
+            self._db_accounts_cursor(limit, after, lock_state, enabled),
+        )
+
+    @query_stats.timed("get_db_accounts")
+    def _db_accounts_cursor(self, limit, after, lock_state, enabled):
+        """Returns the executed cursor of the accounts query
+        (see 'get_db_accounts'), its rows are tuples.
+        """
+        conditions = []
+        params = []
+        if after is not None:
+            conditions.append("la.email > ?")
+            params.append(after)
+        if lock_state is not None:
+            # Filter (not search) on lock_state, so that accounts
+            # are read in email order from the email index
+            conditions.append("+sa.lock_state = ?")
+            params.append(lock_state)
+        if enabled is not None:
+            conditions.append("la.enabled = ?")
+            params.append(1 if enabled else 0)
+        query = "select %s\n" % ", ".join(storage.DB_ACCOUNT_COLUMNS)
+        query += """from ldap_account la
+            left join semaphor_account sa on la.id = sa.ldap_account
+            """
+        if conditions:
+            query += "where %s\n" % " and ".join(conditions)
+        query += "order by la.email\n"
+        if limit is not None:
+            query += "limit ?\n"
+            params.append(limit)
         db_conn = self._get_connection()
         cur = db_conn.cursor()
-        cur.execute(
-            """select email, uniqueid, enabled, semaphor_guid, lock_state
-            from ldap_account la
-            left join semaphor_account sa on la.id = sa.ldap_account
-            """,
-        )
-        accounts = []
-        for row_account in cur.fetchall():
-            account_map = {}
-            account_map.update(row_account)
-            accounts.append(account_map)
-        cur.close()
-        db_conn.close()
-        return accounts
+        # Plain tuples, instead of sqlite3.Row objects
+        cur.row_factory = None
+        cur.execute(query, params)
+        return cur
 
+    @query_stats.timed("get_enabled_ldaped_accounts")
     def get_enabled_ldaped_accounts(self):
         """Returns the semaphor account ids of the ldaped accounts,
         that is, the accounts under the control of the bot.
@@ -380,19 +872,653 @@ class LocalDB(object):
         )
         account_ids = [account[0] for account in cur.fetchall()]
         cur.close()
-        db_conn.close()
         return account_ids
 
-    def run_backup(self):
-        """Creates a backup database file and returns its file name."""
+    def get_account_change_seq(self):
+        """Returns the sequence number of the last logged
+        account change (0 if no change was logged yet).
+        """
         db_conn = self._get_connection()
+        row = db_conn.execute(
+            "select seq from sqlite_sequence where name = 'account_change'",
+        ).fetchone()
+        return row[0] if row else 0
+
+    @query_stats.timed("get_account_changes")
+    def get_account_changes(self, since_seq):
+        """Returns the account changes logged after the 'since_seq'
+        sequence number, in order. Each change is a dict with its 'seq',
+        'change' (created, unlocked, relinked or reenabled) and the
+        current 'email', 'enabled', 'semaphor_guid' and 'lock_state'
+        of the account.
+        Returns None if changes after 'since_seq' were already pruned
+        from the log, the caller must then process all accounts.
+        """
+        db_conn = self._get_connection()
+        cur = db_conn.cursor()
+        first_seq = cur.execute(
+            "select min(seq) from account_change",
+        ).fetchone()[0]
+        if first_seq is None:
+            first_seq = self.get_account_change_seq() + 1
+        if since_seq + 1 < first_seq:
+            cur.close()
+            return None
+        cur.execute(
+            """select ac.seq, ac.change, la.email, la.enabled,
+            sa.semaphor_guid, sa.lock_state
+            from account_change ac
+            join ldap_account la on la.id = ac.ldap_account
+            left join semaphor_account sa on sa.ldap_account = la.id
+            where ac.seq > ?
+            order by ac.seq
+            """,
+            (since_seq,),
+        )
+        changes = []
+        for row_change in cur.fetchall():
+            change = {}
+            change.update(row_change)
+            changes.append(change)
+        cur.close()
+        return changes
+
+    @staticmethod
+    def _prune_account_changes(db_conn, before_time):
+        """Removes the account changes logged before 'before_time',
+        runs on the writer thread. Returns the number of removed changes.
+        """
+        return db_conn.execute(
+            "delete from account_change where time < ?",
+            (int(before_time),),
+        ).rowcount
+
+    @query_stats.timed("run_backup")
+    def run_backup(self,
+                   step_rows=BACKUP_STEP_ROWS,
+                   step_sleep=BACKUP_STEP_SLEEP):
+        """Creates a full backup database file.
+        The DB is copied from a single read transaction (a consistent
+        snapshot, which does not block writers on WAL mode), in steps
+        of 'step_rows' rows, sleeping 'step_sleep' seconds between
+        steps. Progress is available with 'get_backup_progress'.
+        Returns a tuple with the backup file name and
+        the last change sequence number included in the backup.
+        """
         backup_filename = \
             "%s%s" % (self.db_file_name, BACKUP_FILENAME_SUFFIX)
+        if os.path.exists(backup_filename):
+            os.remove(backup_filename)
+        db_conn = self._connect()
+        db_conn.isolation_level = None
         db_back_conn = sqlite3.connect(backup_filename)
-        sqlitebck.copy(db_conn, db_back_conn)
-        db_conn.close()
+        db_back_conn.isolation_level = None
+        db_back_conn.execute("pragma synchronous = off")
+        db_back_conn.execute("pragma auto_vacuum = incremental")
+        db_conn.execute("begin")
+        try:
+            schema = {}
+            for schema_type in ("table", "index", "trigger"):
+                schema[schema_type] = db_conn.execute(
+                    """select name, sql from sqlite_master
+                    where type = ? and sql is not null and
+                    name not like 'sqlite_%'
+                    order by rowid
+                    """,
+                    (schema_type,),
+                ).fetchall()
+            # Tracked changes are not copied, the backup includes them,
+            # neither is the account change log, the sync state (with
+            # the consumers position on the log) is reset on restore
+            tables = [
+                name for name, _ in schema["table"]
+                if name not in ("backup_change", "account_change")
+            ]
+            self._start_backup_progress(sum(
+                db_conn.execute("select count(*) from %s" % table)
+                .fetchone()[0]
+                for table in tables
+            ))
+            db_back_conn.execute("begin")
+            for _, sql in schema["table"]:
+                db_back_conn.execute(sql)
+            for table in tables:
+                self._copy_table(
+                    db_conn,
+                    db_back_conn,
+                    table,
+                    step_rows,
+                    step_sleep,
+                )
+            # Indexes and triggers are created after the data is copied
+            for _, sql in schema["index"] + schema["trigger"]:
+                db_back_conn.execute(sql)
+            # The query planner statistics (see 'run_maintenance'),
+            # a restored DB uses them before the next maintenance run
+            if db_conn.execute(
+                    "select 1 from sqlite_master where name = 'sqlite_stat1'",
+            ).fetchone():
+                # Creates the (empty) statistics table
+                db_back_conn.execute("analyze sqlite_master")
+                db_back_conn.executemany(
+                    "insert into sqlite_stat1 (tbl, idx, stat) "
+                    "values (?, ?, ?)",
+                    db_conn.execute("select tbl, idx, stat from sqlite_stat1"),
+                )
+            db_back_conn.execute(
+                "pragma user_version = %d" %
+                migrations.schema_version(db_conn),
+            )
+            change_seq = db_conn.execute(
+                "select coalesce(max(seq), 0) from backup_change",
+            ).fetchone()[0]
+            db_back_conn.execute("commit")
+        finally:
+            db_conn.execute("commit")
+            db_conn.close()
+            db_back_conn.close()
+            self._end_backup_progress()
+        return backup_filename, change_seq
+
+    def _copy_table(self, db_conn, db_back_conn, table,
+                    step_rows, step_sleep):
+        """Copies the rows of 'table' to the backup DB
+        in steps of 'step_rows' rows, by rowid.
+        """
+        last_rowid = None
+        while True:
+            if last_rowid is None:
+                cur = db_conn.execute(
+                    """select rowid as backup_rowid, * from %s
+                    order by rowid limit ?
+                    """ % table,
+                    (step_rows,),
+                )
+            else:
+                cur = db_conn.execute(
+                    """select rowid as backup_rowid, * from %s
+                    where rowid > ? order by rowid limit ?
+                    """ % table,
+                    (last_rowid, step_rows),
+                )
+            columns = [column[0] for column in cur.description][1:]
+            rows = cur.fetchall()
+            if not rows:
+                return
+            db_back_conn.executemany(
+                "insert into %s (%s) values (%s)" % (
+                    table,
+                    ", ".join(columns),
+                    ", ".join("?" * len(columns)),
+                ),
+                [tuple(row)[1:] for row in rows],
+            )
+            last_rowid = rows[-1][0]
+            self.stats_lock.acquire()
+            self.backup_progress["rows"] += len(rows)
+            self.stats_lock.release()
+            # Let other threads (e.g. writers) run between steps
+            time.sleep(step_sleep)
+
+    def _start_backup_progress(self, total_rows):
+        """Resets the backup progress for a new backup."""
+        self.stats_lock.acquire()
+        self.backup_progress = {
+            "rows": 0,
+            "total_rows": total_rows,
+            "start_time": time.time(),
+            "end_time": None,
+        }
+        self.stats_lock.release()
+
+    def _end_backup_progress(self):
+        """Marks the current backup as finished."""
+        self.stats_lock.acquire()
+        self.backup_progress["end_time"] = time.time()
+        self.stats_lock.release()
+
+    def get_backup_progress(self):
+        """Returns a dict with the progress of the current
+        (or last) full backup: 'rows' copied, 'total_rows',
+        'running' and 'elapsed' seconds, or None if no
+        backup was run.
+        """
+        self.stats_lock.acquire()
+        backup_progress = dict(self.backup_progress)
+        self.stats_lock.release()
+        start_time = backup_progress.pop("start_time")
+        end_time = backup_progress.pop("end_time")
+        if start_time is None:
+            return None
+        backup_progress["running"] = end_time is None
+        backup_progress["elapsed"] = (end_time or time.time()) - start_time
+        return backup_progress
+
+    @query_stats.timed("run_changeset_backup")
+    def run_changeset_backup(self):
+        """Creates a changeset backup file with the rows changed
+        since the last backup (see 'commit_backup').
+        The file has a JSON header line, followed by a JSON line
+        per changed row with its table, key and current values
+        (or null if the row was deleted).
+        Returns a tuple with the changeset file name and the last
+        change sequence number included in the changeset,
+        or (None, 0) if there are no changes.
+        """
+        changeset_filename = \
+            "%s%s" % (self.db_file_name, CHANGESET_FILENAME_SUFFIX)
+        # Changes are read on a single read transaction
+        db_conn = self._connect()
+        db_conn.isolation_level = None
+        db_conn.execute("begin")
+        try:
+            change_seq = db_conn.execute(
+                "select coalesce(max(seq), 0) from backup_change",
+            ).fetchone()[0]
+            if not change_seq:
+                return None, 0
+            with open(changeset_filename, "w") as changeset_file:
+                changeset_file.write("%s\n" % json.dumps({
+                    "changeset": CHANGESET_FORMAT,
+                    "schema_version": migrations.schema_version(db_conn),
+                }, sort_keys=True))
+                for table, key in migrations.CHANGE_TRACKED_TABLES:
+                    cur = db_conn.execute(
+                        """select bc.row_key as change_row_key, t.*
+                        from backup_change bc
+                        left join %s t on t.%s = bc.row_key
+                        where bc.tbl = ? and bc.seq <= ?
+                        order by bc.seq
+                        """ % (table, key),
+                        (table, change_seq),
+                    )
+                    for row in iter_rows(cur):
+                        values = None
+                        if row[key] is not None:
+                            values = {
+                                column: row[column]
+                                for column in row.keys()[1:]
+                            }
+                        changeset_file.write("%s\n" % json.dumps({
+                            "table": table,
+                            "key": row["change_row_key"],
+                            "row": values,
+                        }, sort_keys=True))
+        finally:
+            db_conn.execute("commit")
+            db_conn.close()
+        return changeset_filename, change_seq
+
+    def commit_backup(self, change_seq):
+        """Marks the changes up to 'change_seq' as backed up,
+        to be called once the backup file was stored.
+        """
+        return self.writer.submit(self._commit_backup, change_seq).result()
+
+    @staticmethod
+    def _commit_backup(db_conn, change_seq):
+        """Removes the backed up changes, runs on the writer thread."""
+        db_conn.execute(
+            "delete from backup_change where seq <= ?",
+            (change_seq,),
+        )
+        return True
+
+    def restore_backup(self, backup_filename, changeset_filenames):
+        """Restores the local DB from the given full backup file,
+        and then applies the given changeset backup files in order.
+        """
+        db_conn = self._get_connection()
+        db_back_conn = sqlite3.connect(backup_filename)
+        sqlitebck.copy(db_back_conn, db_conn)
         db_back_conn.close()
-        return backup_filename
+        # The backup may come from an older version
+        self._migrate(db_conn)
+        for changeset_filename in changeset_filenames:
+            LOG.info("applying db changeset '%s'", changeset_filename)
+            self.writer.submit(
+                self._apply_changeset,
+                changeset_filename,
+            ).result()
+        self.writer.submit(self._reset_backup_state).result()
+        self.account_cache.clear()
+
+    @staticmethod
+    def _apply_changeset(db_conn, changeset_filename):
+        """Applies the changeset backup file rows,
+        runs on the writer thread.
+        """
+        table_keys = dict(migrations.CHANGE_TRACKED_TABLES)
+        table_columns = {
+            table: set(
+                column["name"] for column in
+                db_conn.execute("pragma table_info(%s)" % table)
+            )
+            for table in table_keys
+        }
+        with open(changeset_filename, "r") as changeset_file:
+            header = json.loads(changeset_file.readline())
+            if header.get("changeset") != CHANGESET_FORMAT:
+                raise Exception(
+                    "invalid changeset file '%s'" % changeset_filename,
+                )
+            for line in changeset_file:
+                change = json.loads(line)
+                table = change["table"]
+                if table not in table_keys:
+                    raise Exception("invalid changeset table '%s'" % table)
+                values = change["row"]
+                if values is None:
+                    db_conn.execute(
+                        "delete from %s where %s = ?" % (
+                            table,
+                            table_keys[table],
+                        ),
+                        (change["key"],),
+                    )
+                    continue
+                columns = sorted(values)
+                if not table_columns[table].issuperset(columns):
+                    raise Exception(
+                        "invalid changeset columns for '%s'" % table,
+                    )
+                db_conn.execute(
+                    "insert or replace into %s (%s) values (%s)" % (
+                        table,
+                        ", ".join(columns),
+                        ", ".join("?" * len(columns)),
+                    ),
+                    [values[column] for column in columns],
+                )
+        return True
+
+    @staticmethod
+    def _reset_backup_state(db_conn):
+        """Clears the tracked changes, the account change log
+        and the sync state after a restore, runs on the writer thread.
+        """
+        db_conn.execute("delete from backup_change")
+        db_conn.execute("delete from account_change")
+        db_conn.execute("delete from sync_state")
+        return True
+
+    @query_stats.timed("export_db")
+    def export_db(self, export_filename):
+        """Exports the local DB accounts to the 'export_filename' file.
+        The file has a JSON header line, followed by a JSON line per
+        account with its ldap_account and semaphor_account values.
+        Accounts are read from a single read transaction and written
+        DELTA_FETCH_SIZE rows at a time.
+        Returns the number of exported accounts.
+        """
+        db_conn = self._connect()
+        db_conn.isolation_level = None
+        db_conn.execute("begin")
+        try:
+            cur = db_conn.execute(
+                """select la.id as id, la.uniqueid as uniqueid,
+                la.email as email, la.enabled as enabled,
+                sa.semaphor_guid as semaphor_guid,
+                sa.password as password, sa.L2 as L2,
+                sa.lock_state as lock_state
+                from ldap_account la
+                left join semaphor_account sa on sa.ldap_account = la.id
+                order by la.id
+                """,
+            )
+            accounts = 0
+            with open(export_filename, "w") as export_file:
+                export_file.write(json.dumps({
+                    "export": EXPORT_FORMAT,
+                    "schema_version": migrations.schema_version(db_conn),
+                }, sort_keys=True) + "\n")
+                columns = [column[0] for column in cur.description]
+                for row in iter_rows(cur):
+                    # Keys are not sorted, it is much slower on python 2
+                    export_file.write(
+                        json.dumps(dict(zip(columns, row))) + "\n",
+                    )
+                    accounts += 1
+        finally:
+            db_conn.execute("commit")
+            db_conn.close()
+        LOG.info("%d accounts exported to '%s'", accounts, export_filename)
+        return accounts
+
+    def import_db(self, import_filename, chunk_size=IMPORT_CHUNK_SIZE):
+        """Imports the accounts of the 'import_filename' file
+        (see 'export_db') into the local DB, which must have no accounts.
+        Accounts are inserted 'chunk_size' at a time in a single
+        transaction, so a failed import leaves the DB unchanged.
+        Returns the number of imported accounts.
+        """
+        with open(import_filename, "r") as import_file:
+            header = json.loads(import_file.readline() or "null")
+            if not isinstance(header, dict) or \
+                    header.get("export") != EXPORT_FORMAT:
+                raise Exception(
+                    "'%s' is not a local DB export file" % import_filename,
+                )
+            accounts = self.writer.submit(
+                self._import_accounts,
+                iter_jsonl(import_file),
+                chunk_size,
+            ).result()
+        self.account_cache.clear()
+        LOG.info("%d accounts imported from '%s'", accounts, import_filename)
+        return accounts
+
+    @staticmethod
+    def _import_accounts(db_conn, accounts, chunk_size):
+        """Writes the given accounts, runs on the writer thread.
+        The LDAP snapshot is seeded from the imported accounts and the
+        sync state is cleared, so the next ldap-sync runs a full delta.
+        Returns the number of imported accounts.
+        """
+        if db_conn.execute(
+                "select exists(select 1 from ldap_account)").fetchone()[0]:
+            raise Exception("the local DB already has accounts")
+        db_conn.execute("delete from ldap_snapshot")
+        db_conn.execute("delete from sync_state")
+        db_conn.execute("delete from account_change")
+        # The imported rows are recorded for the incremental backups
+        # with a single insert per table after the import, instead
+        # of one by one from the change tracking triggers.
+        # Imported accounts are not logged as account changes,
+        # consumers of the log start over with the cleared sync state.
+        for table, _ in migrations.CHANGE_TRACKED_TABLES:
+            for event, _ in migrations.CHANGE_TRACKED_EVENTS:
+                db_conn.execute(
+                    "drop trigger %s" %
+                    migrations.change_tracking_trigger_name(table, event),
+                )
+        for change in migrations.ACCOUNT_CHANGES:
+            db_conn.execute(
+                "drop trigger %s" %
+                migrations.account_change_trigger_name(change[0]),
+            )
+        imported = 0
+        for chunk in storage.iter_chunks(accounts, chunk_size):
+            db_conn.executemany(
+                """insert into ldap_account (id, uniqueid, email, enabled)
+                values (?, ?, ?, ?)
+                """,
+                [
+                    (
+                        account["id"], account["uniqueid"],
+                        account["email"], account["enabled"],
+                    )
+                    for account in chunk
+                ],
+            )
+            db_conn.executemany(
+                """insert into semaphor_account
+                (ldap_account, semaphor_guid, password, L2, lock_state)
+                values (?, ?, ?, ?, ?)
+                """,
+                [
+                    (
+                        account["id"], account["semaphor_guid"],
+                        account["password"], account["L2"],
+                        account["lock_state"],
+                    )
+                    for account in chunk
+                    if account["lock_state"] is not None
+                ],
+            )
+            imported += len(chunk)
+        db_conn.execute(
+            """insert into ldap_snapshot
+            (uniqueid, email, enabled, content_hash, present, dirty)
+            select uniqueid, email, enabled, null, 1, 0
+            from ldap_account
+            """,
+        )
+        for table, key in migrations.CHANGE_TRACKED_TABLES:
+            db_conn.execute(
+                """insert or replace into backup_change (tbl, row_key)
+                select '%s', %s from %s order by rowid
+                """ % (table, key, table),
+            )
+            for trigger_sql in \
+                    migrations.change_tracking_trigger_statements(table, key):
+                db_conn.execute(trigger_sql)
+        for trigger_sql in migrations.account_change_trigger_statements():
+            db_conn.execute(trigger_sql)
+        return imported
+
+    def run_maintenance(self,
+                        vacuum_pages=MAINTENANCE_VACUUM_PAGES,
+                        step_sleep=MAINTENANCE_STEP_SLEEP,
+                        max_time=MAINTENANCE_MAX_TIME):
+        """Refreshes the query planner statistics, prunes the account
+        changes older than ACCOUNT_CHANGE_RETENTION and reclaims
+        the free pages of the DB in steps of 'vacuum_pages' pages.
+        Steps run on the writer thread only while it is idle, sleeping
+        'step_sleep' seconds between steps, for up to 'max_time'
+        seconds (the remaining pages are reclaimed on the next run).
+        Returns the number of reclaimed pages.
+        """
+        start_time = time.time()
+        self.stats_lock.acquire()
+        self.maintenance_stats = {
+            "freed_pages": 0,
+            "start_time": start_time,
+            "end_time": None,
+        }
+        self.stats_lock.release()
+        freed_pages = 0
+        try:
+            self.writer.submit(self._analyze).result()
+            self.writer.submit(
+                self._prune_account_changes,
+                start_time - ACCOUNT_CHANGE_RETENTION,
+            ).result()
+            while time.time() - start_time < max_time:
+                if self.writer.is_idle():
+                    pages = self.writer.submit(
+                        self._incremental_vacuum,
+                        vacuum_pages,
+                    ).result()
+                    if not pages:
+                        break
+                    freed_pages += pages
+                    self.stats_lock.acquire()
+                    self.maintenance_stats["freed_pages"] = freed_pages
+                    self.stats_lock.release()
+                time.sleep(step_sleep)
+        finally:
+            self.stats_lock.acquire()
+            self.maintenance_stats["end_time"] = time.time()
+            self.stats_lock.release()
+        LOG.info(
+            "db maintenance done, %d pages reclaimed in %.2fs",
+            freed_pages,
+            time.time() - start_time,
+        )
+        return freed_pages
+
+    def _enable_incremental_vacuum(self):
+        """Switches the DB to incremental auto vacuum.
+        It requires a full VACUUM, so it is done once,
+        only for DBs created before incremental auto vacuum.
+        """
+        LOG.info("enabling incremental auto vacuum on the db")
+        db_conn = self._connect()
+        db_conn.isolation_level = None
+        try:
+            db_conn.execute("vacuum")
+        finally:
+            db_conn.close()
+
+    @staticmethod
+    def _analyze(db_conn):
+        """Refreshes the query planner statistics,
+        runs on the writer thread.
+        """
+        db_conn.execute("pragma analysis_limit = %d" % ANALYSIS_LIMIT)
+        db_conn.execute("analyze")
+        return True
+
+    @staticmethod
+    def _incremental_vacuum(db_conn, vacuum_pages):
+        """Reclaims up to 'vacuum_pages' free pages, runs on the
+        writer thread. Returns the number of reclaimed pages.
+        """
+        free_pages = db_conn.execute("pragma freelist_count").fetchone()[0]
+        if not free_pages:
+            return 0
+        # A page is reclaimed on each step of the statement
+        db_conn.execute(
+            "pragma incremental_vacuum(%d)" % vacuum_pages,
+        ).fetchall()
+        return free_pages - \
+            db_conn.execute("pragma freelist_count").fetchone()[0]
+
+    def get_maintenance_stats(self):
+        """Returns a dict with the DB 'size' (bytes), 'free_pages',
+        and the 'freed_pages', 'running' and 'elapsed' seconds
+        of the current (or last) maintenance run ('elapsed' is
+        None if maintenance was not run).
+        """
+        db_conn = self._get_connection()
+        page_size = db_conn.execute("pragma page_size").fetchone()[0]
+        page_count = db_conn.execute("pragma page_count").fetchone()[0]
+        free_pages = db_conn.execute("pragma freelist_count").fetchone()[0]
+        self.stats_lock.acquire()
+        maintenance_stats = dict(self.maintenance_stats)
+        self.stats_lock.release()
+        start_time = maintenance_stats.pop("start_time")
+        end_time = maintenance_stats.pop("end_time")
+        maintenance_stats["size"] = page_size * page_count
+        maintenance_stats["free_pages"] = free_pages
+        maintenance_stats["running"] = \
+            start_time is not None and end_time is None
+        maintenance_stats["elapsed"] = None
+        if start_time is not None:
+            maintenance_stats["elapsed"] = \
+                (end_time or time.time()) - start_time
+        return maintenance_stats
+
+    def check_maintenance(self):
+        """Health check for the DB maintenance.
+        Returns a string with the result.
+        """
+        try:
+            stats = self.get_maintenance_stats()
+        except Exception as exception:
+            return "ERROR: %s" % str(exception)
+        maintenance_state = "size=%.1f KB, free pages=%d" % (
+            stats["size"] / 1024.0,
+            stats["free_pages"],
+        )
+        if stats["elapsed"] is not None:
+            maintenance_state += ", %s, pages reclaimed=%d in %.2fs" % (
+                "running" if stats["running"] else "done",
+                stats["freed_pages"],
+                stats["elapsed"],
+            )
+        return maintenance_state
 
     def check_db(self):
         """Health check for DB. Returns a string with the result."""
@@ -401,5 +1527,9 @@ class LocalDB(object):
         except Exception as exception:
             db_state = "ERROR: %s" % str(exception)
         else:
-            db_state = "OK"
+            db_stats = self.get_connection_stats()
+            db_stats.update(self.writer.get_write_stats())
+            db_state = "OK, connections opened=%(opened)d, " \
+                "reused=%(reused)d, writes=%(writes)d, " \
+                "commits=%(commits)d" % db_stats
         return db_state
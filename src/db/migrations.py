@@ -0,0 +1,283 @@
+"""
+migrations.py
+
+Versioned schema migrations for the semaphor-ldap local DB.
+"""
+
+import logging
+
+
+LOG = logging.getLogger("migrations")
+
+
+# Tables (and their key column) with row changes tracked on the
+# 'backup_change' table, used for incremental backups.
+# 'sync_state' is not tracked, it is reset when a backup is restored.
+CHANGE_TRACKED_TABLES = (
+    ("ldap_account", "id"),
+    ("semaphor_account", "ldap_account"),
+    ("ldap_snapshot", "uniqueid"),
+)
+
+
+# Row events recorded by the change tracking triggers, with
+# the row versions whose key is recorded.
+CHANGE_TRACKED_EVENTS = (
+    ("insert", ("new",)),
+    ("update", ("old", "new")),
+    ("delete", ("old",)),
+)
+
+
+def change_tracking_trigger_name(table, event):
+    """Returns the name of the change tracking trigger
+    of 'table' for the given row 'event'.
+    """
+    return "tr_%s_%s_change" % (table, event)
+
+
+def change_tracking_trigger_statements(table, key):
+    """Returns the list of SQL statements that create the triggers that
+    record the changed rows of 'table' (by 'key') on 'backup_change'.
+    Each changed row is recorded once, with the sequence
+    number of its last change (the unique (tbl, row_key)
+    conflict replaces the previous record).
+    """
+    record_sql = """
+        insert or replace into backup_change (tbl, row_key)
+        values ('%(table)s', %(row)s.%(key)s);
+    """
+    return [
+        """
+    create trigger %(name)s
+    after %(event)s on %(table)s
+    begin%(body)s
+    end;
+    """ % {
+            "name": change_tracking_trigger_name(table, event),
+            "table": table,
+            "event": event,
+            "body": "".join(
+                record_sql % {"table": table, "key": key, "row": row}
+                for row in rows
+            ),
+        }
+        for event, rows in CHANGE_TRACKED_EVENTS
+    ]
+
+
+def change_tracking_triggers(table, key):
+    """Returns the SQL script to create the change
+    tracking triggers of 'table' (by 'key').
+    """
+    return "".join(change_tracking_trigger_statements(table, key))
+
+
+# Account state transitions recorded on the append-only 'account_change'
+# log: (change, table, trigger event, condition, changed account id).
+ACCOUNT_CHANGES = (
+    ("created", "semaphor_account", "insert", None, "new.ldap_account"),
+    # lock_state 0 = unlocked
+    ("unlocked", "semaphor_account", "update of lock_state",
+     "old.lock_state != 0 and new.lock_state = 0", "new.ldap_account"),
+    ("relinked", "semaphor_account", "update of semaphor_guid",
+     "new.semaphor_guid is not null and "
+     "old.semaphor_guid is not new.semaphor_guid", "new.ldap_account"),
+    ("reenabled", "ldap_account", "update of enabled",
+     "not old.enabled and new.enabled", "new.id"),
+)
+
+
+def account_change_trigger_name(change):
+    """Returns the name of the trigger that logs the given account change."""
+    return "tr_account_%s" % change
+
+
+def account_change_trigger_statements():
+    """Returns the list of SQL statements that create the triggers
+    that log the account state transitions on 'account_change'.
+    """
+    return [
+        """
+    create trigger %(name)s
+    after %(event)s on %(table)s%(when)s
+    begin
+        insert into account_change (ldap_account, change)
+        values (%(account)s, '%(change)s');
+    end;
+    """ % {
+            "name": account_change_trigger_name(change),
+            "event": event,
+            "table": table,
+            "when": "\n    when %s" % condition if condition else "",
+            "account": account,
+            "change": change,
+        }
+        for change, table, event, condition, account in ACCOUNT_CHANGES
+    ]
+
+
+# Migration number N upgrades the DB from schema version N-1 to N.
+# The schema version is stored in the DB 'user_version' pragma.
+# Version 0 is the base schema file (schema/dma.sql).
+MIGRATIONS = [
+    # 1: Real primary key on semaphor_account.
+    # 'ldap_account' becomes the rowid, which turns the
+    # ldap_account -> semaphor_account joins into rowid lookups.
+    """
+    create table semaphor_account_new (
+        ldap_account integer not null primary key,
+        semaphor_guid varchar(52),
+        password varchar(32),
+        L2 varchar(44),
+        lock_state integer not null,
+
+        unique(semaphor_guid) on conflict replace,
+        constraint fk_ldap_account foreign key(ldap_account)
+            references ldap_account(id),
+        constraint state_values check (lock_state >= 0 and lock_state <= 2)
+    );
+    insert or replace into semaphor_account_new
+    (ldap_account, semaphor_guid, password, L2, lock_state)
+    select ldap_account, semaphor_guid, password, L2, lock_state
+    from semaphor_account
+    where ldap_account is not null
+    order by rowid;
+    drop table semaphor_account;
+    alter table semaphor_account_new rename to semaphor_account;
+    """,
+    # 2: Covering indexes for the delta and ldaped accounts queries.
+    """
+    create index ix_semaphor_account_lock_state
+    on semaphor_account(lock_state, semaphor_guid);
+    create index ix_ldap_account_enabled
+    on ldap_account(enabled, uniqueid, email);
+    """,
+    # 3: Persistent snapshot of the LDAP group, seeded from ldap_account
+    # so accounts missing from the first synced group are detected.
+    """
+    create table ldap_snapshot (
+        /* LDAP account unique identifier */
+        uniqueid varchar(128) not null primary key,
+        /* LDAP email/username */
+        email varchar(255) not null collate nocase,
+        /* LDAP state, entries removed from the group are disabled */
+        enabled boolean not null,
+        /* hash of the LDAP entry content, null if not synced yet */
+        content_hash varchar(40),
+        /* whether the entry is present on the LDAP group */
+        present boolean not null default 1,
+        /* entry changed and is not yet reconciled with ldap_account */
+        dirty boolean not null default 1
+    );
+    create index ix_ldap_snapshot_dirty on ldap_snapshot(dirty);
+    insert into ldap_snapshot
+    (uniqueid, email, enabled, content_hash, present, dirty)
+    select uniqueid, email, enabled, null, 1, 0
+    from ldap_account;
+    """,
+    # 4: Key/value state of the ldap-sync runs.
+    """
+    create table sync_state (
+        key varchar(64) not null primary key,
+        value text
+    );
+    """,
+    # 5: Index for the set-based uniqueid update (match by email).
+    """
+    create index ix_ldap_snapshot_email on ldap_snapshot(email);
+    """,
+    # 6: Index for the keyset paginated userlist filtered by LDAP state.
+    """
+    create index ix_ldap_account_enabled_email
+    on ldap_account(enabled, email);
+    """,
+    # 7: Row change tracking for incremental backups.
+    """
+    create table backup_change (
+        seq integer not null primary key autoincrement,
+        tbl varchar(64) not null,
+        row_key not null,
+        unique(tbl, row_key)
+    );
+    """ + "".join(
+        change_tracking_triggers(table, key)
+        for table, key in CHANGE_TRACKED_TABLES
+    ),
+    # 8: Change tracking triggers record a change with a single
+    # 'insert or replace', a delete followed by an insert made
+    # every insert slower as backup_change grew.
+    "".join(
+        "drop trigger %s;\n" % change_tracking_trigger_name(table, event)
+        for table, _ in CHANGE_TRACKED_TABLES
+        for event, _ in CHANGE_TRACKED_EVENTS
+    ) + "".join(
+        change_tracking_triggers(table, key)
+        for table, key in CHANGE_TRACKED_TABLES
+    ),
+    # 9: Append-only log of account state transitions, consumers
+    # keep the last 'seq' they processed to read only new changes.
+    """
+    create table account_change (
+        seq integer not null primary key autoincrement,
+        /* references ldap_account.id */
+        ldap_account integer not null,
+        /* created, unlocked, relinked or reenabled */
+        change varchar(16) not null,
+        /* unix time of the change */
+        time integer not null default (strftime('%s', 'now'))
+    );
+    create index ix_account_change_time on account_change(time);
+    """ + "".join(account_change_trigger_statements()),
+    # 10: Only the dirty snapshot entries are indexed, the planner
+    # skipped the full index once the statistics showed that most
+    # entries are clean (queries test 'dirty = 1').
+    """
+    drop index ix_ldap_snapshot_dirty;
+    create index ix_ldap_snapshot_dirty
+    on ldap_snapshot(dirty) where dirty = 1;
+    """,
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def schema_version(db_conn):
+    """Returns the schema version of the given DB connection."""
+    return db_conn.execute("pragma user_version").fetchone()[0]
+
+
+def migrate(db_conn, schema_file_name):
+    """Brings the DB schema up to date.
+    If the DB is new (or it predates migrations) it first creates the
+    base schema from 'schema_file_name', then it applies the pending
+    migrations in order, each one in its own transaction.
+    It does nothing if the DB is already on the current version.
+    """
+    version = schema_version(db_conn)
+    if version == SCHEMA_VERSION:
+        LOG.info("db schema up to date (version %d)", version)
+        return
+    if version > SCHEMA_VERSION:
+        raise Exception(
+            "db schema version %d is newer than supported version %d" % (
+                version,
+                SCHEMA_VERSION,
+            ),
+        )
+    if version == 0:
+        LOG.info("creating db base schema")
+        with open(schema_file_name, "r") as schema_file:
+            db_conn.executescript(schema_file.read())
+    for number in range(version + 1, SCHEMA_VERSION + 1):
+        LOG.info("applying db migration %d", number)
+        try:
+            db_conn.executescript(
+                "begin;\n%s\npragma user_version = %d;\ncommit;" % (
+                    MIGRATIONS[number - 1],
+                    number,
+                ),
+            )
+        except Exception:
+            db_conn.rollback()
+            raise
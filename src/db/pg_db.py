@@ -0,0 +1,985 @@
+"""
+pg_db.py
+
+semaphor-ldap local DB on a PostgreSQL server,
+the pooled PostgreSQL storage engine.
+"""
+
+import json
+import logging
+import threading
+import time
+
+try:
+    import psycopg2
+    import psycopg2.extras
+    import psycopg2.pool
+except ImportError:
+    # Only needed by the PostgreSQL storage engine
+    psycopg2 = None
+
+from flow import Flow
+
+from src.db import account_cache, local_db, query_stats, storage
+
+
+LOG = logging.getLogger("pg_db")
+
+
+SCHEMA_VERSION = 1
+DEFAULT_POOL_SIZE = 8
+MIN_POOL_SIZE = 1
+# Smallest 'pool_size': a sync holds a connection while it reads a
+# delta and writes its actions on another one, the rest is headroom
+# for the HTTP API and bind request threads
+MIN_POOL_SLOTS = 4
+# Seconds to wait for a pooled connection
+POOL_WAIT_TIMEOUT = 30
+# Tables of the local DB
+TABLES = (
+    "ldap_account", "semaphor_account", "ldap_snapshot",
+    "sync_state", "account_change",
+)
+# Columns of the exported accounts (see local_db.LocalDB.export_db)
+EXPORT_COLUMNS = (
+    "id", "uniqueid", "email", "enabled",
+    "semaphor_guid", "password", "L2", "lock_state",
+)
+
+
+def execute_values(cur, sql, rows, chunk_size=local_db.IMPORT_CHUNK_SIZE):
+    """Executes 'sql', a statement with a '%s' placeholder for a
+    values list, for each chunk of up to 'chunk_size' of the given rows
+    (one round trip per chunk, instead of one per row of 'executemany').
+    """
+    for chunk in storage.iter_chunks(rows, chunk_size):
+        template = "(%s)" % ", ".join(["%s"] * len(chunk[0]))
+        cur.execute(sql % ", ".join(
+            cur.mogrify(template, row) for row in chunk
+        ))
+
+
+class PooledWriter(object):
+    """Writer of the PostgreSQL local DB, with the 'submit' interface
+    of local_db.DBWriter. Each write runs on the calling thread,
+    in its own transaction on a pooled connection, so writes
+    from different threads run concurrently.
+    """
+
+    def __init__(self, pg_db):
+        self.pg_db = pg_db
+        self.keep_running = threading.Event()
+        self.keep_running.set()
+        self.stats_lock = threading.Lock()
+        self.write_stats = {
+            "writes": 0,
+            "commits": 0,
+        }
+
+    def submit(self, write_func, *args):
+        """Runs write_func(db_conn, *args) and commits it.
+        Returns a done 'WriteFuture' with its result.
+        """
+        future = local_db.WriteFuture()
+        if not self.keep_running.is_set():
+            future.set_error(psycopg2.InterfaceError("DB writer stopped"))
+            return future
+        stats = self.pg_db.query_stats
+        value = None
+        error = None
+        db_conn = self.pg_db.getconn()
+        try:
+            start_time = time.time()
+            try:
+                value = write_func(db_conn, *args)
+            finally:
+                # Writes are named after their function, e.g. 'update_lock'
+                stats.record(
+                    write_func.__name__.lstrip("_"),
+                    time.time() - start_time,
+                )
+            start_time = time.time()
+            db_conn.commit()
+            stats.record("commit", time.time() - start_time)
+        except Exception as exception:
+            error = exception
+            if not db_conn.closed:
+                db_conn.rollback()
+        finally:
+            self.pg_db.putconn(db_conn)
+        self.stats_lock.acquire()
+        self.write_stats["writes"] += 1
+        if not error:
+            self.write_stats["commits"] += 1
+        self.stats_lock.release()
+        if error:
+            future.set_error(error)
+        else:
+            future.set_result(value)
+        return future
+
+    def stop(self):
+        """Fails the writes submitted from now on."""
+        self.keep_running.clear()
+
+    def is_idle(self):
+        """Writes are not queued, the writer is always idle."""
+        return True
+
+    def get_write_stats(self):
+        """Returns a dict with the number of 'writes' and 'commits'."""
+        self.stats_lock.acquire()
+        write_stats = dict(self.write_stats)
+        self.stats_lock.release()
+        return write_stats
+
+
+class PostgreSQLDB(storage.Storage):
+    """semaphor-ldap local DB operations on the PostgreSQL server
+    of the 'dsn' connection string, with up to 'pool_size'
+    pooled connections, the PostgreSQL storage engine.
+    """
+
+    engine = storage.ENGINE_POSTGRESQL
+
+    def __init__(self,
+                 schema_file_name,
+                 dsn,
+                 pool_size=DEFAULT_POOL_SIZE,
+                 account_cache_size=account_cache.DEFAULT_CACHE_SIZE,
+                 slow_query_ms=0):
+        if psycopg2 is None:
+            raise Exception(
+                "the postgresql db engine requires the psycopg2 package",
+            )
+        super(PostgreSQLDB, self).__init__(account_cache_size, slow_query_ms)
+        self.schema_file_name = schema_file_name
+        if pool_size < MIN_POOL_SLOTS:
+            LOG.warning(
+                "db pool size %d is too small, using %d",
+                pool_size,
+                MIN_POOL_SLOTS,
+            )
+            pool_size = MIN_POOL_SLOTS
+        self.pool_size = pool_size
+        # psycopg2 pools fail (instead of waiting)
+        # when all their connections are in use
+        self.pool_cond = threading.Condition()
+        self.free_slots = pool_size
+        self.pool = psycopg2.pool.ThreadedConnectionPool(
+            MIN_POOL_SIZE,
+            pool_size,
+            dsn,
+        )
+        self.stats_lock = threading.Lock()
+        self.conn_stats = {
+            "in_use": 0,
+        }
+        self.maintenance_stats = {
+            "pruned": 0,
+            "start_time": None,
+            "end_time": None,
+        }
+        LOG.info("using postgresql database (pool size %d)", pool_size)
+        self.migrate()
+        self.writer = PooledWriter(self)
+
+    def getconn(self, timeout=POOL_WAIT_TIMEOUT):
+        """Returns a pooled connection, it waits up to 'timeout'
+        seconds while all the pool connections are in use.
+        """
+        self.pool_cond.acquire()
+        try:
+            deadline = time.time() + timeout
+            while not self.free_slots:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise psycopg2.pool.PoolError(
+                        "all db connections are in use",
+                    )
+                self.pool_cond.wait(remaining)
+            self.free_slots -= 1
+        finally:
+            self.pool_cond.release()
+        try:
+            db_conn = self.pool.getconn()
+        except Exception:
+            self.release_slot()
+            raise
+        self.stats_lock.acquire()
+        self.conn_stats["in_use"] += 1
+        self.stats_lock.release()
+        return db_conn
+
+    def putconn(self, db_conn):
+        """Returns the connection to the pool, which rolls back
+        its open transaction (broken connections are discarded).
+        """
+        try:
+            self.pool.putconn(db_conn, close=bool(db_conn.closed))
+        finally:
+            self.stats_lock.acquire()
+            self.conn_stats["in_use"] -= 1
+            self.stats_lock.release()
+            self.release_slot()
+
+    def release_slot(self):
+        """Frees a pool slot, waking up a waiting thread."""
+        self.pool_cond.acquire()
+        self.free_slots += 1
+        self.pool_cond.notify()
+        self.pool_cond.release()
+
+    def migrate(self):
+        """Creates the DB schema from 'schema_file_name' if the DB
+        is new, otherwise it checks the DB schema version.
+        """
+        db_conn = self.getconn()
+        try:
+            cur = db_conn.cursor()
+            cur.execute("select to_regclass('schema_info')")
+            if cur.fetchone()[0] is None:
+                LOG.info("creating db schema")
+                with open(self.schema_file_name, "r") as schema_file:
+                    cur.execute(schema_file.read())
+                db_conn.commit()
+                return
+            cur.execute("select version from schema_info")
+            version = cur.fetchone()[0]
+            if version != SCHEMA_VERSION:
+                raise Exception(
+                    "db schema version %d is not the supported "
+                    "version %d" % (version, SCHEMA_VERSION),
+                )
+            LOG.info("db schema up to date (version %d)", version)
+        finally:
+            self.putconn(db_conn)
+
+    def close(self):
+        """Stops the writer and closes the pool connections."""
+        self.writer.stop()
+        self.pool.closeall()
+
+    def _fetchall(self, sql, params=(), cursor_factory=None):
+        """Runs the 'sql' query and returns all its rows."""
+        db_conn = self.getconn()
+        try:
+            cur = db_conn.cursor(cursor_factory=cursor_factory)
+            cur.execute(sql, params)
+            rows = cur.fetchall()
+            cur.close()
+            return rows
+        finally:
+            self.putconn(db_conn)
+
+    def _iter_rows(self, name, sql, params=(), cursor_factory=None):
+        """Yields the rows of the 'sql' query, read DELTA_FETCH_SIZE
+        rows at a time from a server side cursor. The query runs when
+        the first row is read, and its time is recorded as 'name'.
+        The pooled connection is in use until all rows are read
+        (or the iterator is closed).
+        """
+        db_conn = self.getconn()
+        try:
+            cur = db_conn.cursor("rows", cursor_factory=cursor_factory)
+            start_time = time.time()
+            cur.execute(sql, params)
+            self.query_stats.record(name, time.time() - start_time)
+            for row in local_db.iter_rows(cur):
+                yield row
+        finally:
+            self.putconn(db_conn)
+
+    def entries_to_setup(self):
+        """Row iterator of the accounts to setup,
+        see local_db.LocalDB.entries_to_setup.
+        """
+        return self._iter_rows(
+            "entries_to_setup",
+            """select ls.uniqueid, ls.email, ls.enabled
+            from ldap_snapshot ls
+            where ls.dirty = 1 and ls.enabled = 1 and
+            not exists(select 1 from ldap_account
+                       where uniqueid = ls.uniqueid) and
+            not exists(select 1 from ldap_account
+                       where lower(email) = lower(ls.email))
+            order by ls.uniqueid
+            """,
+            cursor_factory=psycopg2.extras.RealDictCursor,
+        )
+
+    def entries_to_retry_setup(self):
+        """Row iterator of the 'ldap lock'ed accounts to setup again,
+        see local_db.LocalDB.entries_to_retry_setup.
+        """
+        return self._iter_rows(
+            "entries_to_retry_setup",
+            """select ls.uniqueid, ls.email, ls.enabled
+            from semaphor_account sa
+            join ldap_account la on la.id = sa.ldap_account
+            join ldap_snapshot ls on ls.uniqueid = la.uniqueid
+            where sa.lock_state = %s and ls.enabled = 1
+            order by ls.uniqueid
+            """,
+            (Flow.LDAP_LOCK,),
+            cursor_factory=psycopg2.extras.RealDictCursor,
+        )
+
+    def entries_to_update_lock(self):
+        """Row iterator of the accounts to lock or unlock,
+        see local_db.LocalDB.entries_to_update_lock.
+        """
+        return self._iter_rows(
+            "entries_to_update_lock",
+            """select ls.uniqueid as uniqueid, ls.email as email,
+            ls.enabled as enabled, sa.lock_state as lock_state
+            from ldap_snapshot ls
+            join ldap_account la on la.uniqueid = ls.uniqueid
+            left join semaphor_account sa on sa.ldap_account = la.id
+            where ls.dirty = 1 and ls.enabled != la.enabled
+            order by ls.uniqueid
+            """,
+            cursor_factory=psycopg2.extras.RealDictCursor,
+        )
+
+    @staticmethod
+    def update_uids(db_conn):
+        """Updates the 'uniqueid's of the accounts that don't match
+        the LDAP snapshot, see local_db.LocalDB.update_uids.
+        Returns the number of updated accounts.
+        """
+        cur = db_conn.cursor()
+        cur.execute(
+            """update ldap_account la
+            set uniqueid = ls.uniqueid
+            from ldap_snapshot ls
+            where lower(ls.email) = lower(la.email) and
+            ls.dirty = 1 and ls.present = 1 and
+            ls.uniqueid != la.uniqueid
+            """,
+        )
+        updated_uids = cur.rowcount
+        cur.close()
+        return updated_uids
+
+    def _snapshot_page_hashes(self, uniqueids):
+        """Returns a dict with the content hash of the present
+        LDAP snapshot entries of the given uniqueids.
+        """
+        if not uniqueids:
+            return {}
+        return dict(self._fetchall(
+            "select uniqueid, content_hash from ldap_snapshot "
+            "where present = 1 and uniqueid = any(%s)",
+            (uniqueids,),
+        ))
+
+    @staticmethod
+    def _begin_snapshot(db_conn):
+        """Starts an LDAP snapshot update,
+        see local_db.LocalDB._begin_snapshot.
+        The uniqueids read from LDAP are collected on the (unlogged)
+        'ldap_snapshot_seen' table, writes run on any pool connection.
+        """
+        reconciled_cond = """
+            not exists(select 1 from ldap_account la
+                       where la.uniqueid = ldap_snapshot.uniqueid and
+                       la.enabled != ldap_snapshot.enabled) and
+            (ldap_snapshot.enabled = 0 or
+             exists(select 1 from ldap_account la
+                    where la.uniqueid = ldap_snapshot.uniqueid))
+        """
+        cur = db_conn.cursor()
+        cur.execute(
+            "delete from ldap_snapshot "
+            "where dirty = 1 and present = 0 and %s" % reconciled_cond,
+        )
+        cur.execute(
+            "update ldap_snapshot set dirty = 0 "
+            "where dirty = 1 and %s" % reconciled_cond,
+        )
+        cur.execute("truncate ldap_snapshot_seen")
+        cur.close()
+        return True
+
+    @staticmethod
+    def _write_snapshot_page(db_conn, changed_values, uniqueids):
+        """Writes a page of the LDAP snapshot update,
+        see local_db.LocalDB._write_snapshot_page.
+        """
+        cur = db_conn.cursor()
+        # The last values of a uniqueid win, as with 'insert or replace'
+        changed_rows = dict(
+            (values[0], tuple(values) + (1, 1)) for values in changed_values
+        )
+        execute_values(
+            cur,
+            """insert into ldap_snapshot
+            (uniqueid, email, enabled, content_hash, present, dirty)
+            values %s
+            on conflict (uniqueid) do update
+            set email = excluded.email, enabled = excluded.enabled,
+            content_hash = excluded.content_hash, present = 1, dirty = 1
+            """,
+            changed_rows.values(),
+        )
+        execute_values(
+            cur,
+            """insert into ldap_snapshot_seen (uniqueid) values %s
+            on conflict (uniqueid) do nothing
+            """,
+            [(uniqueid,) for uniqueid in uniqueids],
+        )
+        cur.close()
+        return True
+
+    @classmethod
+    def _end_snapshot(cls, db_conn):
+        """Finishes the LDAP snapshot update,
+        see local_db.LocalDB._end_snapshot.
+        Returns a tuple with the number of removed entries
+        and the number of accounts with an updated uniqueid.
+        """
+        cur = db_conn.cursor()
+        cur.execute(
+            """update ldap_snapshot
+            set enabled = 0, content_hash = null, present = 0, dirty = 1
+            where present = 1 and not exists(
+                select 1 from ldap_snapshot_seen lss
+                where lss.uniqueid = ldap_snapshot.uniqueid
+            )
+            """,
+        )
+        removed = cur.rowcount
+        cur.execute("truncate ldap_snapshot_seen")
+        cur.close()
+        return removed, cls.update_uids(db_conn)
+
+    @staticmethod
+    def _write_snapshot_entries(db_conn, changed_values, removed_uniqueids):
+        """Writes the given LDAP snapshot entries,
+        see local_db.LocalDB._write_snapshot_entries.
+        """
+        cur = db_conn.cursor()
+        changed_rows = dict(
+            (values[0], tuple(values) + (1, 1)) for values in changed_values
+        )
+        execute_values(
+            cur,
+            """insert into ldap_snapshot
+            (uniqueid, email, enabled, content_hash, present, dirty)
+            values %s
+            on conflict (uniqueid) do update
+            set email = excluded.email, enabled = excluded.enabled,
+            content_hash = excluded.content_hash, present = 1, dirty = 1
+            """,
+            changed_rows.values(),
+        )
+        removed = 0
+        if removed_uniqueids:
+            cur.execute(
+                """update ldap_snapshot
+                set enabled = 0, content_hash = null, present = 0, dirty = 1
+                where present = 1 and uniqueid = any(%s)
+                """,
+                (list(removed_uniqueids),),
+            )
+            removed = cur.rowcount
+        cur.close()
+        return removed
+
+    def delta_changes(self):
+        """Returns (not execute) the actions to run for our local DB
+        to match the LDAP snapshot, see 'delta'.
+        """
+        return {
+            "setup": self.entries_to_setup(),
+            "retry_setup": self.entries_to_retry_setup(),
+            "update_lock": self.entries_to_update_lock(),
+        }
+
+    def retry_delta(self):
+        """Returns (not execute) only the 'retry_setup' actions.
+        Used when the LDAP entries did not change since the last sync.
+        """
+        return {
+            "retry_setup": self.entries_to_retry_setup(),
+        }
+
+    @query_stats.timed("get_sync_state")
+    def get_sync_state(self, key):
+        """Returns the stored value for the given
+        sync state key, or None if not set.
+        """
+        rows = self._fetchall(
+            "select value from sync_state where key = %s",
+            (key,),
+        )
+        return rows[0][0] if rows else None
+
+    @staticmethod
+    def _set_sync_state(db_conn, key, value):
+        """Writes the sync state value."""
+        cur = db_conn.cursor()
+        cur.execute(
+            """insert into sync_state (key, value) values (%s, %s)
+            on conflict (key) do update set value = excluded.value
+            """,
+            (key, value),
+        )
+        cur.close()
+        return True
+
+    @staticmethod
+    def _create_account(db_conn, ldap_data, semaphor_data):
+        """Writes the account entries."""
+        cur = db_conn.cursor()
+        ldap_data_values = (
+            ldap_data["uniqueid"], ldap_data["email"],
+            1 if ldap_data["enabled"] else 0,
+        )
+        # Same as the 'on conflict replace' of the SQLite emails
+        cur.execute(
+            "delete from ldap_account where lower(email) = lower(%s)",
+            (ldap_data["email"],),
+        )
+        cur.execute(
+            """insert into ldap_account
+            (uniqueid, email, enabled)
+            values (%s, %s, %s)
+            returning id
+            """,
+            ldap_data_values,
+        )
+        ldap_account_id = cur.fetchone()[0]
+        if semaphor_data.get("id"):
+            # and of the SQLite semaphor guids
+            cur.execute(
+                "delete from semaphor_account where semaphor_guid = %s",
+                (semaphor_data["id"],),
+            )
+        cur.execute(
+            """insert into semaphor_account
+            (ldap_account, semaphor_guid, password, L2, lock_state)
+            values
+            (%s, %s, %s, %s, %s)
+            """, (
+                ldap_account_id,
+                semaphor_data.get("id"),
+                semaphor_data.get("password"),
+                semaphor_data.get("L2"),
+                semaphor_data.get("lock_state"),
+            ),
+        )
+        # Track the account on the LDAP snapshot (if not there yet)
+        cur.execute(
+            """insert into ldap_snapshot
+            (uniqueid, email, enabled, content_hash, present, dirty)
+            values (%s, %s, %s, null, 1, 0)
+            on conflict (uniqueid) do nothing
+            """,
+            ldap_data_values,
+        )
+        cur.close()
+        return True
+
+    @query_stats.timed("read_account")
+    def _read_account(self, username):
+        """Reads the account data of the given username from the DB."""
+        rows = self._fetchall(
+            """select la.id, la.uniqueid, la.email, la.enabled,
+            sa.semaphor_guid, sa.password, sa.L2 as "L2", sa.lock_state
+            from ldap_account la
+            left join semaphor_account sa on sa.ldap_account = la.id
+            where lower(la.email) = lower(%s)
+            """,
+            (username,),
+            psycopg2.extras.RealDictCursor,
+        )
+        return dict(rows[0]) if rows else None
+
+    @staticmethod
+    def _update_semaphor_account(db_conn, username, semaphor_data):
+        """Writes the 'semaphor_account' entry."""
+        cur = db_conn.cursor()
+        cur.execute(
+            "select id from ldap_account where lower(email) = lower(%s)",
+            (username,),
+        )
+        ldap_account_id = cur.fetchone()
+        if not ldap_account_id:
+            LOG.error(
+                "username '%s' not found on DB",
+                username,
+            )
+            return False
+        # Same as the 'on conflict replace' of the SQLite semaphor guids
+        cur.execute(
+            """delete from semaphor_account
+            where semaphor_guid = %s and ldap_account != %s
+            """,
+            (semaphor_data["id"], ldap_account_id[0]),
+        )
+        cur.execute(
+            """update semaphor_account
+            set semaphor_guid = %s, password = %s, L2 = %s, lock_state = %s
+            where ldap_account = %s
+            """, (
+                semaphor_data["id"],
+                semaphor_data["password"],
+                semaphor_data["L2"],
+                semaphor_data["lock_state"],
+                ldap_account_id[0],
+            ),
+        )
+        cur.close()
+        return True
+
+    @staticmethod
+    def _update_lock(db_conn, ldap_account):
+        """Writes the lock state update, see 'update_lock'.
+        Returns the local DB email of the account.
+        """
+        enabled = 1 if ldap_account["enabled"] else 0
+        semaphor_lock_state = \
+            Flow.UNLOCK if enabled else Flow.FULL_LOCK
+        cur = db_conn.cursor()
+        cur.execute(
+            "update ldap_account set enabled = %s where uniqueid = %s "
+            "returning id, email",
+            (enabled, ldap_account["uniqueid"]),
+        )
+        row = cur.fetchone()
+        if not row:
+            LOG.error(
+                "update_lock(%s): account does not exist.",
+                ldap_account["uniqueid"],
+            )
+            return False
+        # Update semaphor_account entry if not ldap-locked
+        if ldap_account["lock_state"] != Flow.LDAP_LOCK:
+            cur.execute(
+                """update semaphor_account
+                set lock_state = %s
+                where ldap_account = %s
+                """,
+                (semaphor_lock_state, row[0]),
+            )
+        cur.close()
+        return row[1]
+
+    def iter_db_accounts(self, limit=None, after=None,
+                         lock_state=None, enabled=None):
+        """Same as 'get_db_accounts', but it returns an iterator of row
+        tuples (with the storage.DB_ACCOUNT_COLUMNS values), read
+        DELTA_FETCH_SIZE rows at a time from a server side cursor.
+        """
+        conditions = []
+        params = []
+        if after is not None:
+            conditions.append("lower(la.email) > lower(%s)")
+            params.append(after)
+        if lock_state is not None:
+            conditions.append("sa.lock_state = %s")
+            params.append(lock_state)
+        if enabled is not None:
+            conditions.append("la.enabled = %s")
+            params.append(1 if enabled else 0)
+        query = "select %s\n" % ", ".join(storage.DB_ACCOUNT_COLUMNS)
+        query += """from ldap_account la
+            left join semaphor_account sa on la.id = sa.ldap_account
+            """
+        if conditions:
+            query += "where %s\n" % " and ".join(conditions)
+        query += "order by lower(la.email)\n"
+        if limit is not None:
+            query += "limit %s\n"
+            params.append(limit)
+        return self._iter_rows("get_db_accounts", query, params)
+
+    @query_stats.timed("get_enabled_ldaped_accounts")
+    def get_enabled_ldaped_accounts(self):
+        """Returns the semaphor account ids of the ldaped accounts,
+        that is, the accounts under the control of the bot.
+        """
+        return [
+            row[0] for row in self._fetchall(
+                """select semaphor_guid
+                from semaphor_account sa
+                join ldap_account la on la.id = sa.ldap_account
+                where sa.lock_state = %s and la.enabled = 1
+                """,
+                (Flow.UNLOCK,),
+            )
+        ]
+
+    def get_account_change_seq(self):
+        """Returns the sequence number of the last logged
+        account change (0 if no change was logged yet).
+        """
+        last_value, is_called = self._fetchall(
+            "select last_value, is_called from account_change_seq_seq",
+        )[0]
+        return last_value if is_called else 0
+
+    @query_stats.timed("get_account_changes")
+    def get_account_changes(self, since_seq):
+        """Returns the account changes logged after the 'since_seq'
+        sequence number, see local_db.LocalDB.get_account_changes.
+        Returns None if changes after 'since_seq' were already pruned.
+        """
+        first_seq = self._fetchall(
+            "select min(seq) from account_change",
+        )[0][0]
+        if first_seq is None:
+            first_seq = self.get_account_change_seq() + 1
+        if since_seq + 1 < first_seq:
+            return None
+        return [
+            dict(row) for row in self._fetchall(
+                """select ac.seq, ac.change, la.email, la.enabled,
+                sa.semaphor_guid, sa.lock_state
+                from account_change ac
+                join ldap_account la on la.id = ac.ldap_account
+                left join semaphor_account sa on sa.ldap_account = la.id
+                where ac.seq > %s
+                order by ac.seq
+                """,
+                (since_seq,),
+                psycopg2.extras.RealDictCursor,
+            )
+        ]
+
+    @staticmethod
+    def _prune_account_changes(db_conn, before_time):
+        """Removes the account changes logged before 'before_time'.
+        Returns the number of removed changes.
+        """
+        cur = db_conn.cursor()
+        cur.execute(
+            "delete from account_change where time < %s",
+            (int(before_time),),
+        )
+        pruned = cur.rowcount
+        cur.close()
+        return pruned
+
+    @staticmethod
+    def _analyze(db_conn):
+        """Refreshes the query planner statistics."""
+        cur = db_conn.cursor()
+        for table in TABLES:
+            cur.execute("analyze %s" % table)
+        cur.close()
+        return True
+
+    def run_maintenance(self):
+        """Refreshes the query planner statistics and prunes the account
+        changes older than local_db.ACCOUNT_CHANGE_RETENTION.
+        Free space is reclaimed by the PostgreSQL autovacuum.
+        Returns the number of pruned account changes.
+        """
+        start_time = time.time()
+        self.stats_lock.acquire()
+        self.maintenance_stats = {
+            "pruned": 0,
+            "start_time": start_time,
+            "end_time": None,
+        }
+        self.stats_lock.release()
+        try:
+            pruned = self.writer.submit(
+                self._prune_account_changes,
+                start_time - local_db.ACCOUNT_CHANGE_RETENTION,
+            ).result()
+            self.writer.submit(self._analyze).result()
+        finally:
+            self.stats_lock.acquire()
+            self.maintenance_stats["end_time"] = time.time()
+            self.stats_lock.release()
+        self.stats_lock.acquire()
+        self.maintenance_stats["pruned"] = pruned
+        self.stats_lock.release()
+        LOG.info(
+            "db maintenance done, %d account changes pruned in %.2fs",
+            pruned,
+            time.time() - start_time,
+        )
+        return pruned
+
+    def get_maintenance_stats(self):
+        """Returns a dict with the DB tables 'size' (bytes), and the
+        'pruned' account changes, 'running' and 'elapsed' seconds
+        of the current (or last) maintenance run ('elapsed' is
+        None if maintenance was not run).
+        """
+        size = sum(
+            row[0] for row in self._fetchall(
+                "select pg_total_relation_size(t) "
+                "from unnest(%s::regclass[]) t",
+                (list(TABLES),),
+            )
+        )
+        self.stats_lock.acquire()
+        maintenance_stats = dict(self.maintenance_stats)
+        self.stats_lock.release()
+        start_time = maintenance_stats.pop("start_time")
+        end_time = maintenance_stats.pop("end_time")
+        maintenance_stats["size"] = size
+        maintenance_stats["running"] = \
+            start_time is not None and end_time is None
+        maintenance_stats["elapsed"] = None
+        if start_time is not None:
+            maintenance_stats["elapsed"] = \
+                (end_time or time.time()) - start_time
+        return maintenance_stats
+
+    def check_maintenance(self):
+        """Health check for the DB maintenance.
+        Returns a string with the result.
+        """
+        try:
+            stats = self.get_maintenance_stats()
+        except Exception as exception:
+            return "ERROR: %s" % str(exception)
+        maintenance_state = "size=%.1f KB" % (stats["size"] / 1024.0)
+        if stats["elapsed"] is not None:
+            maintenance_state += ", %s, changes pruned=%d in %.2fs" % (
+                "running" if stats["running"] else "done",
+                stats["pruned"],
+                stats["elapsed"],
+            )
+        return maintenance_state
+
+    def check_db(self):
+        """Health check for DB. Returns a string with the result."""
+        try:
+            self._fetchall("select 1")
+        except Exception as exception:
+            return "ERROR: %s" % str(exception)
+        self.stats_lock.acquire()
+        db_stats = dict(self.conn_stats)
+        self.stats_lock.release()
+        db_stats.update(self.writer.get_write_stats())
+        db_stats["pool_size"] = self.pool_size
+        return "OK (postgresql), connections in use=%(in_use)d/" \
+            "%(pool_size)d, writes=%(writes)d, " \
+            "commits=%(commits)d" % db_stats
+
+    @query_stats.timed("export_db")
+    def export_db(self, export_filename):
+        """Exports the local DB accounts to the 'export_filename' file,
+        with the format of local_db.LocalDB.export_db.
+        Returns the number of exported accounts.
+        """
+        accounts = 0
+        with open(export_filename, "w") as export_file:
+            export_file.write(json.dumps({
+                "export": local_db.EXPORT_FORMAT,
+                "schema_version": SCHEMA_VERSION,
+            }, sort_keys=True) + "\n")
+            for row in self._iter_rows(
+                    "export_accounts",
+                    """select la.id, la.uniqueid, la.email, la.enabled,
+                    sa.semaphor_guid, sa.password, sa.L2, sa.lock_state
+                    from ldap_account la
+                    left join semaphor_account sa on sa.ldap_account = la.id
+                    order by la.id
+                    """):
+                export_file.write(
+                    json.dumps(dict(zip(EXPORT_COLUMNS, row))) + "\n",
+                )
+                accounts += 1
+        LOG.info("%d accounts exported to '%s'", accounts, export_filename)
+        return accounts
+
+    def import_db(self, import_filename,
+                  chunk_size=local_db.IMPORT_CHUNK_SIZE):
+        """Imports the accounts of the 'import_filename' file
+        (see 'export_db') into the local DB, which must have no accounts.
+        Accounts are inserted 'chunk_size' at a time in a single
+        transaction, so a failed import leaves the DB unchanged.
+        Returns the number of imported accounts.
+        """
+        with open(import_filename, "r") as import_file:
+            header = json.loads(import_file.readline() or "null")
+            if not isinstance(header, dict) or \
+                    header.get("export") != local_db.EXPORT_FORMAT:
+                raise Exception(
+                    "'%s' is not a local DB export file" % import_filename,
+                )
+            accounts = self.writer.submit(
+                self._import_accounts,
+                local_db.iter_jsonl(import_file),
+                chunk_size,
+            ).result()
+        self.account_cache.clear()
+        LOG.info("%d accounts imported from '%s'", accounts, import_filename)
+        return accounts
+
+    @staticmethod
+    def _import_accounts(db_conn, accounts, chunk_size):
+        """Writes the given accounts, see
+        local_db.LocalDB._import_accounts.
+        Returns the number of imported accounts.
+        """
+        cur = db_conn.cursor()
+        cur.execute("select exists(select 1 from ldap_account)")
+        if cur.fetchone()[0]:
+            raise Exception("the local DB already has accounts")
+        cur.execute("delete from ldap_snapshot")
+        cur.execute("delete from sync_state")
+        cur.execute("delete from account_change")
+        # Imported accounts are not logged as account changes
+        cur.execute("alter table semaphor_account disable trigger user")
+        imported = 0
+        for chunk in storage.iter_chunks(accounts, chunk_size):
+            execute_values(
+                cur,
+                """insert into ldap_account (id, uniqueid, email, enabled)
+                values %s
+                """,
+                [
+                    (
+                        account["id"], account["uniqueid"],
+                        account["email"], 1 if account["enabled"] else 0,
+                    )
+                    for account in chunk
+                ],
+                chunk_size,
+            )
+            execute_values(
+                cur,
+                """insert into semaphor_account
+                (ldap_account, semaphor_guid, password, L2, lock_state)
+                values %s
+                """,
+                [
+                    (
+                        account["id"], account["semaphor_guid"],
+                        account["password"], account["L2"],
+                        account["lock_state"],
+                    )
+                    for account in chunk
+                    if account["lock_state"] is not None
+                ],
+                chunk_size,
+            )
+            imported += len(chunk)
+        cur.execute("alter table semaphor_account enable trigger user")
+        # New accounts get ids after the imported ones
+        cur.execute(
+            """select setval(pg_get_serial_sequence('ldap_account', 'id'),
+                             coalesce(max(id), 0) + 1, false)
+            from ldap_account
+            """,
+        )
+        cur.execute(
+            """insert into ldap_snapshot
+            (uniqueid, email, enabled, content_hash, present, dirty)
+            select uniqueid, email, enabled, null, 1, 0
+            from ldap_account
+            """,
+        )
+        cur.close()
+        return imported
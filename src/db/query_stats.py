@@ -0,0 +1,101 @@
+"""
+query_stats.py
+
+Latency statistics of the local DB queries.
+"""
+
+import time
+import logging
+import functools
+import threading
+
+
+LOG = logging.getLogger("query_stats")
+
+
+# Upper bounds (ms) of the latency histogram buckets,
+# slower queries are counted on an extra last bucket
+HISTOGRAM_BUCKETS_MS = (1, 5, 10, 50, 100, 500, 1000)
+
+
+def timed(name):
+    """Decorator for LocalDB methods, it records the latency of
+    each call as the 'name' query on the 'query_stats' of the LocalDB.
+    For methods returning row iterators only the query
+    execution is timed, not the reading of the rows.
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            start_time = time.time()
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                self.query_stats.record(name, time.time() - start_time)
+        return wrapper
+    return decorator
+
+
+class QueryStats(object):
+    """Per query call count, total and max time, and latency histogram.
+    Queries slower than 'slow_query_ms' milliseconds are logged
+    (0 = no slow query log).
+    """
+
+    def __init__(self, slow_query_ms=0):
+        self.slow_query_ms = slow_query_ms
+        self.lock = threading.Lock()
+        self.queries = {}
+
+    def set_slow_query_ms(self, slow_query_ms):
+        """Sets the slow query log threshold (0 = no slow query log)."""
+        LOG.info("slow query log threshold set to %d ms", slow_query_ms)
+        self.slow_query_ms = slow_query_ms
+
+    def record(self, name, elapsed):
+        """Records a call of the 'name' query that took 'elapsed' seconds."""
+        elapsed_ms = elapsed * 1000
+        bucket = len(HISTOGRAM_BUCKETS_MS)
+        for i, bucket_ms in enumerate(HISTOGRAM_BUCKETS_MS):
+            if elapsed_ms <= bucket_ms:
+                bucket = i
+                break
+        self.lock.acquire()
+        query = self.queries.get(name)
+        if query is None:
+            query = {
+                "count": 0,
+                "total_ms": 0.0,
+                "max_ms": 0.0,
+                "histogram": [0] * (len(HISTOGRAM_BUCKETS_MS) + 1),
+            }
+            self.queries[name] = query
+        query["count"] += 1
+        query["total_ms"] += elapsed_ms
+        query["max_ms"] = max(query["max_ms"], elapsed_ms)
+        query["histogram"][bucket] += 1
+        self.lock.release()
+        if self.slow_query_ms and elapsed_ms > self.slow_query_ms:
+            LOG.warning("slow db query '%s': %.1f ms", name, elapsed_ms)
+
+    def get_stats(self):
+        """Returns a dict with the stats of each query name:
+        'count', 'total_ms', 'max_ms' and 'histogram', a list of
+        [bucket label, count] pairs (e.g. ["<=5ms", 10]).
+        """
+        labels = ["<=%dms" % bucket_ms for bucket_ms in HISTOGRAM_BUCKETS_MS]
+        labels.append(">%dms" % HISTOGRAM_BUCKETS_MS[-1])
+        self.lock.acquire()
+        stats = {}
+        for name, query in self.queries.items():
+            stats[name] = {
+                "count": query["count"],
+                "total_ms": query["total_ms"],
+                "max_ms": query["max_ms"],
+                "histogram": [
+                    [label, count]
+                    for label, count in zip(labels, query["histogram"])
+                ],
+            }
+        self.lock.release()
+        return stats
@@ -0,0 +1,388 @@
+"""
+storage.py
+
+Storage interface of the semaphor-ldap local DB, implemented by
+the SQLite (local_db.LocalDB) and PostgreSQL (pg_db.PostgreSQLDB)
+storage engines.
+"""
+
+import logging
+import hashlib
+
+from src.db import account_cache, query_stats
+
+
+LOG = logging.getLogger("storage")
+
+
+ENGINE_SQLITE = "sqlite"
+ENGINE_POSTGRESQL = "postgresql"
+DEFAULT_ENGINE = ENGINE_SQLITE
+
+# LDAP accounts compared with the LDAP snapshot at a time
+# (below the SQLite limit of 999 query parameters)
+SNAPSHOT_PAGE_SIZE = 500
+# Columns of the accounts listed by 'get_db_accounts'
+DB_ACCOUNT_COLUMNS = (
+    "email", "uniqueid", "enabled", "semaphor_guid", "lock_state",
+)
+
+
+def iter_chunks(items, chunk_size):
+    """Yields lists of up to 'chunk_size' items from the 'items' iterable."""
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def entry_hash(*values):
+    """Returns the content hash of the given LDAP entry values."""
+    content = "\0".join(
+        value.encode("utf-8") if isinstance(value, unicode) else str(value)
+        for value in values
+    )
+    return hashlib.sha1(content).hexdigest()
+
+
+class Storage(object):
+    """Local DB storage interface.
+    Engines implement the methods raising NotImplementedError, and
+    the write functions run by their 'writer' (see local_db.DBWriter):
+    '_begin_snapshot', '_write_snapshot_page', '_end_snapshot',
+    '_write_snapshot_entries', '_set_sync_state', '_create_account',
+    '_update_semaphor_account' and '_update_lock'.
+    Writes are submitted to the writer as write_func(db_conn, *args)
+    calls, which return a 'WriteFuture' for the result.
+    """
+
+    # Name of the storage engine
+    engine = None
+    # Whether the engine supports the DMA local DB backups
+    # ('run_backup', 'run_changeset_backup', 'commit_backup',
+    # 'restore_backup'), engines without it are backed up by other means
+    supports_backup = False
+
+    def __init__(self,
+                 account_cache_size=account_cache.DEFAULT_CACHE_SIZE,
+                 slow_query_ms=0):
+        self.account_cache = account_cache.AccountCache(account_cache_size)
+        self.query_stats = query_stats.QueryStats(slow_query_ms)
+        self.writer = None
+
+    def close(self):
+        """Finishes the pending writes and closes the DB connections."""
+        raise NotImplementedError()
+
+    def check_db(self):
+        """Health check for DB. Returns a string with the result."""
+        raise NotImplementedError()
+
+    def run_maintenance(self):
+        """Runs the scheduled DB maintenance."""
+        raise NotImplementedError()
+
+    def get_maintenance_stats(self):
+        """Returns a dict with the DB 'size' (bytes)
+        and the engine specific maintenance statistics.
+        """
+        raise NotImplementedError()
+
+    def check_maintenance(self):
+        """Health check for the DB maintenance.
+        Returns a string with the result.
+        """
+        raise NotImplementedError()
+
+    def get_backup_progress(self):
+        """Returns the progress of the running (or last) backup,
+        None if there is none.
+        """
+        return None
+
+    @query_stats.timed("snapshot_changes")
+    def snapshot_changes(self, ldap_accounts):
+        """Compares the given page of LDAP accounts with the LDAP
+        snapshot using the entries content hash.
+        Returns the list of changed (or new) entries values.
+        """
+        snapshot_hashes = self._snapshot_page_hashes(
+            [ldap_account["uniqueid"] for ldap_account in ldap_accounts],
+        )
+        changed_values = []
+        for ldap_account in ldap_accounts:
+            uniqueid = ldap_account["uniqueid"]
+            enabled = 1 if ldap_account["enabled"] else 0
+            content_hash = entry_hash(ldap_account["email"], enabled)
+            if snapshot_hashes.get(uniqueid) != content_hash:
+                changed_values.append(
+                    (uniqueid, ldap_account["email"], enabled, content_hash),
+                )
+        return changed_values
+
+    def _snapshot_page_hashes(self, uniqueids):
+        """Returns a dict with the content hash of the present
+        LDAP snapshot entries of the given uniqueids.
+        """
+        raise NotImplementedError()
+
+    @query_stats.timed("update_snapshot")
+    def update_snapshot(self, ldap_accounts, page_size=SNAPSHOT_PAGE_SIZE):
+        """Updates the LDAP snapshot with the given LDAP accounts,
+        an iterable read 'page_size' accounts at a time, so only a page
+        of accounts is held in memory. Each page is compared with the
+        snapshot while the previous page changes are written.
+        Only entries whose content changed are written, snapshot entries
+        not on 'ldap_accounts' are marked as removed once all the pages
+        were read (nothing is marked as removed if reading them fails).
+        Account uniqueids are also updated to match LDAP.
+        Returns the number of accounts with an updated uniqueid.
+        """
+        self.writer.submit(self._begin_snapshot).result()
+        changed = 0
+        db_write = None
+        for ldap_page in iter_chunks(ldap_accounts, page_size):
+            changed_values = self.snapshot_changes(ldap_page)
+            if db_write:
+                db_write.result()
+            db_write = self.writer.submit(
+                self._write_snapshot_page,
+                changed_values,
+                [ldap_account["uniqueid"] for ldap_account in ldap_page],
+            )
+            changed += len(changed_values)
+        if db_write:
+            db_write.result()
+        removed, updated_uids = \
+            self.writer.submit(self._end_snapshot).result()
+        if updated_uids:
+            self.account_cache.clear()
+        LOG.info("ldap snapshot: %d changed, %d removed", changed, removed)
+        return updated_uids
+
+    @query_stats.timed("update_snapshot_entries")
+    def update_snapshot_entries(self, ldap_accounts, removed_uniqueids):
+        """Updates only the given entries of the LDAP snapshot, the
+        rest of the snapshot is kept (see 'update_snapshot').
+        'ldap_accounts' are the changed LDAP accounts, and
+        'removed_uniqueids' the uniqueids of the accounts removed from LDAP.
+        Only entries present on the snapshot are updated, new accounts
+        are left to 'update_snapshot'.
+        Returns the number of changed (or removed) entries.
+        """
+        snapshot_hashes = self._snapshot_page_hashes(
+            [ldap_account["uniqueid"] for ldap_account in ldap_accounts],
+        )
+        changed_values = self.snapshot_changes([
+            ldap_account for ldap_account in ldap_accounts
+            if ldap_account["uniqueid"] in snapshot_hashes
+        ])
+        removed = self.writer.submit(
+            self._write_snapshot_entries,
+            changed_values,
+            removed_uniqueids,
+        ).result()
+        LOG.info(
+            "ldap snapshot entries: %d changed, %d removed",
+            len(changed_values),
+            removed,
+        )
+        return len(changed_values) + removed
+
+    def delta_changes(self):
+        """Returns (not execute) the actions to run for our local DB
+        to match the LDAP snapshot, a dict of row iterators with
+        the 'setup', 'retry_setup' and 'update_lock' entries.
+        """
+        raise NotImplementedError()
+
+    def retry_delta(self):
+        """Returns (not execute) only the 'retry_setup' actions."""
+        raise NotImplementedError()
+
+    def delta(self, ldap_accounts):
+        """It will first update (commit) the LDAP snapshot
+        and the uniqueids on our local db to match LDAP.
+        Then return (not execute) the actions
+        to run for our local DB to match LDAP (see 'delta_changes').
+        """
+        self.update_snapshot(ldap_accounts)
+        return self.delta_changes()
+
+    def get_sync_state(self, key):
+        """Returns the stored value for the given
+        sync state key, or None if not set.
+        """
+        raise NotImplementedError()
+
+    def set_sync_state(self, key, value):
+        """Stores the value for the given sync state key."""
+        return self.writer.submit(self._set_sync_state, key, value).result()
+
+    def submit_create_account(self, ldap_data, semaphor_data):
+        """Queues the creation of the account entries with:
+        - ldap_data for ldap_account table.
+        - semaphor_data for semaphor_account table.
+        Returns a 'WriteFuture' for the result of the write.
+        """
+        assert(ldap_data)
+        assert(semaphor_data)
+        return self._submit_account_write(
+            ldap_data["email"],
+            self._create_account,
+            ldap_data,
+            semaphor_data,
+        )
+
+    def create_account(self, ldap_data, semaphor_data):
+        """Create account entries with:
+        - ldap_data for ldap_account table.
+        - semaphor_data for semaphor_account table.
+        """
+        return self.submit_create_account(
+            ldap_data,
+            semaphor_data,
+        ).result()
+
+    def _submit_account_write(self, email, write_func, *args):
+        """Submits the given write of the account with the given email.
+        The account is removed from the account cache once the
+        write is committed. If email is None, the write must return
+        the email of the written account (or False if none).
+        """
+        db_write = self.writer.submit(write_func, *args)
+        if email:
+            db_write.add_done_callback(
+                lambda _: self.account_cache.invalidate(email),
+            )
+        else:
+            db_write.add_done_callback(self._invalidate_written_account)
+        return db_write
+
+    def _invalidate_written_account(self, db_write):
+        """Removes the account written by 'db_write' from the
+        account cache, using the email returned by the write.
+        """
+        if not db_write.error and db_write.value:
+            self.account_cache.invalidate(db_write.value)
+
+    @query_stats.timed("get_account")
+    def get_account(self, username):
+        """Get all available local DB data of the given username.
+        Returns a dict with the following keys:
+        'uniqueid', email', 'enabled',
+        'semaphor_guid', 'password', 'L2' and 'lock_state'.
+        Returns None if the username is not on the local DB.
+        Accounts are served from the account cache when possible.
+        """
+        account = self.account_cache.get(username)
+        if account is account_cache.MISSING:
+            generation = self.account_cache.generation()
+            account = self._read_account(username)
+            self.account_cache.put(username, account, generation)
+        # Callers get their own copy of the cached account
+        return dict(account) if account else None
+
+    def _read_account(self, username):
+        """Reads the account data of the given username from the DB,
+        a dict (see 'get_account') or None.
+        """
+        raise NotImplementedError()
+
+    def update_semaphor_account(self, username, semaphor_data):
+        """Update 'semaphor_account' DB entry for the given username
+        with the provided 'semaphor_data'.
+        """
+        return self._submit_account_write(
+            username,
+            self._update_semaphor_account,
+            username,
+            semaphor_data,
+        ).result()
+
+    def submit_update_lock(self, ldap_account):
+        """Queues the 'enabled' and 'lock_state' update of the given
+        account (see 'update_lock').
+        Returns a 'WriteFuture' for the result of the write.
+        """
+        # The account is looked up by uniqueid, its local DB email
+        # may differ from the LDAP one, so the write returns it
+        return self._submit_account_write(
+            None,
+            self._update_lock,
+            ldap_account,
+        )
+
+    def update_lock(self, ldap_account):
+        """Updates the 'enabled' state on the 'ldap_account' table
+        for the given account, and also updates the 'lock_state'
+        column of the 'semaphor_account' table.
+        It only updates the semaphor_account.lock_state if it is
+        not ldap-locked.
+        Returns the local DB email of the account,
+        or False if it does not exist.
+        """
+        return self.submit_update_lock(ldap_account).result()
+
+    def get_db_accounts(self, limit=None, after=None,
+                        lock_state=None, enabled=None):
+        """Returns the accounts on the local db, ordered by email.
+        Arguments:
+        limit : maximum number of accounts to return (None for all).
+        after : only return accounts with email greater than this one,
+        used as keyset cursor to page through the accounts.
+        lock_state : only return accounts with this lock state.
+        enabled : only return accounts with this LDAP state.
+        """
+        return [
+            dict(zip(DB_ACCOUNT_COLUMNS, row))
+            for row in self.iter_db_accounts(
+                limit,
+                after,
+                lock_state,
+                enabled,
+            )
+        ]
+
+    def iter_db_accounts(self, limit=None, after=None,
+                         lock_state=None, enabled=None):
+        """Same as 'get_db_accounts', but it returns an iterator of row
+        tuples (with the DB_ACCOUNT_COLUMNS values), so large
+        listings are not held in memory.
+        """
+        raise NotImplementedError()
+
+    def get_enabled_ldaped_accounts(self):
+        """Returns the semaphor account ids of the ldaped accounts,
+        that is, the accounts under the control of the bot.
+        """
+        raise NotImplementedError()
+
+    def get_account_change_seq(self):
+        """Returns the sequence number of the last logged
+        account change (0 if no change was logged yet).
+        """
+        raise NotImplementedError()
+
+    def get_account_changes(self, since_seq):
+        """Returns the account changes logged after the 'since_seq'
+        sequence number, or None if they were already pruned.
+        """
+        raise NotImplementedError()
+
+    def export_db(self, export_filename):
+        """Exports the local DB accounts to the 'export_filename' file.
+        Returns the number of exported accounts.
+        """
+        raise NotImplementedError()
+
+    def import_db(self, import_filename):
+        """Imports the accounts of the 'import_filename' file
+        (see 'export_db') into the local DB, which must have no accounts.
+        Returns the number of imported accounts.
+        """
+        raise NotImplementedError()
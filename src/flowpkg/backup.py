@@ -4,67 +4,249 @@ backup.py
 Performs a local DB backup on a private Semaphor channel.
 """
 
+import os
+import re
+import gzip
+import json
+import hashlib
 import logging
-from shutil import copyfile
 
 from flow import Flow
 
-from src import app_platform
+from src.db import local_db
 
 
 LOG = logging.getLogger("backup")
 
+# Number of changeset backups between full backups
+DEFAULT_FULL_EVERY = 24
+# Number of backups sent to a backup channel before starting a new one
+DEFAULT_CHANNEL_MAX_BACKUPS = 500
+# The backup state is kept out of the DB, so that it does not
+# change the DB (and the backups) on every backup run
+STATE_FILENAME_SUFFIX = "-backup-state"
+COMPRESSED_SUFFIX = ".gz"
+RESTORED_SUFFIX = ".restored"
+GZIP_MAGIC = "\x1f\x8b"
+CHUNK_SIZE = 64 * 1024
+# Backup message body: '<file name> sha256=<hash>'
+BACKUP_HASH_RE = re.compile(r"sha256=([0-9a-f]{64})")
 
-def run(db, flow, ldap_tid, backup_cid):
+
+# SQLite file header fields updated on every backup copy, even if the
+# DB did not change: change counter, schema cookie, version-valid-for.
+SQLITE_VOLATILE_HEADER = ((24, 28), (40, 44), (92, 96))
+
+
+def hash_chunk(sha256, chunk, first_chunk):
+    """Updates the backup content hash with the given chunk.
+    The volatile SQLite header fields are not hashed, so
+    backups of an unchanged DB have the same hash.
+    """
+    if first_chunk and chunk.startswith(local_db.SQLITE_FILE_HEADER):
+        chunk = bytearray(chunk)
+        for start, end in SQLITE_VOLATILE_HEADER:
+            chunk[start:end] = "\0" * (end - start)
+        chunk = str(chunk)
+    sha256.update(chunk)
+
+
+def content_hash(filename):
+    """Returns the content hash (sha256 hex digest)
+    of the given (uncompressed) backup file.
+    """
+    sha256 = hashlib.sha256()
+    with open(filename, "rb") as backup_file:
+        for i, chunk in enumerate(
+                iter(lambda: backup_file.read(CHUNK_SIZE), "")):
+            hash_chunk(sha256, chunk, i == 0)
+    return sha256.hexdigest()
+
+
+def compress_backup(backup_filename):
+    """Compresses (gzip) the given backup file, hashing
+    its contents while they are compressed.
+    Returns a tuple with the compressed file name
+    and the backup content hash.
+    """
+    compressed_filename = "%s%s" % (backup_filename, COMPRESSED_SUFFIX)
+    sha256 = hashlib.sha256()
+    with open(backup_filename, "rb") as backup_file, \
+            open(compressed_filename, "wb") as compressed_file:
+        gzip_file = gzip.GzipFile(
+            filename="",
+            mode="wb",
+            fileobj=compressed_file,
+            mtime=0,
+        )
+        for i, chunk in enumerate(
+                iter(lambda: backup_file.read(CHUNK_SIZE), "")):
+            hash_chunk(sha256, chunk, i == 0)
+            gzip_file.write(chunk)
+        gzip_file.close()
+    return compressed_filename, sha256.hexdigest()
+
+
+def decompress_backup(backup_path):
+    """Decompresses the given downloaded backup file,
+    and returns the decompressed file name.
+    Backups uploaded before compression are returned as they are.
+    """
+    with open(backup_path, "rb") as backup_file:
+        if backup_file.read(len(GZIP_MAGIC)) != GZIP_MAGIC:
+            return backup_path
+    restored_filename = "%s%s" % (backup_path, RESTORED_SUFFIX)
+    gzip_file = gzip.open(backup_path, "rb")
+    with open(restored_filename, "wb") as restored_file:
+        for chunk in iter(lambda: gzip_file.read(CHUNK_SIZE), ""):
+            restored_file.write(chunk)
+    gzip_file.close()
+    return restored_filename
+
+
+def verify_backup(backup_msg, backup_path):
+    """Checks the (decompressed) downloaded backup file against
+    the hash recorded on the backup message body.
+    Raises an exception if the hashes do not match.
+    """
+    match = BACKUP_HASH_RE.search(backup_msg.get("text") or "")
+    if not match:
+        LOG.info("db backup without hash, skipping integrity check")
+        return
+    if content_hash(backup_path) != match.group(1):
+        raise Exception("backup integrity check failed")
+
+
+def generation_channel_name(channel_name, generation):
+    """Returns the name of the backup channel of the given generation.
+    Generation 0 is the original backup channel.
+    """
+    if not generation:
+        return channel_name
+    return "%s-%d" % (channel_name, generation)
+
+
+def latest_generation(channels, channel_name):
+    """Returns the latest backup channel generation
+    from the given list of team channels.
+    """
+    generation_re = re.compile(r"^%s(?:-(\d+))?$" % re.escape(channel_name))
+    generation = 0
+    for channel in channels:
+        match = generation_re.match(channel["name"])
+        if match and match.group(1):
+            generation = max(generation, int(match.group(1)))
+    return generation
+
+
+def channel_full(db, channel_max_backups):
+    """Returns True if the current backup channel holds
+    'channel_max_backups' backups (0 = no limit).
+    """
+    return bool(channel_max_backups) and \
+        read_state(db).get("backups", 0) >= channel_max_backups
+
+
+def state_filename(db):
+    """Returns the backup state file name of the given DB."""
+    return "%s%s" % (db.db_file_name, STATE_FILENAME_SUFFIX)
+
+
+def read_state(db):
+    """Returns the backup state of the given DB, a dict with:
+    - 'changesets': number of changeset backups since the last
+    full backup (None if there is no full backup).
+    - 'hash': hash of the last uploaded backup.
+    - 'backups': number of backups sent to the current backup channel.
+    """
+    try:
+        with open(state_filename(db), "r") as state_file:
+            return json.load(state_file)
+    except (IOError, ValueError):
+        return {"changesets": None, "hash": None, "backups": 0}
+
+
+def write_state(db, state):
+    """Stores the given backup state for the given DB."""
+    with open(state_filename(db), "w") as state_file:
+        json.dump(state, state_file)
+
+
+def reset_state(db):
+    """Resets the backup state, so the next backup is a full backup."""
+    if os.path.exists(state_filename(db)):
+        os.remove(state_filename(db))
+
+
+def run(db, flow, ldap_tid, backup_cid, full_every=0):
     """Perform the DB backup and upload it as an attachment
     on the provided 'backup_cid' private channel.
+    A full backup is uploaded after every 'full_every'
+    changeset backups, which only contain the rows changed
+    since the previous backup (0 = always full backups).
     """
     assert(flow)
     assert(ldap_tid)
     assert(backup_cid)
+    state = read_state(db)
+    changesets = state["changesets"]
+    full = changesets is None or changesets >= full_every
     # run db back up
-    backup_filename = db.run_backup()
+    if full:
+        LOG.info("running full db backup")
+        backup_filename, change_seq = db.run_backup()
+    else:
+        LOG.info("running changeset db backup")
+        backup_filename, change_seq = db.run_changeset_backup()
+        if not backup_filename:
+            LOG.info("no db changes since the last backup")
+            return
+    compressed_filename, backup_hash = compress_backup(backup_filename)
+    if backup_hash == state["hash"]:
+        LOG.info("db backup unchanged, skipping upload")
+        db.commit_backup(change_seq)
+        return
     try:
         LOG.info("uploading db")
         # upload backup as attachment
         aid = flow.new_attachment(
             ldap_tid,
-            backup_filename,
+            compressed_filename,
         )
         # send the attachment to the backup channel
         flow.send_message(
             ldap_tid,
             backup_cid,
-            backup_filename,
+            "%s sha256=%s" % (
+                os.path.basename(compressed_filename),
+                backup_hash,
+            ),
             [aid],
         )
     except Flow.FlowError as flow_err:
         LOG.error("backup failed: %s", str(flow_err))
+        return
+    db.commit_backup(change_seq)
+    write_state(db, {
+        "changesets": 0 if full else changesets + 1,
+        "hash": backup_hash,
+        "backups": state.get("backups", 0) + 1,
+    })
 
 
-def restore(flow, ldap_tid, backup_cid):
-    """If available, restore the local DB from the
-    backup private channel.
+def download_backup(flow, ldap_tid, backup_cid, backup_msg):
+    """Downloads the backup attached to the given
+    backup channel message, and returns its local path.
     """
-    assert(flow)
-    assert(ldap_tid)
-    assert(backup_cid)
-    msgs = flow.enumerate_messages(ldap_tid, backup_cid)
-    if not msgs:
-        # no backup available
-        LOG.info("no db backup available")
-        return
-    last_backup_msg = msgs[0]
-    attachments = last_backup_msg["attachments"]
+    attachments = backup_msg["attachments"]
     # we only store messages with attachments on the backup channel
     assert(attachments)
     aid = attachments[0]["id"]
-    LOG.info("downloading last db backup")
     flow.start_attachment_download(
         aid,
         ldap_tid,
         backup_cid,
-        last_backup_msg["id"],
+        backup_msg["id"],
     )
     # wait until download is done
     download_error = {"value": None}
@@ -89,9 +271,58 @@ def restore(flow, ldap_tid, backup_cid):
     if download_error_value:
         LOG.error("db backup download failed: %s", download_error_value)
         raise Exception("backup download failed")
-    LOG.info("last db backup downloaded successfully")
     backup_path = flow.stored_attachment_path(ldap_tid, aid)
     assert(backup_path)
-    local_db_filename = app_platform.local_db_path()
-    copyfile(backup_path, local_db_filename)
-    LOG.info("last db backup restored successfully")
+    return backup_path
+
+
+def restore(db, flow, ldap_tid, backup_cid, current_channel=True):
+    """If available, restore the local DB from the
+    backup private channel.
+    The last full backup is restored, followed by
+    the changeset backups sent after it, in order.
+    The restore is skipped if the latest backup was
+    uploaded from the local DB (so it is up to date).
+    The backup count of the channel is kept on the backup state,
+    unless it is not the 'current_channel' (the one the next
+    backups are sent to, e.g. a new empty channel).
+    Returns False if there is no backup on the channel.
+    """
+    assert(flow)
+    assert(ldap_tid)
+    assert(backup_cid)
+    msgs = flow.enumerate_messages(ldap_tid, backup_cid)
+    if not msgs:
+        # no backup available
+        LOG.info("no db backup available")
+        return False
+    # messages are enumerated from the newest to the oldest
+    match = BACKUP_HASH_RE.search(msgs[0].get("text") or "")
+    if match and match.group(1) == read_state(db)["hash"]:
+        LOG.info("local db is up to date with the last backup")
+        return True
+    changeset_paths = []
+    for backup_msg in msgs:
+        LOG.info("downloading db backup")
+        backup_path = download_backup(flow, ldap_tid, backup_cid, backup_msg)
+        backup_path = decompress_backup(backup_path)
+        verify_backup(backup_msg, backup_path)
+        if not local_db.is_full_backup(backup_path):
+            changeset_paths.append(backup_path)
+            continue
+        LOG.info(
+            "last db backup downloaded successfully (%d changesets)",
+            len(changeset_paths),
+        )
+        changeset_paths.reverse()
+        db.restore_backup(backup_path, changeset_paths)
+        # The next backup is a full backup
+        write_state(db, {
+            "changesets": None,
+            "hash": None,
+            "backups": len(msgs) if current_channel else 0,
+        })
+        LOG.info("last db backup restored successfully")
+        return True
+    LOG.error("no full db backup available")
+    return False
@@ -45,10 +45,12 @@ class DMAManager(object):
         self.flow_remote_logger = None
         self.ldap_team_id = ""
         self.backup_cid = ""
+        self.backup_generation = 0
         self.log_cid = ""
         self.test_cid = ""
         self.ready = threading.Event()
         self.threads_running = False
+        self.backup_thread = None
 
         self.init_flow()
         self.init_remote_logger()
@@ -67,6 +69,12 @@ class DMAManager(object):
         """Register 'db-backup-minutes' config callback
         and update task frequency.
         """
+        if not self.db.supports_backup:
+            LOG.info(
+                "local db backups not supported by the '%s' db engine",
+                self.db.engine,
+            )
+            return
         self.config.register_callback(
             ["db-backup-minutes"],
             self.set_db_backup_mins_from_config,
@@ -123,6 +131,8 @@ class DMAManager(object):
             self.ready.set()
             self.flow_notify.join()
             self.flow_remote_logger.join()
+        if self.backup_thread:
+            self.backup_thread.join()
         if self.flow:
             self.flow.terminate()
 
@@ -231,18 +241,16 @@ class DMAManager(object):
             self.setup_ldap_team()
             self.setup_ldap_channels()
             if device_created:
-                backup.restore(
-                    self.flow,
-                    self.ldap_team_id,
-                    self.backup_cid,
-                )
+                self.restore_backup()
             self.finalize_flow_config()
         except Exception as exception:
             LOG.error("setup_team_channels failed: '%s'", str(exception))
 
-    def scan_accounts(self):
+    def scan_accounts(self, full=True):
         """Performs a scan over the LDAP team and prescribed channels
         and adds remaining accounts to them.
+        If 'full' is False, only the accounts changed since
+        the last scan are scanned.
         """
         LOG.info("start scan accounts on LDAP team and prescribed channels")
         try:
@@ -250,6 +258,7 @@ class DMAManager(object):
                 self.flow,
                 self.db,
                 self.ldap_team_id,
+                full,
             )
         except Exception as exception:
             LOG.error("scan_accounts failed: '%s'", exception)
@@ -312,15 +321,7 @@ class DMAManager(object):
         """Create/Set DMA LDAP channels, in particular
         the backup, log and test channels.
         """
-        backup_channel_name = self.gen_channel_name(
-            utils.DMA_BACKUP_CHANNEL_SUFFIX_NAME,
-        )
-        LOG.info("creating/getting backup channel")
-        self.backup_cid, _ = self.get_channel(
-            self.ldap_team_id,
-            backup_channel_name,
-            private=True,
-        )
+        self.setup_backup_channel()
         log_channel_name = self.gen_channel_name(
             utils.DMA_LOG_CHANNEL_SUFFIX_NAME,
         )
@@ -342,6 +343,59 @@ class DMAManager(object):
             private=True,
         )
 
+    def setup_backup_channel(self, generation=None):
+        """Creates/Gets the backup channel of the given generation,
+        or of the latest generation if 'generation' is None.
+        A new backup channel generation is started when the current
+        one is full, so restores only read the latest backups.
+        """
+        backup_channel_name = self.gen_channel_name(
+            utils.DMA_BACKUP_CHANNEL_SUFFIX_NAME,
+        )
+        if generation is None:
+            generation = backup.latest_generation(
+                self.flow.enumerate_channels(self.ldap_team_id),
+                backup_channel_name,
+            )
+        LOG.info("creating/getting backup channel (generation %d)", generation)
+        self.backup_cid, _ = self.get_channel(
+            self.ldap_team_id,
+            backup.generation_channel_name(backup_channel_name, generation),
+            private=True,
+        )
+        self.backup_generation = generation
+
+    def restore_backup(self):
+        """Restores the local DB from the latest backup channel.
+        If the latest channel has no backups yet (its first
+        upload failed), then the previous channel is used.
+        """
+        if not self.db.supports_backup:
+            return
+        if backup.restore(
+                self.db,
+                self.flow,
+                self.ldap_team_id,
+                self.backup_cid):
+            return
+        if not self.backup_generation:
+            return
+        previous_cid, _ = self.get_channel(
+            self.ldap_team_id,
+            backup.generation_channel_name(
+                self.gen_channel_name(utils.DMA_BACKUP_CHANNEL_SUFFIX_NAME),
+                self.backup_generation - 1,
+            ),
+            private=True,
+        )
+        backup.restore(
+            self.db,
+            self.flow,
+            self.ldap_team_id,
+            previous_cid,
+            current_channel=False,
+        )
+
     def gen_channel_name(self, suffix):
         """Generates a channel name from the
         DMA username and the provided suffix.
@@ -426,17 +480,43 @@ class DMAManager(object):
         self.flow.set_profile("profile", content)
 
     def run_backup(self):
-        """Performs the local DB backup process."""
+        """Starts the local DB backup process on its own thread,
+        so the cron thread (e.g. ldap-sync runs) is not blocked.
+        """
         if not self.ready.is_set():
             LOG.info("skipping local db backup, flow not ready")
             return
+        if self.backup_thread and self.backup_thread.is_alive():
+            LOG.info("skipping local db backup, backup already running")
+            return
+        self.backup_thread = threading.Thread(target=self.backup_db)
+        self.backup_thread.start()
+
+    def backup_db(self):
+        """Performs the local DB backup process."""
         LOG.info("running local db backup")
-        backup.run(
-            self.db,
-            self.flow,
-            self.ldap_team_id,
-            self.backup_cid,
-        )
+        try:
+            channel_max_backups = int(
+                self.config.get("db-backup-channel-max") or
+                backup.DEFAULT_CHANNEL_MAX_BACKUPS
+            )
+            if backup.channel_full(self.db, channel_max_backups):
+                LOG.info("backup channel is full, starting a new one")
+                self.setup_backup_channel(self.backup_generation + 1)
+                # The new channel starts with a full backup
+                backup.reset_state(self.db)
+            backup.run(
+                self.db,
+                self.flow,
+                self.ldap_team_id,
+                self.backup_cid,
+                int(
+                    self.config.get("db-backup-full-every") or
+                    backup.DEFAULT_FULL_EVERY
+                ),
+            )
+        except Exception as exception:
+            LOG.error("local db backup failed: '%s'", exception)
 
     def send_fingerprint(self):
         """Sends the DMA fingerprint to the LOG channel."""
@@ -449,6 +529,21 @@ class DMAManager(object):
             ),
         )
 
+    def check_backup(self):
+        """Returns a string with the progress of the running
+        (or last) local DB backup.
+        """
+        backup_progress = self.db.get_backup_progress()
+        running = self.backup_thread and self.backup_thread.is_alive()
+        if not backup_progress:
+            return "running..." if running else "N/A"
+        return "%s, rows copied=%d/%d in %.2fs" % (
+            "running" if running else "done",
+            backup_progress["rows"],
+            backup_progress["total_rows"],
+            backup_progress["elapsed"],
+        )
+
     def check_flow(self):
         """Health check for Flow. Returns a string with the result."""
         try:
@@ -13,6 +13,11 @@ from src import utils, app_platform
 LOG = logging.getLogger("flow_util")
 
 
+# sync_state key of the account change sequence number
+# of the last successful accounts rescan
+RESCAN_SEQ_KEY = "rescan-seq"
+
+
 def create_flow_object(config):
     """Creates and returns the flow object using the given 'config' dict."""
     flow_config = {
@@ -264,16 +269,52 @@ def rescan_accounts_on_team(flow, tid, accounts):
     return team_accounts
 
 
-def rescan_accounts(flow, db, ldap_tid):
+def changed_ldaped_accounts(db, since_seq):
+    """Returns the semaphor account ids of the enabled ldaped accounts
+    with changes logged after the 'since_seq' account change sequence
+    number, or None if those changes are no longer on the log.
+    """
+    changes = db.get_account_changes(since_seq)
+    if changes is None:
+        return None
+    account_ids = set(
+        change["semaphor_guid"] for change in changes
+        if change["enabled"] and
+        change["lock_state"] == Flow.UNLOCK and
+        change["semaphor_guid"]
+    )
+    return list(account_ids)
+
+
+def rescan_accounts(flow, db, ldap_tid, full=True):
     """Performs a rescan on the local DB accounts, by checking
     that all accounts are member of the LDAP team and channels.
     If they are not member, they are automatically added to
     the team and channels.
+    If 'full' is False, only the accounts changed since the last
+    successful rescan are checked (all of them if there is no
+    last rescan, or its changes are no longer on the account change log).
     """
     if not db:
         return
-    # Get accounts the bot controls
-    accounts = db.get_enabled_ldaped_accounts()
+    # Changes logged from here on are picked up by the next rescan
+    change_seq = db.get_account_change_seq()
+    accounts = None
+    if not full:
+        rescan_seq = db.get_sync_state(RESCAN_SEQ_KEY)
+        if rescan_seq is not None:
+            accounts = changed_ldaped_accounts(db, int(rescan_seq))
+    if accounts is None:
+        # Get accounts the bot controls
+        accounts = db.get_enabled_ldaped_accounts()
+    else:
+        LOG.info("rescan of %d changed accounts", len(accounts))
+    _rescan_accounts(flow, ldap_tid, accounts)
+    db.set_sync_state(RESCAN_SEQ_KEY, str(change_seq))
+
+
+def _rescan_accounts(flow, ldap_tid, accounts):
+    """Rescans the given accounts on the LDAP team and channels."""
     if not accounts:
         return
     # Rescan accounts on team
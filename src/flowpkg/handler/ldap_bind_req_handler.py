@@ -152,11 +152,14 @@ class LDAPBindProcessor(threading.Thread):
     def ldap_bind(self, username, password):
         """Executes the actual bind against the LDAP server.
         Returns True if the credentials are correct.
+        Binds don't wait for a free pooled connection.
         """
-        ldap_conn = self.ldap_factory.get_connection()
-        response = ldap_conn.can_auth(
-            username,
-            password,
-        )
-        ldap_conn.close()
+        ldap_conn = self.ldap_factory.get_connection(overflow=True)
+        try:
+            response = ldap_conn.can_auth(
+                username,
+                password,
+            )
+        finally:
+            ldap_conn.close()
         return response
@@ -9,12 +9,60 @@ import inspect
 
 import sqlite3
 
+from flow import Flow
+
 from src import utils
+from src.db import storage
 from src.log import app_log
 
 
 LOG = logging.getLogger("http_api")
 
+# Lock state names accepted by the 'lock-state' userlist filter
+LOCK_STATES = {
+    "unlocked": Flow.UNLOCK,
+    "full-locked": Flow.FULL_LOCK,
+    "ldap-locked": Flow.LDAP_LOCK,
+}
+
+
+def parse_limit(limit):
+    """Parses the 'limit' userlist argument.
+    Returns None (no limit) if not set.
+    """
+    if limit is None or limit == "":
+        return None
+    limit = int(limit)
+    if limit <= 0:
+        raise Exception("Invalid limit: '%s'" % limit)
+    return limit
+
+
+def parse_enabled(enabled):
+    """Parses the 'enabled' userlist filter,
+    returns None (no filter), True or False.
+    """
+    if enabled is None or enabled == "":
+        return None
+    if enabled in (True, 1, "1", "yes", "enabled"):
+        return True
+    if enabled in (False, 0, "0", "no", "disabled"):
+        return False
+    raise Exception("Invalid enabled filter: '%s'" % enabled)
+
+
+def parse_lock_state(lock_state):
+    """Parses the 'lock-state' userlist filter,
+    returns None (no filter) or the lock state value.
+    """
+    if lock_state is None or lock_state == "":
+        return None
+    if lock_state in LOCK_STATES:
+        return LOCK_STATES[lock_state]
+    if lock_state in LOCK_STATES.values():
+        return lock_state
+    raise Exception("Invalid lock-state filter: '%s'" % lock_state)
+
 
 class HttpApi(object):
     """HTTP API for this application.
@@ -35,6 +83,13 @@ class HttpApi(object):
         converted to string
     """
 
+    # API methods with a streamed version, that returns a tuple
+    # with the result object keys and an iterator of row tuples,
+    # so the result list is not built in memory
+    STREAMED_APIS = {
+        "db_userlist": "_db_userlist_rows",
+    }
+
     def __init__(self, server, http_server):
         self.server = server
         self.ldap_factory = self.server.ldap_factory
@@ -67,13 +122,35 @@ class HttpApi(object):
         self.dma_manager.create_device(username, recovery_key)
         return "null"
 
-    def group_userlist(self):
-        """Returns the userlist for the configured Group/OU."""
+    def group_userlist(self, limit=None, after=None, enabled=None):
+        """Returns the userlist for the configured Group/OU.
+        Users are ordered by email, the LDAP group is read
+        on each call, so it is not paged by the CLI.
+        Arguments:
+        limit : Maximum number of users to return.[optional]
+        after : Return users with email after this one.[optional]
+        enabled : {yes,no} LDAP state filter.[optional]
+        """
+        limit = parse_limit(limit)
+        enabled = parse_enabled(enabled)
         ldap_conn = self.ldap_factory.get_connection()
-        ldap_group = ldap_conn.get_group(self.server.config.get("group-dn"))
-        users = ldap_group.userlist()
-        ldap_conn.close()
-        return users
+        try:
+            ldap_group = ldap_conn.get_group(
+                self.server.config.get("group-dn"),
+            )
+            users = ldap_group.userlist()
+        finally:
+            ldap_conn.close()
+        if after:
+            after = after.lower()
+            users = [user for user in users if user["email"].lower() > after]
+        if enabled is not None:
+            users = [
+                user for user in users
+                if bool(user["enabled"]) == enabled
+            ]
+        users.sort(key=lambda user: user["email"].lower())
+        return users[:limit]
 
     def log_dest(self, target):
         """Configures the server's logging destination.
@@ -112,9 +189,12 @@ class HttpApi(object):
         """Executes health checks and returns the server status."""
         return {
             "db": self.server.db.check_db(),
+            "backup": self.dma_manager.check_backup(),
+            "maintenance": self.server.db.check_maintenance(),
             "flow": self.dma_manager.check_flow(),
             "ldap": self.ldap_factory.check_ldap(),
             "sync": self.server.ldap_sync.check_sync(),
+            "listener": self.server.check_ldap_listener(),
         }
 
     def test_auth(self, username, password):
@@ -124,18 +204,71 @@ class HttpApi(object):
         password : LDAP password.[optional]
         """
         ldap_conn = self.ldap_factory.get_connection()
-        auth_result = ldap_conn.can_auth(username, password)
-        ldap_conn.close()
+        try:
+            auth_result = ldap_conn.can_auth(username, password)
+        finally:
+            ldap_conn.close()
         return auth_result
 
     def dma_fingerprint(self):
         """Returns the DMA fingerprint."""
         return self.dma_manager.get_dma_fingerprint()
 
-    def db_userlist(self):
-        """Returns all the accounts on the local DB."""
-        accounts = self.server.db.get_db_accounts()
-        return accounts
+    def db_userlist(self, limit=None, after=None,
+                    lock_state=None, enabled=None):
+        """Returns the accounts on the local DB.
+        Accounts are ordered by email, all of them if no limit is set.
+        Arguments:
+        limit : Maximum number of accounts to return.[optional]
+        after : Return accounts with email after this one.[optional]
+        lock-state : {unlocked,full-locked,ldap-locked} filter.[optional]
+        enabled : {yes,no} LDAP state filter.[optional]
+        """
+        columns, rows = self._db_userlist_rows(
+            limit,
+            after,
+            lock_state,
+            enabled,
+        )
+        return [dict(zip(columns, row)) for row in rows]
+
+    def _db_userlist_rows(self, limit=None, after=None,
+                          lock_state=None, enabled=None):
+        """Streamed version of 'db_userlist', returns a tuple with
+        the account keys and an iterator of the account row tuples.
+        """
+        rows = self.server.db.iter_db_accounts(
+            limit=parse_limit(limit),
+            after=after or None,
+            lock_state=parse_lock_state(lock_state),
+            enabled=parse_enabled(enabled),
+        )
+        return storage.DB_ACCOUNT_COLUMNS, rows
+
+    def db_stats(self):
+        """Returns the latency statistics of the local DB queries."""
+        return self.server.db.query_stats.get_stats()
+
+    def export_db(self, filename):
+        """Exports the local DB accounts to a JSONL file.
+        Returns the number of exported accounts.
+        Arguments:
+        filename : Path of the file to write, on the server host.
+        """
+        if not filename:
+            raise Exception("Empty filename.")
+        return self.server.db.export_db(filename)
+
+    def import_db(self, filename):
+        """Imports the accounts of a JSONL file (see export-db).
+        The local DB must not have any accounts.
+        Returns the number of imported accounts.
+        Arguments:
+        filename : Path of the file to read, on the server host.
+        """
+        if not filename:
+            raise Exception("Empty filename.")
+        return self.server.db.import_db(filename)
 
     def ldap_sync_trigger(self):
         """Triggers an LDAP sync (if enabled)."""
@@ -6,6 +6,7 @@ HTTP request handler for the local HTTP Semaphor-LDAP server.
 
 import logging
 import hmac
+import json
 
 from werkzeug.routing import Map, Rule
 from werkzeug.exceptions import HTTPException
@@ -19,6 +20,33 @@ from src.http.http_api import HttpApi
 
 LOG = logging.getLogger("http_handler")
 
+# Result rows written on each chunk of a streamed response
+STREAM_CHUNK_ROWS = 256
+
+
+def iter_rpc_result(request_id, columns, rows):
+    """Yields the chunks of the JSON-RPC 2.0 response with a result
+    list of objects with the 'columns' keys and the 'rows' values,
+    serialized from the rows as they are read.
+    """
+    yield '{"jsonrpc": "2.0", "id": %s, "result": [' % json.dumps(request_id)
+    try:
+        separator = ""
+        chunk = []
+        for row in rows:
+            chunk.append(json.dumps(dict(zip(columns, row))))
+            if len(chunk) >= STREAM_CHUNK_ROWS:
+                yield separator + ", ".join(chunk)
+                separator = ", "
+                chunk = []
+        if chunk:
+            yield separator + ", ".join(chunk)
+    except Exception as exception:
+        # The response is already being sent, it is left incomplete
+        LOG.error("failed to stream response: '%s'", exception)
+        raise
+    yield "]}"
+
 
 class HTTPRequestHandler(object):
     """Handles/Dispatches HTTP requests."""
@@ -60,17 +88,61 @@ class HTTPRequestHandler(object):
         if not auth_token or \
            not hmac.compare_digest(auth_token, self.auth_token):
             return Response("Invalid Request", status=404)
-        rpc_response = JSONRPCResponseManager.handle(
-            request.data,
-            dispatcher,
+        response = self.stream_rpc(request.data)
+        if response is None:
+            rpc_response = JSONRPCResponseManager.handle(
+                request.data,
+                dispatcher,
+            )
+            response = Response(
+                rpc_response.json,
+                mimetype="application/json",
+            )
+        return response
+
+    def stream_rpc(self, request_data):
+        """Handles a JSON-RPC 2.0 request of a streamed API method
+        (see HttpApi.STREAMED_APIS), the result is serialized
+        as it is read from the DB.
+        Returns None for any other request, or if the method call
+        fails, these are handled (and their errors reported)
+        by the JSON-RPC dispatcher.
+        """
+        try:
+            rpc_request = json.loads(request_data)
+        except ValueError:
+            return None
+        if not isinstance(rpc_request, dict) or \
+           rpc_request.get("jsonrpc") != "2.0" or \
+           "id" not in rpc_request:
+            return None
+        method = self.streamed_methods.get(rpc_request.get("method"))
+        if method is None:
+            return None
+        params = rpc_request.get("params") or {}
+        try:
+            if isinstance(params, dict):
+                columns, rows = method(**params)
+            else:
+                columns, rows = method(*params)
+        except Exception:
+            return None
+        return Response(
+            iter_rpc_result(rpc_request["id"], columns, rows),
+            mimetype="application/json",
         )
-        return Response(rpc_response.json, mimetype="application/json")
 
     def register_api_methods(self):
         """Registers all HttpApi methods to the dispatcher."""
+        self.streamed_methods = {}
         for method_name, _ in HttpApi.get_apis():
             disp_method_name = method_name.replace("_", "-")
             dispatcher[disp_method_name] = getattr(self.http_api, method_name)
+            if method_name in HttpApi.STREAMED_APIS:
+                self.streamed_methods[disp_method_name] = getattr(
+                    self.http_api,
+                    HttpApi.STREAMED_APIS[method_name],
+                )
 
     def dispatch_request(self, request):
         """Performs request dispatching from URL and method.
@@ -9,20 +9,27 @@ import threading
 
 import ldap_reader
 
+from src import ldap_pool
+
 
 LOG = logging.getLogger("ldap_factory")
 
 
 class LDAPFactory(object):
-    """Factory class to create connections to an LDAP server."""
+    """Factory class to create connections to an LDAP server.
+    Connections are pooled, see 'ldap_pool.LDAPConnectionPool'.
+    """
 
     def __init__(self, config):
         self.lock = threading.Lock()
         self.config = config
+        self.pool = None
         self.reload_config()
 
     def reload_config(self):
-        """Reloads LDAP configuration from self.config."""
+        """Reloads LDAP configuration from self.config,
+        and drains the connection pool.
+        """
         LOG.info("reloading ldap config")
         self.lock.acquire()
         self.uri = self.config.get("uri")
@@ -37,10 +44,27 @@ class LDAPFactory(object):
             "dir_auth_source": self.config.get("dir-auth-source"),
             "dir_auth_username": self.config.get("dir-auth-username"),
         }
+        pool_size = int(
+            self.config.get("ldap-pool-size") or
+            ldap_pool.DEFAULT_POOL_SIZE
+        )
+        pool_idle_seconds = int(
+            self.config.get("ldap-pool-idle-seconds") or
+            ldap_pool.DEFAULT_POOL_IDLE_SECONDS
+        )
         self.lock.release()
+        if self.pool is None:
+            self.pool = ldap_pool.LDAPConnectionPool(
+                self.connect,
+                self.rebind,
+                pool_size,
+                pool_idle_seconds,
+            )
+        else:
+            self.pool.drain(pool_size, pool_idle_seconds)
 
-    def get_connection(self, timeout=5):
-        """Returns an 'LDAPConnection'
+    def connect(self, timeout):
+        """Returns a new 'LDAPConnection'
         connection object to the LDAP server.
         """
         self.lock.acquire()
@@ -57,6 +81,22 @@ class LDAPFactory(object):
             self.lock.release()
         return ldap_conn
 
+    def rebind(self, ldap_conn):
+        """Binds the given 'LDAPConnection' with the service account."""
+        self.lock.acquire()
+        ldap_user = self.ldap_user
+        ldap_pw = self.ldap_pw
+        self.lock.release()
+        ldap_conn.conn.simple_bind_s(ldap_user, ldap_pw)
+
+    def get_connection(self, timeout=5, overflow=False):
+        """Returns a pooled 'LDAPConnection' connection object to the
+        LDAP server, its 'close' returns it to the pool.
+        If 'overflow' is True it does not wait for a free connection
+        (see 'LDAPConnectionPool.get').
+        """
+        return self.pool.get(timeout, overflow)
+
     def check_ldap(self):
         """Health check for LDAP. Returns a string with the result."""
         ldap_state = ""
@@ -68,7 +108,10 @@ class LDAPFactory(object):
                 "check 'uri', 'ldap-user' and " \
                 "'ldap-pw' LDAP variables" % (str(exception),)
         else:
-            ldap_state = "OK"
+            ldap_state = "OK, connections in use=%(in_use)d/%(size)d, " \
+                "idle=%(idle)d, hit rate=%(hit_rate).2f, " \
+                "waits=%(waits)d (max %(max_wait_ms).1f ms)" % \
+                self.pool.get_stats()
         finally:
             if ldap_conn:
                 ldap_conn.close()
@@ -0,0 +1,301 @@
+"""
+ldap_pool.py
+
+Pool of LDAP connections bound with the service account.
+"""
+
+import logging
+import inspect
+import threading
+import time
+
+
+LOG = logging.getLogger("ldap_pool")
+
+
+DEFAULT_POOL_SIZE = 4
+DEFAULT_POOL_IDLE_SECONDS = 300
+POOL_WAIT_TIMEOUT = 30  # seconds
+# Pooled connections idle for longer are checked before handout
+LIVENESS_CHECK_IDLE = 10  # seconds
+
+
+def is_alive(ldap_conn):
+    """Liveness check of an idle LDAP connection,
+    a 'Who am I?' request on its python-ldap connection.
+    """
+    try:
+        ldap_conn.conn.whoami_s()
+    except Exception as exception:
+        LOG.debug("pooled ldap connection is not alive: %s", exception)
+        return False
+    return True
+
+
+class PooledLDAPConnection(object):
+    """'LdapConnection' handed out by the 'LDAPConnectionPool',
+    'close' returns it to the pool.
+    """
+
+    def __init__(self, pool, ldap_conn, generation):
+        self.pool = pool
+        self.ldap_conn = ldap_conn
+        self.generation = generation
+        self.last_used = time.time()
+        # Whether it can go back to the pool
+        self.reusable = True
+        self.closed = False
+
+    def get_group(self, group_dn):
+        """See 'LdapConnection.get_group'."""
+        return PooledLDAPGroup(
+            self,
+            self._call(self.ldap_conn.get_group, group_dn),
+        )
+
+    def can_auth(self, username, password):
+        """See 'LdapConnection.can_auth'."""
+        result = self._call(self.ldap_conn.can_auth, username, password)
+        # The user bind may replace the service account bind, the
+        # connection is only reused once bound with it again
+        try:
+            self.pool.rebind(self.ldap_conn)
+        except Exception as exception:
+            LOG.debug("ldap service account bind failed: %s", exception)
+            self.reusable = False
+        return result
+
+    def search_ext_s(self, *args, **kwargs):
+        """python-ldap 'search_ext_s' on the LDAP connection."""
+        return self._call(self.ldap_conn.conn.search_ext_s, *args, **kwargs)
+
+    def _call(self, method, *args, **kwargs):
+        """Runs the given connection method, failed
+        connections are not returned to the pool.
+        """
+        try:
+            return method(*args, **kwargs)
+        except Exception:
+            self.reusable = False
+            raise
+
+    def close(self):
+        """Returns the connection to the pool."""
+        if self.closed:
+            return
+        self.closed = True
+        self.pool.release(self)
+
+
+class PooledLDAPGroup(object):
+    """LDAP group of a 'PooledLDAPConnection', its methods search
+    on the connection, so failed calls (or failed iterations of
+    the returned generators) make the connection not reusable.
+    """
+
+    def __init__(self, pooled_conn, group):
+        self.pooled_conn = pooled_conn
+        self.group = group
+
+    def __getattr__(self, name):
+        attr = getattr(self.group, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            result = self.pooled_conn._call(attr, *args, **kwargs)
+            if inspect.isgenerator(result):
+                return self._iter(result)
+            return result
+        return call
+
+    def _iter(self, generator):
+        """Yields the items of the given generator."""
+        try:
+            for item in generator:
+                yield item
+        except Exception:
+            self.pooled_conn.reusable = False
+            raise
+
+
+class LDAPConnectionPool(object):
+    """Bounded pool of up to 'size' LDAP connections, bound with the
+    service account. Connections idle for more than 'idle_seconds'
+    are closed, and connections idle for more than LIVENESS_CHECK_IDLE
+    are checked before handout.
+    'connect(timeout)' opens a new connection, and 'rebind(ldap_conn)'
+    binds a connection with the service account again (after a user bind).
+    """
+
+    def __init__(self, connect, rebind, size, idle_seconds):
+        self.connect = connect
+        self.rebind = rebind
+        self.size = size
+        self.idle_seconds = idle_seconds
+        self.cond = threading.Condition(threading.Lock())
+        # Idle connections, the most recently used last
+        self.idle = []
+        # Number of open (idle and in use) connections
+        self.opened = 0
+        # Connections of older generations are closed on release
+        self.generation = 0
+        self.stats = {
+            "hits": 0,
+            "misses": 0,
+            "discarded": 0,
+            "overflows": 0,
+            "waits": 0,
+            "wait_ms": 0.0,
+            "max_wait_ms": 0.0,
+        }
+
+    def get(self, timeout, overflow=False):
+        """Returns a 'PooledLDAPConnection', an idle one if possible,
+        otherwise a new one. It waits up to POOL_WAIT_TIMEOUT seconds
+        while all the pool connections are in use, unless 'overflow'
+        is True, then a connection over the pool size is opened
+        (and closed when released).
+        """
+        start_time = time.time()
+        stale = []
+        self.cond.acquire()
+        try:
+            while True:
+                stale.extend(self._pop_stale_connections())
+                if self.idle or self.opened < self.size:
+                    break
+                if overflow:
+                    self.stats["overflows"] += 1
+                    break
+                if time.time() - start_time > POOL_WAIT_TIMEOUT:
+                    raise Exception("all ldap connections are in use")
+                self.cond.wait(1)
+            wait_ms = (time.time() - start_time) * 1000
+            if wait_ms > 1:
+                self.stats["waits"] += 1
+                self.stats["wait_ms"] += wait_ms
+                self.stats["max_wait_ms"] = \
+                    max(self.stats["max_wait_ms"], wait_ms)
+            pooled_conn = self.idle.pop() if self.idle else None
+            if pooled_conn is None:
+                self.opened += 1
+            generation = self.generation
+        finally:
+            self.cond.release()
+        # Connections are closed and opened out of the lock
+        for stale_conn in stale:
+            self._close(stale_conn)
+        if pooled_conn is not None:
+            if time.time() - pooled_conn.last_used <= LIVENESS_CHECK_IDLE \
+                    or is_alive(pooled_conn.ldap_conn):
+                self._count("hits")
+                pooled_conn.closed = False
+                return pooled_conn
+            # Replaced by a new connection (on the same pool slot)
+            self._close(pooled_conn)
+            self._count("discarded")
+        self._count("misses")
+        try:
+            ldap_conn = self.connect(timeout)
+        except Exception:
+            self._discard()
+            raise
+        return PooledLDAPConnection(self, ldap_conn, generation)
+
+    def _pop_stale_connections(self):
+        """Removes and returns the idle connections
+        unused for more than 'idle_seconds'.
+        """
+        now = time.time()
+        stale = [
+            pooled_conn for pooled_conn in self.idle
+            if now - pooled_conn.last_used > self.idle_seconds
+        ]
+        if stale:
+            self.idle = [
+                pooled_conn for pooled_conn in self.idle
+                if pooled_conn not in stale
+            ]
+            self.opened -= len(stale)
+            self.cond.notify_all()
+        return stale
+
+    def release(self, pooled_conn):
+        """Returns the connection to the idle connections, or closes
+        it if it is not reusable or from an older generation.
+        """
+        pooled_conn.last_used = time.time()
+        self.cond.acquire()
+        # Overflow connections are closed
+        reuse = pooled_conn.reusable and \
+            pooled_conn.generation == self.generation and \
+            self.opened <= self.size
+        if reuse:
+            self.idle.append(pooled_conn)
+            self.cond.notify()
+        self.cond.release()
+        if not reuse:
+            self._close(pooled_conn)
+            self._discard()
+
+    def _discard(self):
+        """Frees the slot of a closed (or failed) connection."""
+        self.cond.acquire()
+        self.opened -= 1
+        self.stats["discarded"] += 1
+        self.cond.notify()
+        self.cond.release()
+
+    def _count(self, stat):
+        """Increments the given counter stat."""
+        self.cond.acquire()
+        self.stats[stat] += 1
+        self.cond.release()
+
+    @staticmethod
+    def _close(pooled_conn):
+        """Closes the LDAP connection, errors are only logged."""
+        try:
+            pooled_conn.ldap_conn.close()
+        except Exception as exception:
+            LOG.debug("closing ldap connection failed: %s", exception)
+
+    def drain(self, size, idle_seconds):
+        """Closes the idle connections and resizes the pool. The in use
+        connections are closed when released, so connections opened from
+        now on use the current config.
+        """
+        self.cond.acquire()
+        idle = self.idle
+        self.idle = []
+        self.opened -= len(idle)
+        self.generation += 1
+        self.size = size
+        self.idle_seconds = idle_seconds
+        self.cond.notify_all()
+        self.cond.release()
+        for pooled_conn in idle:
+            self._close(pooled_conn)
+        LOG.info(
+            "ldap connection pool drained (%d idle connections closed)",
+            len(idle),
+        )
+
+    def get_stats(self):
+        """Returns a dict with the pool 'size', the 'idle' and 'in_use'
+        connections, the 'hits' (reused connections), 'misses'
+        (new connections), 'hit_rate', 'discarded' connections,
+        'overflows' (connections over the pool size), and the 'waits'
+        for a free connection with their total 'wait_ms' and 'max_wait_ms'.
+        """
+        self.cond.acquire()
+        stats = dict(self.stats)
+        stats["size"] = self.size
+        stats["idle"] = len(self.idle)
+        stats["in_use"] = self.opened - len(self.idle)
+        self.cond.release()
+        handouts = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = \
+            float(stats["hits"]) / handouts if handouts else 0.0
+        return stats
@@ -22,6 +22,8 @@ from src.sync import ldap_sync
 from src.log import app_log
 from src.db import (
     local_db,
+    pg_db,
+    storage,
 )
 from src.ldap_factory import LDAPFactory
 from src.flowpkg import dma_manager
@@ -45,6 +47,8 @@ class Server(object):
         self.db = None
         self.cron = None
         self.ldap_sync = None
+        self.ldap_listener = None
+        self.db_maintenance_thread = None
         self.http_server = None
         self.threads_running = False
         self.ldap_factory = None
@@ -59,8 +63,10 @@ class Server(object):
         self.init_cron()
         self.init_ldap()
         self.init_db()
+        self.init_db_maintenance()
         self.init_dma()
         self.init_ldap_sync()
+        self.init_ldap_listener()
         self.init_http()
         self.write_auto_connect_config()
 
@@ -116,11 +122,84 @@ class Server(object):
         )
 
     def init_db(self):
-        """Initializes the db object"""
-        LOG.info("initializing db")
-        schema_file_name = self.config.get("local-db-schema") or \
-            app_platform.get_default_schema_path()
-        self.db = local_db.LocalDB(schema_file_name)
+        """Initializes the db object with the 'db-engine' storage engine"""
+        db_engine = self.config.get("db-engine") or storage.DEFAULT_ENGINE
+        LOG.info("initializing db (%s)", db_engine)
+        if db_engine == storage.ENGINE_SQLITE:
+            schema_file_name = self.config.get("local-db-schema") or \
+                app_platform.get_default_schema_path()
+            busy_timeout = int(
+                self.config.get("db-busy-timeout") or
+                local_db.DEFAULT_BUSY_TIMEOUT
+            )
+            self.db = local_db.LocalDB(
+                schema_file_name,
+                busy_timeout=busy_timeout,
+                slow_query_ms=self.get_slow_query_ms(),
+            )
+        elif db_engine == storage.ENGINE_POSTGRESQL:
+            schema_file_name = self.config.get("local-db-pg-schema") or \
+                app_platform.get_default_pg_schema_path()
+            pool_size = int(
+                self.config.get("db-pool-size") or
+                pg_db.DEFAULT_POOL_SIZE
+            )
+            self.db = pg_db.PostgreSQLDB(
+                schema_file_name,
+                self.config.get("db-dsn"),
+                pool_size=pool_size,
+                slow_query_ms=self.get_slow_query_ms(),
+            )
+        else:
+            raise SemaphorLDAPServerError(
+                "invalid db-engine '%s'" % db_engine,
+            )
+        self.config.register_callback(
+            ["db-slow-query-ms"],
+            self.set_slow_query_ms_from_config,
+        )
+
+    def get_slow_query_ms(self):
+        """Returns the 'db-slow-query-ms' config value."""
+        return int(self.config.get("db-slow-query-ms") or 0)
+
+    def set_slow_query_ms_from_config(self):
+        """Sets the db slow query log threshold from config value."""
+        self.db.query_stats.set_slow_query_ms(self.get_slow_query_ms())
+
+    def run_db_maintenance(self):
+        """Runs the scheduled local DB maintenance from a separate
+        thread, so it does not delay the other cron tasks (ldap-sync).
+        It is skipped if the previous run did not finish.
+        """
+        if self.db_maintenance_thread is not None and \
+                self.db_maintenance_thread.is_alive():
+            LOG.info("local db maintenance still running")
+            return
+        LOG.info("running local db maintenance")
+        self.db_maintenance_thread = threading.Thread(
+            target=self.db.run_maintenance,
+        )
+        self.db_maintenance_thread.start()
+
+    def set_db_maintenance_mins_from_config(self):
+        """Sets the db maintenance interval from config value."""
+        minutes = int(
+            self.config.get("db-maintenance-minutes") or
+            local_db.DEFAULT_MAINTENANCE_MINUTES
+        )
+        self.cron.update_task_frequency(minutes, self.run_db_maintenance)
+
+    def init_db_maintenance(self):
+        """Schedules the local DB maintenance and registers
+        its config callback.
+        """
+        LOG.info("initializing db maintenance scheduling")
+        self.config.register_callback(
+            ["db-maintenance-minutes"],
+            self.set_db_maintenance_mins_from_config,
+        )
+        self.set_db_maintenance_mins_from_config()
 
     def init_ldap(self):
         """Initializes LDAP from config values."""
@@ -169,6 +248,39 @@ class Server(object):
         )
         self.set_ldap_sync_on_from_config()
 
+    def set_ldap_listener_on_from_config(self):
+        """Sets the LDAP change listener on/off state from the config.
+        The listener is created when it is first enabled, its
+        python-ldap controls need the (optional) pyasn1 packages.
+        """
+        listener_on = self.config.get("ldap-listener-on")
+        if listener_on == "yes":
+            if self.ldap_listener is None:
+                from src.sync import ldap_listener
+                LOG.info("initializing ldap change listener")
+                self.ldap_listener = ldap_listener.LDAPChangeListener(self)
+                if self.threads_running:
+                    self.ldap_listener.start()
+            self.ldap_listener.listener_on.set()
+        elif self.ldap_listener is not None:
+            self.ldap_listener.listener_on.clear()
+
+    def check_ldap_listener(self):
+        """Status check for the LDAP change listener.
+        Returns a string with the result.
+        """
+        if self.ldap_listener is None:
+            return "OFF"
+        return self.ldap_listener.check_listener()
+
+    def init_ldap_listener(self):
+        """Registers the LDAP change listener config callback."""
+        self.config.register_callback(
+            ["ldap-listener-on"],
+            self.set_ldap_listener_on_from_config,
+        )
+        self.set_ldap_listener_on_from_config()
+
     def init_config(self, options):
         """Initializes the config handler."""
         # If not provided in args, use config from default location
@@ -217,12 +329,15 @@ class Server(object):
         """Server main loop.
         It performs the following actions:
             - Starts the LDAP sync thread
+            - Starts the LDAP change listener thread
             - Starts the Bind Request Handler thread.
             - Starts the CLI HTTP request processing (on main thread)
         """
         # Start cron thread, auth listener thread and remote logger thread
         self.cron.start()
         self.dma_manager.start()
+        if self.ldap_listener is not None:
+            self.ldap_listener.start()
         self.http_server.start()
         self.threads_running = True
 
@@ -240,9 +355,16 @@ class Server(object):
         if self.threads_running:
             self.cron.stop()
             self.cron.join()
+            if self.db_maintenance_thread is not None:
+                self.db_maintenance_thread.join()
             self.dma_manager.stop()
+            if self.ldap_listener is not None:
+                self.ldap_listener.stop()
+                self.ldap_listener.join()
             self.http_server.stop()
             self.http_server.join()
+        if self.db:
+            self.db.close()
         self.config.store_config()
         LOG.info("server cleanup done")
 
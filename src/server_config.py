@@ -19,7 +19,18 @@ _DEFAULT_CONFIG = """
 # Generic
 listen-port = 8080
 db-backup-minutes = 60
+db-backup-full-every = 24
+db-backup-channel-max = 500
+db-engine = sqlite
+db-dsn =
+db-pool-size = 8
+db-busy-timeout = 10
+db-maintenance-minutes = 360
+db-slow-query-ms = 0
 ldap-sync-minutes = 60
+ldap-sync-mode = full
+ldap-full-sync-every = 60
+ldap-listener-on = no
 excluded-accounts =
 ldap-sync-on = no
 verbose = no
@@ -31,6 +42,8 @@ base-dn =
 ldap-user = cn=user,dc=domain,dc=com
 ldap-pw = password
 group-dn = ou=People,dc=domain,dc=com
+ldap-pool-size = 4
+ldap-pool-idle-seconds = 300
 ########################################
 # LDAP Vendor
 server-type = AD
@@ -44,6 +57,7 @@ dir-auth-username =
 )
 LDAP_VARIABLES = set([
     "uri", "base-dn", "ldap-user", "ldap-pw", "group-dn",
+    "ldap-pool-size", "ldap-pool-idle-seconds",
     "server-type", "dir-member-source", "dir-username-source",
     "dir-guid-source", "dir-auth-source", "dir-auth-username",
 ])
@@ -28,7 +28,10 @@ class Action(object):
         return self.__class__.__name__
 
     def execute(self):
-        """Action to execute on this action class."""
+        """Action to execute on this action class.
+        Returns True/False on success/failure, or a 'WriteFuture'
+        for the pending DB write of the action.
+        """
         LOG.error(
             "%s: execute not implemented",
             self.name(),
@@ -120,17 +123,16 @@ class UserAccountSetup(Action):
                 "lock_state": Flow.UNLOCK,
             }
 
-        # Create the entry on the local DB
-        self.ldap_sync.server.db.create_account(
+        # Queue the entry creation on the local DB
+        db_write = self.ldap_sync.server.db.submit_create_account(
             self.ldap_account,
             semaphor_data,
         )
 
-        if "id" in semaphor_data:
-            response = self.add_account_to_team_chans(semaphor_data["id"])
-        else:
-            response = True
-        return response
+        if "id" in semaphor_data and \
+                not self.add_account_to_team_chans(semaphor_data["id"]):
+            return False
+        return db_write
 
 
 class UpdateLock(Action):
@@ -161,8 +163,8 @@ class UpdateLock(Action):
                 flow_err,
             )
             return False
-        # Update the database with the new 'enabled' state
-        return self.ldap_sync.server.db.update_lock(self.ldap_account)
+        # Queue the database update with the new 'enabled' state
+        return self.ldap_sync.server.db.submit_update_lock(self.ldap_account)
 
 
 class TryUserAccountSetup(UserAccountSetup):
@@ -0,0 +1,203 @@
+"""
+ldap_changes.py
+
+Change detection on the LDAP server for the incremental ldap-sync,
+using high-water marks of the directory state.
+"""
+
+import logging
+import re
+import time
+
+import ldap
+import ldap.dn
+import ldap.filter
+
+
+LOG = logging.getLogger("ldap_changes")
+
+
+# Generalized time of the modifyTimestamp attribute
+TIMESTAMP_FORMAT = "%Y%m%d%H%M%SZ"
+TIMESTAMP_RE = re.compile(r"^\d{14}(\.\d+)?Z$")
+# Margin for the clock difference with the LDAP server
+CLOCK_SKEW_MARGIN = 300  # seconds
+# Active Directory matching rule of the nested group members
+AD_IN_CHAIN_RULE = "1.2.840.113556.1.4.1941"
+
+
+class InvalidMark(Exception):
+    """The high-water mark is not valid on the LDAP server."""
+    pass
+
+
+def search_base(base_dn, group_dn):
+    """Returns the subtree where changes are looked for, the configured
+    'base_dn', or the domain (the 'dc' components) of the group DN.
+    """
+    if base_dn:
+        return base_dn
+    return ",".join(
+        rdn for rdn in ldap.dn.explode_dn(group_dn)
+        if rdn.lower().startswith("dc=")
+    )
+
+
+def any_entry(ldap_conn, base_dn, scope, filterstr):
+    """Returns True if an entry under 'base_dn' matches 'filterstr'.
+    Only a single entry (without attributes) is read, so the search
+    stays below the server size limits.
+    """
+    try:
+        results = ldap_conn.search_ext_s(
+            base_dn,
+            scope,
+            filterstr,
+            ["1.1"],
+            sizelimit=1,
+        )
+    except ldap.SIZELIMIT_EXCEEDED:
+        return True
+    # Search continuation references have no DN
+    return any(dn for dn, _ in results)
+
+
+def group_changed(ldap_conn, base_dn, group_dn, change_filter,
+                  member_attr="memberOf"):
+    """Returns True if the group entry, or one of its members
+    (entries with 'member_attr' = 'group_dn') under 'base_dn',
+    match 'change_filter'. Changes of other entries are ignored.
+    """
+    if any_entry(ldap_conn, group_dn, ldap.SCOPE_BASE, change_filter):
+        return True
+    return any_entry(
+        ldap_conn,
+        base_dn,
+        ldap.SCOPE_SUBTREE,
+        "(&(%s=%s)%s)" % (
+            member_attr,
+            ldap.filter.escape_filter_chars(group_dn),
+            change_filter,
+        ),
+    )
+
+
+class USNTracker(object):
+    """Active Directory changes, tracked with the update sequence
+    numbers (USN) of the domain controller: the 'uSNChanged' of the
+    entries, and the 'highestCommittedUSN' of the server.
+    USNs are local to each domain controller, a mark ahead of
+    the server state is not valid (e.g. after a failover).
+    """
+
+    kind = "usn"
+
+    def __init__(self, base_dn, group_dn):
+        self.base_dn = base_dn
+        self.group_dn = group_dn
+
+    def parse_mark(self, value):
+        """Returns the mark of the stored 'value', None if not valid."""
+        if not value or not value.startswith(self.kind + ":"):
+            return None
+        try:
+            return int(value[len(self.kind) + 1:])
+        except ValueError:
+            return None
+
+    def format_mark(self, mark):
+        """Returns the stored value of 'mark'."""
+        return "%s:%d" % (self.kind, mark)
+
+    def current_mark(self, ldap_conn):
+        """Returns the mark of the current server state."""
+        results = ldap_conn.search_ext_s(
+            "",
+            ldap.SCOPE_BASE,
+            "(objectClass=*)",
+            ["highestCommittedUSN"],
+        )
+        return int(results[0][1]["highestCommittedUSN"][0])
+
+    def changed_since(self, ldap_conn, mark):
+        """Returns a tuple with whether the group or its (nested)
+        members changed after 'mark', and the mark of the current
+        server state.
+        Raises 'InvalidMark' if 'mark' is ahead of the server.
+        """
+        current_mark = self.current_mark(ldap_conn)
+        if current_mark < mark:
+            raise InvalidMark(
+                "ldap highestCommittedUSN %d is behind the mark %d" % (
+                    current_mark,
+                    mark,
+                ),
+            )
+        if current_mark == mark:
+            return False, mark
+        changed = group_changed(
+            ldap_conn,
+            self.base_dn,
+            self.group_dn,
+            "(uSNChanged>=%d)" % (mark + 1),
+            member_attr="memberOf:%s:" % AD_IN_CHAIN_RULE,
+        )
+        LOG.info("ldap group changed since usn %d: %s", mark, changed)
+        return changed, current_mark
+
+
+class TimestampTracker(object):
+    """Generic LDAP changes, tracked with the 'modifyTimestamp'
+    of the entries. The first mark comes from the local clock
+    (there is no standard server time), moved back CLOCK_SKEW_MARGIN
+    seconds. Group members are found with their 'memberOf' attribute
+    (e.g. the OpenLDAP memberof overlay).
+    """
+
+    kind = "ts"
+
+    def __init__(self, base_dn, group_dn):
+        self.base_dn = base_dn
+        self.group_dn = group_dn
+
+    def parse_mark(self, value):
+        """Returns the mark of the stored 'value', None if not valid."""
+        if not value or not value.startswith(self.kind + ":"):
+            return None
+        mark = value[len(self.kind) + 1:]
+        return mark if TIMESTAMP_RE.match(mark) else None
+
+    def format_mark(self, mark):
+        """Returns the stored value of 'mark'."""
+        return "%s:%s" % (self.kind, mark)
+
+    def current_mark(self, ldap_conn):
+        """Returns the mark of the current server state."""
+        return time.strftime(
+            TIMESTAMP_FORMAT,
+            time.gmtime(time.time() - CLOCK_SKEW_MARGIN),
+        )
+
+    def changed_since(self, ldap_conn, mark):
+        """Returns a tuple with whether the group or its members changed
+        after 'mark', and the mark to check the next changes from
+        ('mark' if there were none).
+        """
+        changed = group_changed(
+            ldap_conn,
+            self.base_dn,
+            self.group_dn,
+            "(&(modifyTimestamp>=%s)(!(modifyTimestamp=%s)))" % (mark, mark),
+        )
+        LOG.info("ldap group changed since %s: %s", mark, changed)
+        if not changed:
+            return False, mark
+        return True, self.current_mark(ldap_conn)
+
+
+def get_tracker(server_type, base_dn, group_dn):
+    """Returns the change tracker of the given LDAP server type."""
+    base_dn = search_base(base_dn, group_dn)
+    if server_type == "AD":
+        return USNTracker(base_dn, group_dn)
+    return TimestampTracker(base_dn, group_dn)
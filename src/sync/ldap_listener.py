@@ -0,0 +1,468 @@
+"""
+ldap_listener.py
+
+LDAP change listener, applies the directory changes pushed by the LDAP
+server as they happen, between the periodic ldap-sync runs.
+"""
+
+import logging
+import threading
+import time
+
+import ldap
+import ldap.dn
+import ldap.ldapobject
+import ldap.syncrepl
+from ldap.controls import LDAPControl
+from ldap.controls.psearch import (
+    CHANGE_TYPES_INT,
+    PersistentSearchControl,
+    EntryChangeNotificationControl,
+)
+
+from src.db import storage
+from src.sync import ldap_changes
+
+
+LOG = logging.getLogger("ldap_listener")
+
+
+# Seconds to wait for a change message before applying
+# the pending changes and checking the listener state
+POLL_SECONDS = 1
+# Max number of pending changes, applied in a single delta
+MAX_PENDING_CHANGES = 500
+# Seconds to wait for more changes before running a requested ldap-sync
+SYNC_REQUEST_DELAY = 30
+# Seconds to wait before reconnecting, doubled on each failed attempt
+RECONNECT_MIN_SECONDS = 30
+RECONNECT_MAX_SECONDS = 600
+CONNECT_TIMEOUT = 10
+# Sync state key prefix of the syncrepl cookies
+COOKIE_KEY_PREFIX = "ldap-cookie-"
+# Active Directory change notification and show deleted objects controls
+AD_NOTIFICATION_OID = "1.2.840.113556.1.4.528"
+AD_SHOW_DELETED_OID = "1.2.840.113556.1.4.417"
+# Active Directory userAccountControl flag of disabled accounts
+AD_ACCOUNTDISABLE = 0x2
+
+
+def normalize_dn(dn):
+    """Returns the given DN in a form that can be compared."""
+    return ",".join(
+        rdn.strip().lower() for rdn in ldap.dn.explode_dn(dn)
+    )
+
+
+class ChangeFeed(object):
+    """Directory change feed of an LDAP server, the changed entries
+    are passed to the listener 'entry_changed'.
+    Feeds implement 'start' and 'poll'.
+    """
+
+    ldap_class = ldap.ldapobject.LDAPObject
+
+    def __init__(self, listener, ldap_conn):
+        self.listener = listener
+        self.ldap_conn = ldap_conn
+        self.msgid = None
+
+    def start(self, base_dn, attrlist):
+        """Starts the change search under 'base_dn'."""
+        raise NotImplementedError()
+
+    def poll(self, timeout):
+        """Reads the next change message. Returns False if there was
+        none after 'timeout' seconds. Raises if the search finished.
+        """
+        try:
+            rtype, rdata, _, _ = self.ldap_conn.result4(
+                self.msgid,
+                all=0,
+                timeout=timeout,
+                add_ctrls=1,
+                resp_ctrl_classes={
+                    EntryChangeNotificationControl.controlType:
+                    EntryChangeNotificationControl,
+                },
+            )
+        except ldap.TIMEOUT:
+            return False
+        if rtype == ldap.RES_SEARCH_RESULT:
+            raise Exception("ldap change search finished")
+        for dn, attributes, controls in rdata:
+            if dn:
+                self.entry(dn, attributes, controls)
+        return True
+
+    def entry(self, dn, attributes, controls):
+        """Passes a search entry to the listener."""
+        self.listener.entry_changed(dn, attributes)
+
+
+class NotificationFeed(ChangeFeed):
+    """Active Directory change notifications, each changed entry is sent
+    with its current attributes. Deleted entries are sent as tombstones
+    (only a few attributes are kept), so they are marked as deleted.
+    """
+
+    kind = "ad-notification"
+
+    def start(self, base_dn, attrlist):
+        """Starts the change search under 'base_dn'."""
+        self.msgid = self.ldap_conn.search_ext(
+            base_dn,
+            ldap.SCOPE_SUBTREE,
+            "(objectClass=*)",
+            attrlist + ["isDeleted"],
+            serverctrls=[
+                LDAPControl(AD_NOTIFICATION_OID, True, None),
+                LDAPControl(AD_SHOW_DELETED_OID, True, None),
+            ],
+        )
+
+    def entry(self, dn, attributes, controls):
+        """Passes a search entry to the listener."""
+        self.listener.entry_changed(
+            dn,
+            attributes,
+            deleted=attributes.get("isDeleted") == ["TRUE"],
+        )
+
+
+class PersistentSearchFeed(ChangeFeed):
+    """Persistent search change notifications
+    (draft-ietf-ldapext-psearch), e.g. on RHDS.
+    """
+
+    kind = "psearch"
+
+    def start(self, base_dn, attrlist):
+        """Starts the change search under 'base_dn'."""
+        self.msgid = self.ldap_conn.search_ext(
+            base_dn,
+            ldap.SCOPE_SUBTREE,
+            "(objectClass=*)",
+            attrlist,
+            serverctrls=[
+                PersistentSearchControl(
+                    criticality=True,
+                    changesOnly=True,
+                    returnECs=True,
+                ),
+            ],
+        )
+
+    def entry(self, dn, attributes, controls):
+        """Passes a search entry to the listener."""
+        change_types = [
+            control.changeType for control in controls
+            if control.controlType ==
+            EntryChangeNotificationControl.controlType
+        ]
+        self.listener.entry_changed(
+            dn,
+            attributes,
+            deleted=change_types == [CHANGE_TYPES_INT["delete"]],
+        )
+
+
+class SyncreplLDAPObject(ldap.ldapobject.LDAPObject,
+                         ldap.syncrepl.SyncreplConsumer):
+    """LDAP connection of an RFC 4533 content synchronization (syncrepl)
+    consumer, the consumer callbacks are passed to its 'feed'.
+    """
+
+    feed = None
+
+    def syncrepl_get_cookie(self):
+        return self.feed.cookie
+
+    def syncrepl_set_cookie(self, cookie):
+        self.feed.set_cookie(cookie)
+
+    def syncrepl_entry(self, dn, attributes, uuid):
+        self.feed.entry(dn, attributes, None)
+
+    def syncrepl_delete(self, uuids):
+        self.feed.deleted(uuids)
+
+    def syncrepl_present(self, uuids, refreshDeletes=False):
+        self.feed.deleted(None)
+
+    def syncrepl_refreshdone(self):
+        self.feed.refreshing = False
+
+
+class SyncreplFeed(ChangeFeed):
+    """RFC 4533 content synchronization (refreshAndPersist), e.g. on
+    OpenLDAP. The sync cookie is stored on the local DB, so a new
+    connection only gets the changes after it. Without a cookie, the
+    initial refresh sends every entry, they are already handled
+    by the ldap-sync.
+    Deletes only have the entryUUID, so they request an ldap-sync.
+    """
+
+    kind = "syncrepl"
+    ldap_class = SyncreplLDAPObject
+
+    def __init__(self, listener, ldap_conn):
+        super(SyncreplFeed, self).__init__(listener, ldap_conn)
+        ldap_conn.feed = self
+        self.cookie = listener.get_cookie()
+        self.refreshing = self.cookie is None
+
+    def start(self, base_dn, attrlist):
+        """Starts the change search under 'base_dn'."""
+        self.msgid = self.ldap_conn.syncrepl_search(
+            base_dn,
+            ldap.SCOPE_SUBTREE,
+            mode="refreshAndPersist",
+            filterstr="(objectClass=*)",
+            attrlist=attrlist,
+        )
+
+    def poll(self, timeout):
+        """Reads the next change message. Returns False if there was
+        none after 'timeout' seconds. Raises if the search finished.
+        """
+        try:
+            if not self.ldap_conn.syncrepl_poll(
+                    msgid=self.msgid,
+                    timeout=timeout):
+                raise Exception("ldap change search finished")
+        except ldap.TIMEOUT:
+            return False
+        return True
+
+    def set_cookie(self, cookie):
+        """Stores the sync cookie."""
+        self.cookie = cookie
+        self.listener.set_cookie(cookie)
+
+    def entry(self, dn, attributes, controls):
+        """Passes a sync entry to the listener."""
+        if not self.refreshing:
+            self.listener.entry_changed(dn, attributes)
+
+    def deleted(self, uuids):
+        """Deleted entries are handled by an ldap-sync run."""
+        if not self.refreshing:
+            self.listener.request_sync("ldap entries deleted")
+
+
+def get_feed_class(server_type):
+    """Returns the change feed class of the given LDAP server type."""
+    if server_type == "AD":
+        return NotificationFeed
+    if server_type == "OpenLDAP":
+        return SyncreplFeed
+    return PersistentSearchFeed
+
+
+class LDAPChangeListener(threading.Thread):
+    """Runs a thread that subscribes to the directory changes of the
+    LDAP server, and turns them into targeted per-account deltas
+    (see 'LDAPSync.run_account_changes') of the local DB accounts:
+    - Disabled and re-enabled accounts (AD 'userAccountControl').
+    - Deleted accounts.
+    Changes that can't be applied to a single account (e.g. group
+    membership changes, or other account changes of non AD servers)
+    request an ldap-sync run.
+    The periodic ldap-sync remains the consistency backstop.
+    The listener uses its own LDAP connection, which is reopened
+    when the LDAP config is reloaded.
+    """
+
+    def __init__(self, server):
+        super(LDAPChangeListener, self).__init__()
+        self.daemon = True
+        self.server = server
+        self.config = server.config
+        self.ldap_sync = server.ldap_sync
+        self.ldap_factory = server.ldap_factory
+        self.listener_on = threading.Event()
+        self.stop_listener = threading.Event()
+        self.feed = None
+        self.pending_changes = []
+        self.sync_requested = None
+        self.changes = 0
+        self.last_error = None
+
+    def stop(self):
+        """Finishes the execution of the listener thread."""
+        self.stop_listener.set()
+
+    def running(self):
+        """Returns True while the listener should stay connected."""
+        return self.listener_on.is_set() and \
+            not self.stop_listener.is_set()
+
+    def cookie_key(self):
+        """Returns the sync state key of the syncrepl cookie
+        of the configured LDAP server.
+        """
+        return COOKIE_KEY_PREFIX + storage.entry_hash(
+            self.config.get("uri"),
+            self.config.get("base-dn"),
+        )[:16]
+
+    def get_cookie(self):
+        """Returns the stored syncrepl cookie."""
+        return self.server.db.get_sync_state(self.cookie_key())
+
+    def set_cookie(self, cookie):
+        """Stores the syncrepl cookie."""
+        self.server.db.set_sync_state(self.cookie_key(), cookie)
+
+    def connect(self, feed_class):
+        """Returns a new connection to the LDAP server,
+        of the connection class of 'feed_class'.
+        """
+        ldap_conn = feed_class.ldap_class(self.config.get("uri"))
+        ldap_conn.set_option(ldap.OPT_REFERRALS, 0)
+        ldap_conn.set_option(ldap.OPT_NETWORK_TIMEOUT, CONNECT_TIMEOUT)
+        ldap_conn.simple_bind_s(
+            self.config.get("ldap-user"),
+            self.config.get("ldap-pw"),
+        )
+        return ldap_conn
+
+    def entry_changed(self, dn, attributes, deleted=False):
+        """Turns a changed LDAP entry into a pending account change,
+        or an ldap-sync request.
+        """
+        if normalize_dn(dn) == self.group_dn:
+            self.request_sync("ldap group changed")
+            return
+        emails = attributes.get(self.username_source)
+        if not emails:
+            # Deleted AD entries lose their username
+            if deleted:
+                self.request_sync("ldap entry deleted")
+            return
+        email = emails[0].decode("utf-8")
+        if not self.server.db.get_account(email):
+            # New group members come with a group change
+            return
+        enabled = None
+        if "userAccountControl" in attributes:
+            enabled = not int(attributes["userAccountControl"][0]) & \
+                AD_ACCOUNTDISABLE
+        if not deleted and enabled is None:
+            # Account state changes of other servers are left
+            # to the ldap-sync
+            self.request_sync("ldap account changed")
+            return
+        self.pending_changes.append({
+            "email": email,
+            "enabled": enabled,
+            "removed": deleted,
+        })
+
+    def request_sync(self, reason):
+        """Requests an ldap-sync run, after SYNC_REQUEST_DELAY seconds
+        (so more changes are included).
+        """
+        if self.sync_requested is None:
+            LOG.info("%s, ldap-sync requested", reason)
+            self.sync_requested = time.time()
+
+    def apply_changes(self):
+        """Applies the pending account changes
+        and runs the requested ldap-sync.
+        """
+        if self.pending_changes:
+            changes = self.pending_changes
+            self.pending_changes = []
+            LOG.info("applying %d ldap account changes", len(changes))
+            if self.ldap_sync.run_account_changes(changes):
+                self.changes += len(changes)
+            else:
+                # Dropped, or the running ldap-sync may have read
+                # the accounts before they changed
+                self.request_sync("account changes not applied")
+        if self.sync_requested is not None and \
+                time.time() - self.sync_requested >= SYNC_REQUEST_DELAY and \
+                not self.ldap_sync.lock.locked():
+            self.sync_requested = None
+            self.ldap_sync.trigger_sync()
+
+    def listen(self):
+        """Listens to the LDAP changes until the listener is disabled,
+        or the LDAP config is reloaded.
+        """
+        server_type = self.config.get("server-type")
+        feed_class = get_feed_class(server_type)
+        generation = self.ldap_factory.pool.generation
+        self.username_source = self.config.get("dir-username-source")
+        self.group_dn = normalize_dn(self.config.get("group-dn"))
+        attrlist = [self.username_source]
+        if server_type == "AD":
+            attrlist.append("userAccountControl")
+            # Change notifications are only allowed on the whole domain
+            base_dn = ldap_changes.search_base("", self.config.get("group-dn"))
+        else:
+            base_dn = ldap_changes.search_base(
+                self.config.get("base-dn"),
+                self.config.get("group-dn"),
+            )
+        ldap_conn = self.connect(feed_class)
+        try:
+            self.feed = feed_class(self, ldap_conn)
+            self.feed.start(base_dn, attrlist)
+            self.last_error = None
+            LOG.info(
+                "listening to %s changes on '%s'",
+                self.feed.kind,
+                base_dn,
+            )
+            while self.running() and \
+                    generation == self.ldap_factory.pool.generation:
+                if not self.feed.poll(POLL_SECONDS) or \
+                        len(self.pending_changes) >= MAX_PENDING_CHANGES:
+                    self.apply_changes()
+        finally:
+            self.feed = None
+            ldap_conn.unbind_s()
+
+    def run(self):
+        """Runs the listener loop, reconnecting on errors."""
+        LOG.info("ldap listener thread started")
+        reconnect_seconds = RECONNECT_MIN_SECONDS
+        while not self.stop_listener.is_set():
+            if not self.listener_on.is_set():
+                self.stop_listener.wait(POLL_SECONDS)
+                continue
+            try:
+                self.listen()
+                reconnect_seconds = RECONNECT_MIN_SECONDS
+            except Exception as exception:
+                LOG.error(
+                    "ldap listener failed: '%s', reconnecting in %ds",
+                    exception,
+                    reconnect_seconds,
+                )
+                self.last_error = str(exception)
+                # Changes missed while disconnected are found by an ldap-sync
+                self.pending_changes = []
+                self.request_sync("ldap listener disconnected")
+                self.stop_listener.wait(reconnect_seconds)
+                reconnect_seconds = min(
+                    reconnect_seconds * 2,
+                    RECONNECT_MAX_SECONDS,
+                )
+        LOG.info("ldap listener thread finished")
+
+    def check_listener(self):
+        """Status check for the listener. Returns a string
+        with the result.
+        """
+        if not self.listener_on.is_set():
+            return "OFF"
+        feed = self.feed
+        if feed is None:
+            return "ON, not connected%s" % (
+                ": '%s'" % self.last_error if self.last_error else "",
+            )
+        return "ON, %s, account changes=%d" % (feed.kind, self.changes)
@@ -8,11 +8,66 @@ import logging
 import threading
 import time
 
-from src.sync import action
+from src.db import local_db, storage
+from src.sync import action, ldap_changes
 
 
 LOG = logging.getLogger("ldap_sync")
 
+USERLIST_DIGEST_KEY = "userlist-digest"
+# Sync state key prefix of the LDAP server high-water marks
+LDAP_MARK_KEY_PREFIX = "ldap-mark-"
+SYNC_MODE_INCREMENTAL = "incremental"
+DEFAULT_FULL_SYNC_EVERY = 60
+_DIGEST_MODULUS = 2 ** 160
+# Action classes for each delta change label, in execution order
+_ACTION_CLASSES = (
+    ("retry_setup", action.TryUserAccountSetup),
+    ("setup", action.UserAccountSetup),
+    ("update_lock", action.UpdateLock),
+)
+# Max number of executed actions with unchecked results
+_MAX_PENDING_RESULTS = local_db.WRITE_BATCH_SIZE
+
+
+class UserlistDigest(object):
+    """Order-independent digest of an LDAP userlist and the excluded
+    accounts config, computed as the userlist entries are read.
+    The digest is the sum of the entry hashes, together with
+    the number of entries and the hash of the excluded accounts.
+    """
+
+    def __init__(self, excluded_accounts):
+        self.excluded_accounts = excluded_accounts
+        self.entries_sum = 0
+        self.entries = 0
+
+    def add(self, user):
+        """Adds the given userlist entry to the digest."""
+        self.entries_sum += int(
+            storage.entry_hash(
+                user["uniqueid"],
+                user["email"],
+                1 if user["enabled"] else 0,
+            ),
+            16,
+        )
+        self.entries += 1
+
+    def iter_users(self, users):
+        """Yields the given users, adding them to the digest."""
+        for user in users:
+            self.add(user)
+            yield user
+
+    def hexdigest(self):
+        """Returns the digest of the entries added so far."""
+        return "%x,%d,%s" % (
+            self.entries_sum % _DIGEST_MODULUS,
+            self.entries,
+            storage.entry_hash(*sorted(self.excluded_accounts)),
+        )
+
 
 class LDAPSync(object):
     """Runs the LDAP sync operation."""
@@ -26,48 +81,96 @@ class LDAPSync(object):
         self.config = server.config
         self.sync_on = server.ldap_sync_on
         self.lock = threading.Lock()
+        self.last_run = None
+        # Incremental runs since the last full sync
+        self.incremental_runs = 0
 
-    def get_ldap_userlist(self):
-        """Retrieves the LDAP user directory using the config group_dn."""
+    def iter_ldap_userlist(self, excluded_accounts):
+        """Yields the LDAP user directory entries of the config
+        group_dn that are not excluded. The LDAP connection is
+        returned to the pool once all the entries were read.
+        """
+        excluded_accounts = set(excluded_accounts)
         ldap_conn = self.ldap_factory.get_connection()
-        group_dn = self.config.get("group-dn")
-        group = ldap_conn.get_group(group_dn)
-        group_users = group.userlist()
-        excluded_accounts = self.config.get_list("excluded-accounts")
-        users = [user for user in group_users if user[
-            "email"] not in excluded_accounts]
-        ldap_conn.close()
-        return users
+        try:
+            group_dn = self.config.get("group-dn")
+            group = ldap_conn.get_group(group_dn)
+            for user in group.userlist():
+                if user["email"] not in excluded_accounts:
+                    yield user
+        finally:
+            ldap_conn.close()
 
     def changes_into_actions(self, delta_changes):
-        """Turns the given delta changes into executable action objects."""
-        action_labels = {
-            "retry_setup": action.TryUserAccountSetup,
-            "setup": action.UserAccountSetup,
-            "update_lock": action.UpdateLock,
-        }
-        actions = []
-        for action_label, entries in delta_changes.iteritems():
-            for entry in entries:
-                actions.append(action_labels[action_label](self, entry))
-        return actions
+        """Turns the given delta changes into executable action objects.
+        Actions are yielded as the delta entries are read,
+        so they can be executed right away.
+        """
+        for action_label, action_class in _ACTION_CLASSES:
+            for entry in delta_changes.get(action_label, ()):
+                yield action_class(self, entry)
+
+    @staticmethod
+    def check_action_result(action_i, result):
+        """Logs an error if the given action execution failed.
+        'result' can be a 'WriteFuture' of the action DB write,
+        in which case it waits for the write to be committed.
+        Returns True if the action succeeded.
+        """
+        try:
+            if isinstance(result, local_db.WriteFuture):
+                result = result.result()
+            if not result:
+                LOG.error(
+                    "action %s execution failed",
+                    action_i,
+                )
+                return False
+        except Exception as exception:
+            LOG.error(
+                "action %s execution failed with error: %s",
+                action_i,
+                exception,
+            )
+            return False
+        return True
+
+    def check_action_results(self, action_results):
+        """Checks the given (action, result) list,
+        returns the number of failed actions.
+        """
+        return len([
+            action_i for action_i, result in action_results
+            if not self.check_action_result(action_i, result)
+        ])
 
     def execute_actions(self, actions):
-        """Executes all the actions needed to comply with the LDAP sync."""
+        """Executes all the actions needed to comply with the LDAP sync.
+        DB writes of the actions are committed in groups by the
+        DB writer, results are checked every _MAX_PENDING_RESULTS
+        executed actions.
+        Returns a tuple with the number of executed and failed actions.
+        """
+        executed_actions = 0
+        failed_actions = 0
+        action_results = []
         for action_i in actions:
+            LOG.info("executing action %s", action_i)
+            executed_actions += 1
             try:
-                success = action_i.execute()
-                if not success:
-                    LOG.error(
-                        "action %s execution failed",
-                        action_i,
-                    )
+                action_results.append((action_i, action_i.execute()))
             except Exception as exception:
                 LOG.error(
                     "action %s execution failed with error: %s",
                     action_i,
                     exception,
                 )
+                failed_actions += 1
+            if len(action_results) >= _MAX_PENDING_RESULTS:
+                failed_actions += self.check_action_results(action_results)
+                action_results = []
+        failed_actions += self.check_action_results(action_results)
+        return executed_actions, failed_actions
 
     def pre_checks(self):
         """Runs a few checks before running the ldap-sync."""
@@ -84,47 +187,251 @@ class LDAPSync(object):
         LOG.info("triggering a ldap sync")
         threading.Thread(
             target=self.run_sync,
+            kwargs={"full": True},
         ).start()
 
-    def run_sync(self):
-        """Method to run the ldap-sync from a separate thread."""
+    def run_sync(self, full=False):
+        """Method to run the ldap-sync from a separate thread.
+        If 'full' is True the LDAP userlist is read even on
+        the incremental sync mode.
+        """
         self.lock.acquire()
         try:
-            self.run()
+            self.run(full)
         finally:
             self.lock.release()
 
-    def run(self):
+    def ldap_mark_key(self):
+        """Returns the sync state key of the high-water mark
+        of the configured LDAP server.
+        """
+        return LDAP_MARK_KEY_PREFIX + storage.entry_hash(
+            self.config.get("uri"),
+            self.config.get("base-dn"),
+            self.config.get("group-dn"),
+        )[:16]
+
+    def check_ldap_changes(self, full):
+        """Checks the LDAP changes since the stored high-water mark.
+        A full sync is needed if 'full' is True, if the mark is not set
+        or not valid, after 'ldap-full-sync-every' incremental runs,
+        or if LDAP entries changed.
+        Returns a tuple with whether a full sync is needed, and the
+        high-water mark to store after a successful run.
+        """
+        tracker = ldap_changes.get_tracker(
+            self.config.get("server-type"),
+            self.config.get("base-dn"),
+            self.config.get("group-dn"),
+        )
+        full_sync_every = int(
+            self.config.get("ldap-full-sync-every") or
+            DEFAULT_FULL_SYNC_EVERY
+        )
+        mark = tracker.parse_mark(
+            self.server.db.get_sync_state(self.ldap_mark_key()),
+        )
+        ldap_conn = self.ldap_factory.get_connection()
+        try:
+            if not full and mark is not None and \
+                    self.incremental_runs < full_sync_every:
+                try:
+                    changed, new_mark = \
+                        tracker.changed_since(ldap_conn, mark)
+                except ldap_changes.InvalidMark as exception:
+                    LOG.warning("%s, running a full sync", exception)
+                else:
+                    return changed, tracker.format_mark(new_mark)
+            # Changes while the userlist is read are
+            # found on the next incremental run
+            return True, tracker.format_mark(
+                tracker.current_mark(ldap_conn),
+            )
+        finally:
+            ldap_conn.close()
+
+    def run_retry(self, run_type, start_sync_time):
+        """Only retries the setup of 'ldap lock'ed accounts.
+        Returns the number of failed actions.
+        """
+        delta_changes = self.server.db.retry_delta()
+        executed_actions, failed_actions = self.execute_actions(
+            self.changes_into_actions(delta_changes),
+        )
+        self.record_run(
+            run_type,
+            start_sync_time,
+            executed_actions,
+            failed_actions,
+        )
+        return failed_actions
+
+    def run(self, full=False):
         """Runs the actual LDAP sync operation:
-        1. Get account entries from LDAP.
-        2. Calculate delta actions to execute.
-        3. Execute actions (log ERROR with actions that failed).
-        4. Perform an extra scan over the ldaped accounts.
+        0. On the incremental sync mode, if no LDAP entries changed since
+        the last run (see 'check_ldap_changes'), only retry the setup
+        of 'ldap lock'ed accounts and finish.
+        1. Stream the account entries from LDAP into the LDAP snapshot.
+        2. If the LDAP entries (and excluded accounts) did not change
+        since the last successful run, only retry the setup of
+        'ldap lock'ed accounts and finish.
+        3. Calculate delta actions to execute.
+        4. Execute actions (log ERROR with actions that failed).
+        5. Perform an extra scan over the changed ldaped accounts.
         """
         if not self.pre_checks():
             return
         LOG.info("start")
         start_sync_time = time.time()
+        mark = None
+        if self.config.get("ldap-sync-mode") == SYNC_MODE_INCREMENTAL:
+            try:
+                full, mark = self.check_ldap_changes(full)
+            except Exception as exception:
+                LOG.error("Failed to check ldap changes: '%s'", exception)
+                return
+            if not full:
+                LOG.info("no ldap changes since %s", mark)
+                self.incremental_runs += 1
+                self.server.db.set_sync_state(self.ldap_mark_key(), mark)
+                self.run_retry("no-change", start_sync_time)
+                return
+        excluded_accounts = self.config.get_list("excluded-accounts")
+        digest = UserlistDigest(excluded_accounts)
+        # The userlist is streamed into the LDAP snapshot
         try:
-            ldap_accounts = self.get_ldap_userlist()
+            updated_uids = self.server.db.update_snapshot(
+                digest.iter_users(self.iter_ldap_userlist(excluded_accounts)),
+            )
         except Exception as exception:
-            LOG.error("Failed to get ldap userlist: '%s'", str(exception))
+            LOG.error("Failed to sync ldap userlist: '%s'", str(exception))
+            return
+        LOG.info(
+            "ldap accounts: %d, updated uniqueids: %d",
+            digest.entries,
+            updated_uids,
+        )
+        digest = digest.hexdigest()
+        if digest == self.server.db.get_sync_state(USERLIST_DIGEST_KEY):
+            LOG.info("ldap userlist unchanged since last sync")
+            self.run_retry("no-op", start_sync_time)
+            self.store_ldap_mark(mark)
             return
-        LOG.info("ldap accounts: %s", ldap_accounts)
-        delta_changes = self.server.db.delta(ldap_accounts)
-        actions = self.changes_into_actions(delta_changes)
-        LOG.info("actions to execute: %s", actions)
-        self.execute_actions(actions)
+        delta_changes = self.server.db.delta_changes()
+        executed_actions, failed_actions = self.execute_actions(
+            self.changes_into_actions(delta_changes),
+        )
         # Perform an extra scan over the accounts
-        # It will add all ldaped accounts to LDAP team and prescribed channels
-        # This scan is needed to retry adding accounts to team and channels
-        # if they failed in the past for some reason.
-        self.dma_manager.scan_accounts()
-        LOG.info("done, elapsed=%.2fs", time.time() - start_sync_time)
+        # It will add the ldaped accounts changed since the last scan
+        # to LDAP team and prescribed channels.
+        # A failed scan is not recorded, so its accounts are
+        # scanned again on the next run.
+        self.dma_manager.scan_accounts(full=False)
+        # Only skip the next runs if this one fully succeeded
+        self.server.db.set_sync_state(
+            USERLIST_DIGEST_KEY,
+            digest if not failed_actions else None,
+        )
+        self.store_ldap_mark(mark if not failed_actions else None)
+        self.record_run(
+            "sync",
+            start_sync_time,
+            executed_actions,
+            failed_actions,
+        )
+
+    def run_account_changes(self, changes):
+        """Runs a targeted delta for the given LDAP account changes
+        (see 'ldap_listener.LDAPChangeListener'), a list of dicts with
+        the 'email' of the account, and whether it is 'enabled' on
+        LDAP, or was 'removed' from it.
+        Only local DB accounts present on the LDAP snapshot are updated,
+        the periodic ldap-sync takes care of the rest.
+        Returns False if the changes were not applied: while an
+        ldap-sync runs (so the listener keeps reading its changes),
+        or if the sync is disabled or flow is not ready.
+        """
+        if not self.pre_checks():
+            return False
+        if not self.lock.acquire(False):
+            return False
+        try:
+            start_sync_time = time.time()
+            ldap_accounts = []
+            removed_uniqueids = []
+            for change in changes:
+                account = self.server.db.get_account(change["email"])
+                if not account:
+                    continue
+                if change["removed"]:
+                    removed_uniqueids.append(account["uniqueid"])
+                else:
+                    ldap_accounts.append({
+                        "uniqueid": account["uniqueid"],
+                        "email": account["email"],
+                        "enabled": change["enabled"],
+                    })
+            if not self.server.db.update_snapshot_entries(
+                    ldap_accounts,
+                    removed_uniqueids):
+                return True
+            # The next ldap-sync compares the whole userlist again
+            self.server.db.set_sync_state(USERLIST_DIGEST_KEY, None)
+            executed_actions, failed_actions = self.execute_actions(
+                self.changes_into_actions(self.server.db.delta_changes()),
+            )
+            self.dma_manager.scan_accounts(full=False)
+            self.record_run(
+                "change-feed",
+                start_sync_time,
+                executed_actions,
+                failed_actions,
+            )
+            return True
+        finally:
+            self.lock.release()
+
+    def store_ldap_mark(self, mark):
+        """Stores the high-water mark after a full sync. None (e.g. on
+        the full sync mode) clears it, so the next incremental run
+        is a full sync.
+        """
+        self.incremental_runs = 0
+        self.server.db.set_sync_state(self.ldap_mark_key(), mark)
+
+    def record_run(self,
+                   run_type,
+                   start_sync_time,
+                   executed_actions,
+                   failed_actions):
+        """Records the result of the last run for the sync status."""
+        elapsed = time.time() - start_sync_time
+        self.last_run = {
+            "type": run_type,
+            "elapsed": elapsed,
+            "actions": executed_actions,
+            "failed": failed_actions,
+        }
+        LOG.info(
+            "done (%s), actions=%d, failed=%d, elapsed=%.2fs",
+            run_type,
+            executed_actions,
+            failed_actions,
+            elapsed,
+        )
 
     def check_sync(self):
         """Status check for sync. Returns a string with the result."""
         sync_state = "ON" if self.sync_on.is_set() else "OFF"
         if self.lock.locked():
             sync_state += ", running..."
+        last_run = self.last_run
+        if last_run:
+            sync_state += ", last run: %s in %.2fs " \
+                "(actions=%d, failed=%d)" % (
+                    last_run["type"],
+                    last_run["elapsed"],
+                    last_run["actions"],
+                    last_run["failed"],
+                )
         return sync_state
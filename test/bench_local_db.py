@@ -0,0 +1,340 @@
+#! /usr/bin/env python
+"""
+bench_local_db.py
+
+Benchmarks the local DB sync queries on synthetic LDAP directories.
+Results (wall time, peak RSS and rows/sec of each operation)
+are written as JSON, so storage changes can be compared.
+
+Usage: bench_local_db.py [--sizes 1000,10000] [--output results.json]
+                         [--engine postgresql --dsn "dbname=dma_bench"]
+"""
+import sys
+import os
+import argparse
+import json
+import random
+import shutil
+import sqlite3
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+# flow-ldap root dir
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT_DIR)
+
+from src.db import local_db, pg_db, storage
+
+
+SCHEMA_FILE = os.path.join(
+    ROOT_DIR,
+    "schema/dma.sql",
+)
+PG_SCHEMA_FILE = os.path.join(
+    ROOT_DIR,
+    "schema/dma_pg.sql",
+)
+PG_BENCH_SCHEMA = "dma_bench"
+
+UNLOCK = 0
+LDAP_LOCK = 2
+
+DEFAULT_SIZES = "1000,10000,100000,500000"
+
+
+def peak_rss_kb():
+    """Returns the peak resident set size of the process in KB,
+    or None if not available on this platform.
+    """
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        # bytes on OS X
+        return max_rss / 1024
+    return max_rss
+
+
+def timed(operation, *args):
+    """Runs operation(*args) and returns a tuple with
+    its result and the elapsed wall time.
+    """
+    start_time = time.time()
+    result = operation(*args)
+    return result, time.time() - start_time
+
+
+def op_result(wall_time, rows):
+    """Returns the benchmark result of an operation."""
+    return {
+        "wall_time": wall_time,
+        "rows": rows,
+        "rows_per_sec": rows / wall_time if wall_time else None,
+        "peak_rss_kb": peak_rss_kb(),
+    }
+
+
+def gen_directories(size, options):
+    """Generates the previous and the current LDAP directory
+    of 'size' accounts, the current one with the configured mix
+    of new, disabled and renamed-uniqueid accounts.
+    Returns a tuple with both lists of LDAP entries.
+    """
+    rnd = random.Random(options.seed)
+    new_count = int(size * options.new)
+    previous = [
+        {
+            "uniqueid": "u%07d" % i,
+            "email": "user%07d@example.com" % i,
+            "enabled": 1,
+        }
+        for i in range(size - new_count)
+    ]
+    current = [dict(entry) for entry in previous]
+    for entry in rnd.sample(current, int(size * options.disabled)):
+        entry["enabled"] = 0
+    for entry in rnd.sample(current, int(size * options.renamed)):
+        entry["uniqueid"] = "r" + entry["uniqueid"][1:]
+    current.extend(
+        {
+            "uniqueid": "u%07d" % i,
+            "email": "user%07d@example.com" % i,
+            "enabled": 1,
+        }
+        for i in range(size - new_count, size)
+    )
+    return previous, current
+
+
+def executemany(db_conn, sql, rows):
+    """Runs the 'sql' statement, with '?' placeholders,
+    for each of the rows on either DB engine.
+    """
+    cur = db_conn.cursor()
+    if not isinstance(db_conn, sqlite3.Connection):
+        sql = sql.replace("?", "%s")
+    cur.executemany(sql, rows)
+    cur.close()
+
+
+def populate_db(db_conn, previous, locked):
+    """Writes the accounts of the previous directory,
+    runs on the writer thread. The 'locked' uniqueids
+    are ldap-locked accounts.
+    """
+    executemany(
+        db_conn,
+        """insert into ldap_account (id, uniqueid, email, enabled)
+        values (?, ?, ?, ?)
+        """,
+        (
+            (i + 1, entry["uniqueid"], entry["email"], entry["enabled"])
+            for i, entry in enumerate(previous)
+        ),
+    )
+    executemany(
+        db_conn,
+        """insert into semaphor_account
+        (ldap_account, semaphor_guid, password, L2, lock_state)
+        values (?, ?, ?, ?, ?)
+        """,
+        (
+            (i + 1, None, None, None, LDAP_LOCK)
+            if entry["uniqueid"] in locked else
+            (i + 1, "guid%07d" % i, "PW" * 16, "L2" * 22, UNLOCK)
+            for i, entry in enumerate(previous)
+        ),
+    )
+    return len(previous)
+
+
+def restore_uids(db_conn, renamed):
+    """Restores the uniqueids of the renamed accounts,
+    runs on the writer thread.
+    """
+    executemany(
+        db_conn,
+        "update ldap_account set uniqueid = ? where email = ?",
+        [("u" + entry["uniqueid"][1:], entry["email"]) for entry in renamed],
+    )
+    return len(renamed)
+
+
+def run_delta(db, current):
+    """Runs the delta and reads all its actions.
+    Returns the number of actions of each type.
+    """
+    delta_entries = db.delta(current)
+    return {
+        label: sum(1 for _ in entries)
+        for label, entries in delta_entries.items()
+    }
+
+
+def new_db(size, options, db_dir):
+    """Returns a new empty DB of the benchmarked engine."""
+    if options.engine == storage.ENGINE_SQLITE:
+        return local_db.LocalDB(
+            SCHEMA_FILE,
+            os.path.join(db_dir, "bench-%d.sqlite" % size),
+        )
+    # Each size runs on a new schema of the PostgreSQL server
+    db_conn = pg_db.psycopg2.connect(options.dsn)
+    db_conn.autocommit = True
+    cur = db_conn.cursor()
+    cur.execute("drop schema if exists %s cascade" % PG_BENCH_SCHEMA)
+    cur.execute("create schema %s" % PG_BENCH_SCHEMA)
+    db_conn.close()
+    return pg_db.PostgreSQLDB(
+        PG_SCHEMA_FILE,
+        "%s options='-c search_path=%s'" % (options.dsn, PG_BENCH_SCHEMA),
+    )
+
+
+def bench_size(size, options, db_dir):
+    """Runs the benchmark on a synthetic directory of 'size' accounts."""
+    previous, current = gen_directories(size, options)
+    # Not the gen_directories seed, or the locked accounts
+    # would be the disabled ones
+    rnd = random.Random(options.seed + 1)
+    locked = set(
+        entry["uniqueid"]
+        for entry in rnd.sample(previous, int(size * options.locked))
+    )
+    renamed = [entry for entry in current if entry["uniqueid"][0] == "r"]
+    db = new_db(size, options, db_dir)
+    operations = {}
+    try:
+        # The local DB and the snapshot match the previous directory
+        rows, wall_time = timed(
+            lambda: db.writer.submit(populate_db, previous, locked).result(),
+        )
+        operations["populate"] = op_result(wall_time, rows)
+        db.update_snapshot(previous)
+        db.update_snapshot(previous)
+        # Sync the current directory
+        actions, wall_time = timed(run_delta, db, current)
+        operations["delta"] = op_result(wall_time, len(current))
+        operations["delta"]["actions"] = actions
+        # Run the uniqueid update again, on the renamed accounts
+        db.writer.submit(restore_uids, renamed).result()
+        rows, wall_time = timed(
+            lambda: db.writer.submit(type(db).update_uids).result(),
+        )
+        operations["update_uids"] = op_result(wall_time, rows)
+        accounts, wall_time = timed(db.get_db_accounts)
+        operations["get_db_accounts"] = op_result(wall_time, len(accounts))
+        del accounts
+        ldaped, wall_time = timed(db.get_enabled_ldaped_accounts)
+        operations["get_enabled_ldaped_accounts"] = \
+            op_result(wall_time, len(ldaped))
+        del ldaped
+        db_size = db.get_maintenance_stats()["size"]
+    finally:
+        db.close()
+    return {
+        "accounts": size,
+        "db_size": db_size,
+        "operations": operations,
+    }
+
+
+def parse_args():
+    """Parses the benchmark command line arguments."""
+    parser = argparse.ArgumentParser(
+        description="Benchmarks the local DB on synthetic directories.",
+    )
+    parser.add_argument(
+        "--sizes",
+        default=DEFAULT_SIZES,
+        help="comma separated directory sizes (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--new",
+        type=float,
+        default=0.05,
+        help="fraction of new accounts (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--disabled",
+        type=float,
+        default=0.05,
+        help="fraction of disabled accounts (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--renamed",
+        type=float,
+        default=0.02,
+        help="fraction of accounts with a new uniqueid "
+        "(default: %(default)s)",
+    )
+    parser.add_argument(
+        "--locked",
+        type=float,
+        default=0.05,
+        help="fraction of ldap-locked accounts (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=1,
+        help="random seed of the directory generation",
+    )
+    parser.add_argument(
+        "--engine",
+        choices=(storage.ENGINE_SQLITE, storage.ENGINE_POSTGRESQL),
+        default=storage.ENGINE_SQLITE,
+        help="storage engine (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--dsn",
+        help="PostgreSQL connection string of the postgresql engine",
+    )
+    parser.add_argument(
+        "--output",
+        help="JSON results file (default: stdout)",
+    )
+    options = parser.parse_args()
+    if options.engine == storage.ENGINE_POSTGRESQL and not options.dsn:
+        parser.error("--dsn is required by the postgresql engine")
+    return options
+
+
+def main():
+    options = parse_args()
+    db_dir = tempfile.mkdtemp(prefix="bench_local_db")
+    try:
+        results = [
+            bench_size(int(size), options, db_dir)
+            for size in options.sizes.split(",")
+        ]
+    finally:
+        shutil.rmtree(db_dir)
+    report = json.dumps({
+        "python": sys.version.split()[0],
+        "sqlite": sqlite3.sqlite_version,
+        "engine": options.engine,
+        "mix": {
+            "new": options.new,
+            "disabled": options.disabled,
+            "renamed": options.renamed,
+            "locked": options.locked,
+            "seed": options.seed,
+        },
+        "results": results,
+    }, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, "w") as output_file:
+            output_file.write(report)
+    else:
+        print(report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+#! /usr/bin/env python
+import sys
+import os
+import unittest
+import re
+
+# flow-ldap root dir
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT_DIR)
+
+try:
+    import ldap
+    from src.sync import ldap_changes
+except ImportError:
+    # python-ldap not installed
+    ldap_changes = None
+
+
+class FakeConn(object):
+    """Python-ldap connection answering the change searches."""
+
+    def __init__(self, highest_usn, entries):
+        self.highest_usn = highest_usn
+        # (dn, uSNChanged, modifyTimestamp, group member) tuples
+        self.entries = entries
+        self.searches = []
+
+    def search_ext_s(self, base_dn, scope, filterstr, attrlist, sizelimit=0):
+        self.searches.append((base_dn, filterstr))
+        if base_dn == "":
+            return [("", {"highestCommittedUSN": [str(self.highest_usn)]})]
+        usn = re.search(r"\(uSNChanged>=(\d+)\)", filterstr)
+        timestamp = re.search(r"\(modifyTimestamp>=(\w+)\)", filterstr)
+        results = [
+            (dn, {}) for dn, entry_usn, entry_timestamp, member in self.entries
+            if (dn == base_dn if scope == ldap.SCOPE_BASE else member) and
+            (entry_usn >= int(usn.group(1)) if usn else
+             entry_timestamp > timestamp.group(1))
+        ]
+        if sizelimit and len(results) > sizelimit:
+            raise ldap.SIZELIMIT_EXCEEDED({"desc": "Size limit exceeded"})
+        return results + [(None, ["ldap://other.example.com/dc=other"])]
+
+
+@unittest.skipUnless(ldap_changes, "python-ldap not installed")
+class TestLDAPChanges(unittest.TestCase):
+
+    def test_search_base(self):
+        self.assertEqual(
+            ldap_changes.search_base("", "cn=Team,ou=People,dc=ex,dc=com"),
+            "dc=ex,dc=com",
+        )
+        self.assertEqual(
+            ldap_changes.search_base("ou=People,dc=ex,dc=com", "cn=Team"),
+            "ou=People,dc=ex,dc=com",
+        )
+
+    def test_usn(self):
+        tracker = ldap_changes.get_tracker("AD", "", "cn=Team,dc=ex,dc=com")
+        self.assertIsInstance(tracker, ldap_changes.USNTracker)
+        conn = FakeConn(120, [
+            ("cn=john,dc=ex,dc=com", 110, None, True),
+            # Not a group member
+            ("cn=pc1,dc=ex,dc=com", 118, None, False),
+        ])
+        self.assertEqual(tracker.current_mark(conn), 120)
+        self.assertEqual(tracker.parse_mark(tracker.format_mark(100)), 100)
+        self.assertIsNone(tracker.parse_mark("ts:20260101000000Z"))
+        self.assertIsNone(tracker.parse_mark(None))
+        self.assertEqual(tracker.changed_since(conn, 100), (True, 120))
+        self.assertEqual(tracker.changed_since(conn, 115), (False, 120))
+        # Only the server state is read if the USN did not move
+        searches = len(conn.searches)
+        self.assertEqual(tracker.changed_since(conn, 120), (False, 120))
+        self.assertEqual(len(conn.searches), searches + 1)
+        conn.highest_usn = 130
+        conn.entries.append(("cn=Team,dc=ex,dc=com", 125, None, False))
+        self.assertEqual(tracker.changed_since(conn, 120), (True, 130))
+        # The mark of another domain controller
+        self.assertRaises(
+            ldap_changes.InvalidMark,
+            tracker.changed_since,
+            conn,
+            500,
+        )
+
+    def test_size_limit(self):
+        tracker = ldap_changes.get_tracker("AD", "", "cn=Team,dc=ex,dc=com")
+        conn = FakeConn(200, [
+            ("cn=user%d,dc=ex,dc=com" % i, 150, None, True)
+            for i in range(10)
+        ])
+        self.assertEqual(tracker.changed_since(conn, 100), (True, 200))
+
+    def test_timestamp(self):
+        tracker = ldap_changes.get_tracker("OpenLDAP", "", "cn=Team,dc=ex")
+        self.assertIsInstance(tracker, ldap_changes.TimestampTracker)
+        self.assertEqual(tracker.base_dn, "dc=ex")
+        conn = FakeConn(0, [
+            ("cn=john,dc=ex", 0, "20260101100000Z", True),
+            ("cn=alice,dc=ex", 0, "20260101120000Z", True),
+            ("cn=pc1,dc=ex", 0, "20260101130000Z", False),
+        ])
+        mark = tracker.current_mark(conn)
+        self.assertEqual(tracker.parse_mark(tracker.format_mark(mark)), mark)
+        self.assertIsNone(tracker.parse_mark("ts:yesterday"))
+        changed, new_mark = tracker.changed_since(conn, "20260101000000Z")
+        self.assertTrue(changed)
+        self.assertIsNotNone(tracker.parse_mark(
+            tracker.format_mark(new_mark),
+        ))
+        self.assertEqual(
+            tracker.changed_since(conn, "20260101120000Z"),
+            (False, "20260101120000Z"),
+        )
+
+if __name__ == "__main__":
+    unittest.main()
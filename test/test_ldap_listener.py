@@ -0,0 +1,147 @@
+#! /usr/bin/env python
+import sys
+import os
+import unittest
+
+# flow-ldap root dir
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT_DIR)
+
+try:
+    from src.sync import ldap_listener
+except ImportError:
+    # python-ldap not installed
+    ldap_listener = None
+
+
+class FakeDB(object):
+
+    def __init__(self, emails):
+        self.emails = emails
+
+    def get_account(self, username):
+        if username.lower() not in self.emails:
+            return None
+        return {"email": username.lower()}
+
+
+class FakeLDAPSync(object):
+
+    def __init__(self):
+        self.account_changes = []
+        self.triggered = 0
+        self.running = False
+        self.lock = self
+
+    def locked(self):
+        return self.running
+
+    def run_account_changes(self, changes):
+        if self.running:
+            return False
+        self.account_changes.extend(changes)
+        return True
+
+    def trigger_sync(self):
+        self.triggered += 1
+
+
+class FakeServer(object):
+
+    def __init__(self, config, emails):
+        self.config = config
+        self.db = FakeDB(emails)
+        self.ldap_sync = FakeLDAPSync()
+        self.ldap_factory = None
+
+
+@unittest.skipUnless(ldap_listener, "python-ldap not installed")
+class TestLDAPChangeListener(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeServer(
+            {"group-dn": "CN=Team, OU=People,DC=ex,DC=com"},
+            ["john@ex.com", "alice@ex.com"],
+        )
+        self.listener = ldap_listener.LDAPChangeListener(self.server)
+        self.listener.username_source = "userPrincipalName"
+        self.listener.group_dn = ldap_listener.normalize_dn(
+            self.server.config["group-dn"],
+        )
+
+    def test_account_changes(self):
+        self.listener.entry_changed("cn=John,dc=ex,dc=com", {
+            "userPrincipalName": ["John@ex.com"],
+            "userAccountControl": ["514"],
+        })
+        self.listener.entry_changed("cn=Alice,dc=ex,dc=com", {
+            "userPrincipalName": ["alice@ex.com"],
+        }, deleted=True)
+        # Not on the local DB, or not an account
+        self.listener.entry_changed("cn=Neil,dc=ex,dc=com", {
+            "userPrincipalName": ["neil@ex.com"],
+            "userAccountControl": ["512"],
+        })
+        self.listener.entry_changed("cn=PC1,dc=ex,dc=com", {})
+        self.listener.apply_changes()
+        self.assertEqual(self.server.ldap_sync.account_changes, [
+            {"email": "John@ex.com", "enabled": False, "removed": False},
+            {"email": "alice@ex.com", "enabled": None, "removed": True},
+        ])
+        self.assertEqual(self.listener.changes, 2)
+        self.assertIsNone(self.listener.sync_requested)
+
+    def test_sync_running(self):
+        self.server.ldap_sync.running = True
+        self.listener.entry_changed("cn=John,dc=ex,dc=com", {
+            "userPrincipalName": ["john@ex.com"],
+            "userAccountControl": ["514"],
+        })
+        self.listener.apply_changes()
+        self.assertEqual(self.server.ldap_sync.account_changes, [])
+        self.assertIsNotNone(self.listener.sync_requested)
+        # The sync runs once the running one finished
+        self.listener.sync_requested -= ldap_listener.SYNC_REQUEST_DELAY
+        self.listener.apply_changes()
+        self.assertEqual(self.server.ldap_sync.triggered, 0)
+        self.server.ldap_sync.running = False
+        self.listener.apply_changes()
+        self.assertEqual(self.server.ldap_sync.triggered, 1)
+
+    def test_sync_requests(self):
+        # Account changes of non AD servers
+        self.listener.entry_changed("cn=John,dc=ex,dc=com", {
+            "userPrincipalName": ["john@ex.com"],
+        })
+        self.assertIsNotNone(self.listener.sync_requested)
+        self.listener.apply_changes()
+        self.assertEqual(self.server.ldap_sync.triggered, 0)
+        self.listener.sync_requested -= ldap_listener.SYNC_REQUEST_DELAY
+        self.listener.apply_changes()
+        self.assertEqual(self.server.ldap_sync.triggered, 1)
+        self.assertIsNone(self.listener.sync_requested)
+        # Group membership changes
+        self.listener.entry_changed("cn=team,ou=people,dc=ex,dc=com", {
+            "member": ["cn=John,dc=ex,dc=com"],
+        })
+        self.assertIsNotNone(self.listener.sync_requested)
+        self.assertEqual(self.server.ldap_sync.account_changes, [])
+
+    def test_feed_class(self):
+        self.assertIs(
+            ldap_listener.get_feed_class("AD"),
+            ldap_listener.NotificationFeed,
+        )
+        self.assertIs(
+            ldap_listener.get_feed_class("OpenLDAP"),
+            ldap_listener.SyncreplFeed,
+        )
+        self.assertIs(
+            ldap_listener.get_feed_class("RHDS"),
+            ldap_listener.PersistentSearchFeed,
+        )
+        self.assertEqual(self.listener.check_listener(), "OFF")
+
+
+if __name__ == "__main__":
+    unittest.main()
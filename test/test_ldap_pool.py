@@ -0,0 +1,215 @@
+#! /usr/bin/env python
+import sys
+import os
+import unittest
+import threading
+
+# flow-ldap root dir
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT_DIR)
+
+from src import ldap_pool
+
+
+class FakeConn(object):
+    """Python-ldap connection with a 'Who am I?' request."""
+
+    def __init__(self):
+        self.alive = True
+        self.bound_user = "u:service"
+
+    def simple_bind_s(self, user, password):
+        if not self.alive:
+            raise Exception("Can't contact LDAP server")
+        self.bound_user = "u:%s" % user
+
+    def whoami_s(self):
+        if not self.alive:
+            raise Exception("Can't contact LDAP server")
+        return "u:service"
+
+
+class FakeGroup(object):
+
+    def __init__(self, conn, group_dn):
+        self.conn = conn
+        self.dn = group_dn
+
+    def userlist(self):
+        if not self.conn.alive:
+            raise Exception("Can't contact LDAP server")
+        return [{"email": "john@example.com"}]
+
+    def iter_userlist(self):
+        yield {"email": "john@example.com"}
+        if not self.conn.alive:
+            raise Exception("Can't contact LDAP server")
+
+
+class FakeLdapConnection(object):
+
+    def __init__(self, number):
+        self.number = number
+        self.conn = FakeConn()
+        self.closed = False
+
+    def get_group(self, group_dn):
+        if not self.conn.alive:
+            raise Exception("Can't contact LDAP server")
+        return FakeGroup(self.conn, group_dn)
+
+    def can_auth(self, username, password):
+        self.conn.bound_user = "u:%s" % username
+        return password == "secret"
+
+    def close(self):
+        self.closed = True
+
+
+class TestLDAPConnectionPool(unittest.TestCase):
+
+    def setUp(self):
+        self.connections = []
+        self.pool = ldap_pool.LDAPConnectionPool(
+            self.connect,
+            self.rebind,
+            2,
+            300,
+        )
+
+    def connect(self, timeout):
+        ldap_conn = FakeLdapConnection(len(self.connections))
+        self.connections.append(ldap_conn)
+        return ldap_conn
+
+    def rebind(self, ldap_conn):
+        ldap_conn.conn.simple_bind_s("service", "pw")
+
+    def test_reuse(self):
+        ldap_conn = self.pool.get(5)
+        self.assertEqual(ldap_conn.get_group("cn=group").dn, "cn=group")
+        ldap_conn.close()
+        ldap_conn.close()
+        ldap_conn = self.pool.get(5)
+        self.assertEqual(ldap_conn.ldap_conn.number, 0)
+        ldap_conn.close()
+        stats = self.pool.get_stats()
+        self.assertEqual(stats["hits"], 1)
+        self.assertEqual(stats["misses"], 1)
+        self.assertEqual(stats["hit_rate"], 0.5)
+        self.assertEqual(stats["idle"], 1)
+        self.assertEqual(stats["in_use"], 0)
+
+    def test_user_bind(self):
+        # Bound with the service account again after a user bind
+        ldap_conn = self.pool.get(5)
+        self.assertTrue(ldap_conn.can_auth("john@example.com", "secret"))
+        self.assertEqual(ldap_conn.ldap_conn.conn.bound_user, "u:service")
+        ldap_conn.close()
+        self.assertEqual(self.pool.get_stats()["idle"], 1)
+        # Not reused if the service account bind fails
+        ldap_conn = self.pool.get(5)
+        self.assertEqual(ldap_conn.ldap_conn.number, 0)
+        ldap_conn.ldap_conn.conn.alive = False
+        self.assertFalse(ldap_conn.can_auth("john@example.com", "wrong"))
+        ldap_conn.close()
+        self.assertTrue(self.connections[0].closed)
+
+    def test_not_reusable(self):
+        # Failed connections are not reused
+        ldap_conn = self.pool.get(5)
+        ldap_conn.ldap_conn.conn.alive = False
+        self.assertRaises(Exception, ldap_conn.get_group, "cn=group")
+        ldap_conn.close()
+        self.assertEqual(len(self.connections), 1)
+        self.assertTrue(self.connections[0].closed)
+        stats = self.pool.get_stats()
+        self.assertEqual(stats["discarded"], 1)
+        self.assertEqual(stats["idle"] + stats["in_use"], 0)
+
+    def test_group_errors(self):
+        # Failed searches of the group make the connection not reusable
+        for method in ("userlist", "iter_userlist"):
+            ldap_conn = self.pool.get(5)
+            group = ldap_conn.get_group("cn=group")
+            self.assertEqual(
+                list(getattr(group, method)()),
+                [{"email": "john@example.com"}],
+            )
+            self.assertTrue(ldap_conn.reusable)
+            ldap_conn.ldap_conn.conn.alive = False
+            self.assertRaises(
+                Exception,
+                lambda: list(getattr(group, method)()),
+            )
+            self.assertFalse(ldap_conn.reusable)
+            ldap_conn.close()
+        self.assertEqual(self.pool.get_stats()["discarded"], 2)
+
+    def test_overflow(self):
+        connections = [self.pool.get(5), self.pool.get(5)]
+        # Over the pool size, without waiting
+        overflow_conn = self.pool.get(5, overflow=True)
+        self.assertEqual(self.pool.get_stats()["overflows"], 1)
+        self.assertEqual(self.pool.get_stats()["waits"], 0)
+        overflow_conn.close()
+        self.assertTrue(overflow_conn.ldap_conn.closed)
+        for ldap_conn in connections:
+            ldap_conn.close()
+        stats = self.pool.get_stats()
+        self.assertEqual(stats["idle"], 2)
+        self.assertEqual(stats["in_use"], 0)
+
+    def test_liveness_check(self):
+        ldap_conn = self.pool.get(5)
+        ldap_conn.close()
+        ldap_conn.last_used -= ldap_pool.LIVENESS_CHECK_IDLE + 1
+        ldap_conn.ldap_conn.conn.alive = False
+        ldap_conn = self.pool.get(5)
+        self.assertEqual(ldap_conn.ldap_conn.number, 1)
+        self.assertTrue(self.connections[0].closed)
+        ldap_conn.close()
+        self.assertEqual(self.pool.get_stats()["idle"], 1)
+
+    def test_idle_eviction(self):
+        first_conn = self.pool.get(5)
+        second_conn = self.pool.get(5)
+        first_conn.close()
+        second_conn.close()
+        first_conn.last_used -= 301
+        ldap_conn = self.pool.get(5)
+        self.assertIs(ldap_conn, second_conn)
+        self.assertTrue(self.connections[0].closed)
+        self.assertEqual(self.pool.get_stats()["idle"], 0)
+        ldap_conn.close()
+
+    def test_wait(self):
+        connections = [self.pool.get(5), self.pool.get(5)]
+        threading.Timer(0.1, connections[0].close).start()
+        ldap_conn = self.pool.get(5)
+        self.assertIs(ldap_conn, connections[0])
+        stats = self.pool.get_stats()
+        self.assertEqual(stats["waits"], 1)
+        self.assertTrue(stats["max_wait_ms"] >= 50)
+        self.assertEqual(stats["in_use"], 2)
+
+    def test_drain(self):
+        idle_conn = self.pool.get(5)
+        in_use_conn = self.pool.get(5)
+        idle_conn.close()
+        self.pool.drain(1, 60)
+        self.assertTrue(self.connections[0].closed)
+        # Connections of the previous config are not reused
+        in_use_conn.close()
+        self.assertTrue(self.connections[1].closed)
+        ldap_conn = self.pool.get(5)
+        self.assertEqual(ldap_conn.ldap_conn.number, 2)
+        ldap_conn.close()
+        stats = self.pool.get_stats()
+        self.assertEqual(stats["size"], 1)
+        self.assertEqual(stats["idle"], 1)
+        self.assertEqual(stats["in_use"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
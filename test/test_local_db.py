@@ -4,6 +4,7 @@ import os
 import unittest
 import random
 import string
+import time
 
 import sqlite3
 
@@ -11,7 +12,7 @@ import sqlite3
 ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.append(ROOT_DIR)
 
-from src.db import local_db
+from src.db import local_db, migrations, storage
 
 
 SCHEMA_FILE = os.path.join(
@@ -72,6 +73,19 @@ class TestLocalDB(unittest.TestCase):
         db_conn.commit()
         db_conn.close()
 
+    def run_delta(self, ldap_entries):
+        delta_entries = self.db.delta(ldap_entries)
+        return {
+            label: list(entries)
+            for label, entries in delta_entries.items()
+        }
+
+    def run_delta_changes(self):
+        return {
+            label: list(entries)
+            for label, entries in self.db.delta_changes().items()
+        }
+
     def test_entries_to_setup(self):
         # This is what comes from LDAP
         ldap_entries = [
@@ -93,7 +107,7 @@ class TestLocalDB(unittest.TestCase):
             ("4", "back@example.com", True, UNLOCK),
         ])
         # Run the delta
-        delta_entries = self.db.delta(ldap_entries)
+        delta_entries = self.run_delta(ldap_entries)
         self.assertFalse(delta_entries["retry_setup"])
         self.assertFalse(delta_entries["update_lock"])
         setup = delta_entries["setup"]
@@ -128,7 +142,7 @@ class TestLocalDB(unittest.TestCase):
             ("4", "back@example.com", True, LDAP_LOCK),
         ])
         # Run the delta
-        delta_entries = self.db.delta(ldap_entries)
+        delta_entries = self.run_delta(ldap_entries)
         self.assertFalse(delta_entries["setup"])
         self.assertEqual(len(delta_entries["update_lock"]), 1)
         retry = delta_entries["retry_setup"]
@@ -186,7 +200,7 @@ class TestLocalDB(unittest.TestCase):
             ("10", "enable@example.com", False, LDAP_LOCK),
         ])
         # Run the delta
-        delta_entries = self.db.delta(ldap_entries)
+        delta_entries = self.run_delta(ldap_entries)
         self.assertFalse(delta_entries["setup"])
         self.assertEqual(len(delta_entries["retry_setup"]), 1)
         update_lock = delta_entries["update_lock"]
@@ -205,8 +219,543 @@ class TestLocalDB(unittest.TestCase):
         self.assertEqual(update_lock[5]["email"], "other@example.com")  # (6)
         self.assertEqual(update_lock[5]["enabled"], 0)
 
-    def tearDown(self):
+    def test_snapshot_changes_only(self):
+        ldap_entries = [
+            {"uniqueid": "1", "email": "john@example.com", "enabled": 1},
+            {"uniqueid": "2", "email": "alice@example.com", "enabled": 1},
+        ]
+        self.create_account_db_entries([
+            ("1", "john@example.com", True, UNLOCK),
+            ("3", "carl@example.com", True, UNLOCK),
+        ])
+        delta_entries = self.run_delta(ldap_entries)
+        self.assertEqual(len(delta_entries["setup"]), 1)
+        self.assertEqual(len(delta_entries["update_lock"]), 1)
+        # Nothing changed on LDAP, so nothing to write on the snapshot
+        self.assertFalse(self.db.snapshot_changes(ldap_entries))
+        # Actions were not executed, so they are computed again
+        delta_entries = self.run_delta(ldap_entries)
+        self.assertEqual(len(delta_entries["setup"]), 1)
+        self.assertEqual(len(delta_entries["update_lock"]), 1)
+        # Execute actions
+        self.create_account_db_entries([
+            ("2", "alice@example.com", True, UNLOCK),
+        ])
+        self.db.update_lock(delta_entries["update_lock"][0])
+        delta_entries = self.run_delta(ldap_entries)
+        self.assertFalse(delta_entries["setup"])
+        self.assertFalse(delta_entries["update_lock"])
+        # Alice is disabled on LDAP
+        ldap_entries[1]["enabled"] = 0
+        self.assertEqual(len(self.db.snapshot_changes(ldap_entries)), 1)
+        delta_entries = self.run_delta(ldap_entries)
+        self.assertEqual(len(delta_entries["update_lock"]), 1)
+        self.assertEqual(
+            delta_entries["update_lock"][0]["email"],
+            "alice@example.com",
+        )
+
+    def test_snapshot_pages(self):
+        ldap_entries = [
+            {"uniqueid": str(i),
+             "email": "user%d@example.com" % i,
+             "enabled": 1}
+            for i in range(10)
+        ]
+        self.create_account_db_entries(
+            [
+                (entry["uniqueid"], entry["email"], True, UNLOCK)
+                for entry in ldap_entries
+            ] + [("10", "gone@example.com", True, UNLOCK)],
+        )
+        self.db.update_snapshot(iter(ldap_entries), page_size=3)
+        delta_entries = self.run_delta_changes()
+        self.assertFalse(delta_entries["setup"])
+        # Only the account not read from LDAP is locked
+        update_lock = delta_entries["update_lock"]
+        self.assertEqual(
+            [entry["email"] for entry in update_lock],
+            ["gone@example.com"],
+        )
+        self.db.update_lock(update_lock[0])
+
+        def failing_entries():
+            for ldap_entry in ldap_entries[:4]:
+                yield ldap_entry
+            raise Exception("Can't contact LDAP server")
+        # Entries are not marked as removed if reading LDAP fails
+        self.assertRaises(
+            Exception,
+            self.db.update_snapshot,
+            failing_entries(),
+            page_size=3,
+        )
+        self.assertFalse(self.run_delta_changes()["update_lock"])
+        self.db.update_snapshot(iter(ldap_entries[:4]), page_size=3)
+        self.assertEqual(len(self.run_delta_changes()["update_lock"]), 6)
+
+    def test_delta_streaming(self):
+        ldap_entries = [
+            {"uniqueid": str(i),
+             "email": "user%d@example.com" % i,
+             "enabled": 1}
+            for i in range(local_db.DELTA_FETCH_SIZE * 2 + 1)
+        ]
+        delta_entries = self.db.delta(ldap_entries)
+        setup = delta_entries["setup"]
+        # Rows are read lazily, not materialized as a list
+        self.assertFalse(isinstance(setup, list))
+        self.assertEqual(next(setup)["email"], "user0@example.com")
+        self.assertEqual(len(list(setup)), len(ldap_entries) - 1)
+        self.assertFalse(list(delta_entries["update_lock"]))
+
+    def test_update_uids(self):
+        ldap_entries = [
+            {"uniqueid": "11", "email": "john@example.com", "enabled": 1},
+            {"uniqueid": "12", "email": "alice@example.com", "enabled": 1},
+            {"uniqueid": "3", "email": "carl@example.com", "enabled": 1},
+        ]
+        self.create_account_db_entries([
+            ("1", "john@example.com", True, UNLOCK),
+            ("2", "alice@example.com", True, UNLOCK),
+            ("3", "carl@example.com", True, UNLOCK),
+        ])
+        self.assertEqual(
+            self.db.get_account("alice@example.com")["uniqueid"],
+            "2",
+        )
+        self.assertEqual(self.db.update_snapshot(ldap_entries), 2)
+        accounts = self.db.get_db_accounts()
+        self.assertEqual(
+            sorted(account["uniqueid"] for account in accounts),
+            ["11", "12", "3"],
+        )
+        self.assertEqual(
+            self.db.get_account("alice@example.com")["uniqueid"],
+            "12",
+        )
+        # Nothing else to update
+        self.assertEqual(self.db.update_snapshot(ldap_entries), 0)
+
+    def test_db_accounts_pages(self):
+        self.create_account_db_entries([
+            ("1", "john@example.com", True, UNLOCK),
+            ("2", "Alice@example.com", True, LDAP_LOCK),
+            ("3", "carl@example.com", False, FULL_LOCK),
+            ("4", "bob@example.com", True, UNLOCK),
+            ("5", "dave@example.com", True, LDAP_LOCK),
+        ])
+        emails = []
+        after = None
+        while True:
+            accounts = self.db.get_db_accounts(limit=2, after=after)
+            emails.extend(account["email"] for account in accounts)
+            if len(accounts) < 2:
+                break
+            after = accounts[-1]["email"]
+        self.assertEqual(emails, [
+            "Alice@example.com",
+            "bob@example.com",
+            "carl@example.com",
+            "dave@example.com",
+            "john@example.com",
+        ])
+        accounts = self.db.get_db_accounts(
+            after="alice@example.com",
+            lock_state=LDAP_LOCK,
+        )
+        self.assertEqual(
+            [account["email"] for account in accounts],
+            ["dave@example.com"],
+        )
+        accounts = self.db.get_db_accounts(limit=1, enabled=False)
+        self.assertEqual(len(accounts), 1)
+        self.assertEqual(accounts[0]["email"], "carl@example.com")
+        accounts = self.db.get_db_accounts(
+            after="bob@example.com",
+            enabled=True,
+        )
+        self.assertEqual(
+            [account["email"] for account in accounts],
+            ["dave@example.com", "john@example.com"],
+        )
+        # Streamed listing, with row tuples
+        rows = list(self.db.iter_db_accounts(enabled=True))
+        self.assertEqual(rows[0], ("Alice@example.com", "2", 1, None, 2))
+        self.assertEqual(
+            [dict(zip(storage.DB_ACCOUNT_COLUMNS, row)) for row in rows],
+            self.db.get_db_accounts(enabled=True),
+        )
+
+    def test_account_cache(self):
+        # Unknown accounts are cached as negative entries
+        self.assertIsNone(self.db.get_account("john@example.com"))
+        self.assertIsNone(self.db.get_account("John@Example.com"))
+        cache_stats = self.db.account_cache.get_stats()
+        self.assertEqual(cache_stats["hits"], 1)
+        # Writes invalidate the cached account
+        self.create_account_db_entries([
+            ("1", "john@example.com", True, UNLOCK),
+        ])
+        account = self.db.get_account("john@example.com")
+        self.assertEqual(account["uniqueid"], "1")
+        self.assertEqual(account["lock_state"], UNLOCK)
+        # Only the updated account is invalidated, by its local DB email
+        self.db.get_account("carl@example.com")
+        self.assertEqual(self.db.update_lock({
+            "uniqueid": "1",
+            "email": "john.renamed@example.com",
+            "enabled": 0,
+            "lock_state": UNLOCK,
+        }), "john@example.com")
+        account = self.db.get_account("JOHN@example.com")
+        self.assertFalse(account["enabled"])
+        self.assertEqual(account["lock_state"], FULL_LOCK)
+        hits = self.db.account_cache.get_stats()["hits"]
+        self.db.get_account("carl@example.com")
+        self.assertEqual(self.db.account_cache.get_stats()["hits"], hits + 1)
+        # Callers cannot modify the cached account
+        account["enabled"] = 1
+        self.assertFalse(self.db.get_account("john@example.com")["enabled"])
+
+    def test_write_future_callbacks(self):
+        # Waiters wake up after the done callbacks ran
+        future = local_db.WriteFuture()
+        called = []
+        future.add_done_callback(
+            lambda done_future: called.append(done_future.done.is_set()),
+        )
+        future.set_result(True)
+        self.assertTrue(future.result())
+        self.assertEqual(called, [False])
+        # Called right away once the write is done
+        future.add_done_callback(lambda _: called.append(True))
+        self.assertEqual(called, [False, True])
+
+    def test_sync_state(self):
+        self.assertIsNone(self.db.get_sync_state("userlist-digest"))
+        self.db.set_sync_state("userlist-digest", "abc")
+        self.assertEqual(self.db.get_sync_state("userlist-digest"), "abc")
+        self.db.set_sync_state("userlist-digest", None)
+        self.assertIsNone(self.db.get_sync_state("userlist-digest"))
+
+    def test_account_changes(self):
+        guid = self.gen_sem_guid()
+        self.db.create_account(
+            {"uniqueid": "1", "email": "john@example.com", "enabled": 1},
+            {"id": guid, "lock_state": UNLOCK},
+        )
+        self.db.create_account(
+            {"uniqueid": "2", "email": "carl@example.com", "enabled": 1},
+            {"lock_state": LDAP_LOCK},
+        )
+        changes = self.db.get_account_changes(0)
+        self.assertEqual(
+            [(change["change"], change["email"]) for change in changes],
+            [("created", "john@example.com"), ("created", "carl@example.com")],
+        )
+        self.assertEqual(changes[0]["semaphor_guid"], guid)
+        seq = self.db.get_account_change_seq()
+        self.assertEqual(seq, 2)
+        self.assertEqual(self.db.get_account_changes(seq), [])
+        # carl joins: unlocked and linked to a semaphor account
+        carl_guid = self.gen_sem_guid()
+        self.db.update_semaphor_account("carl@example.com", {
+            "id": carl_guid,
+            "password": self.PASSWORD,
+            "L2": self.L2,
+            "lock_state": UNLOCK,
+        })
+        # john is disabled (not logged) and enabled again
+        for enabled in (0, 1):
+            self.db.update_lock({
+                "uniqueid": "1",
+                "enabled": enabled,
+                "lock_state": UNLOCK,
+            })
+        changes = self.db.get_account_changes(seq)
+        self.assertEqual(
+            sorted((change["change"], change["email"]) for change in changes),
+            [
+                ("reenabled", "john@example.com"),
+                ("relinked", "carl@example.com"),
+                ("unlocked", "carl@example.com"),
+                ("unlocked", "john@example.com"),
+            ],
+        )
+        self.assertEqual(
+            [change["seq"] for change in changes],
+            range(seq + 1, seq + 5),
+        )
+        self.assertEqual(changes[0]["semaphor_guid"], carl_guid)
+        # Pruned changes are no longer available
+        last_seq = self.db.get_account_change_seq()
+        self.assertEqual(
+            self.db.writer.submit(
+                self.db._prune_account_changes,
+                time.time() + 1,
+            ).result(),
+            6,
+        )
+        self.assertIsNone(self.db.get_account_changes(seq))
+        self.assertEqual(self.db.get_account_changes(last_seq), [])
+        self.assertEqual(self.db.get_account_change_seq(), last_seq)
+
+    def test_connection_reuse(self):
+        db_conn = self.db._get_connection()
+        journal_mode = db_conn.execute("pragma journal_mode").fetchone()[0]
+        self.assertEqual(journal_mode, "wal")
+        self.create_account_db_entries([
+            ("1", "john@example.com", True, UNLOCK),
+            ("2", "alice@example.com", True, UNLOCK),
+        ])
+        self.db.get_account("john@example.com")
+        self.db.get_db_accounts()
+        # All operations on this thread share the same connection
+        self.assertIs(self.db._get_connection(), db_conn)
+        conn_stats = self.db.get_connection_stats()
+        self.assertEqual(conn_stats["opened"], 1)
+        self.assertTrue(conn_stats["reused"] >= 3)
+
+    def test_group_commit(self):
+        self.create_account_db_entries([
+            ("1", "john@example.com", True, UNLOCK),
+        ])
+        writes = [
+            self.db.submit_create_account(
+                {"uniqueid": str(i),
+                 "email": "user%d@example.com" % i,
+                 "enabled": 1},
+                {"id": self.gen_sem_guid(),
+                 "lock_state": UNLOCK},
+            )
+            for i in range(2, 102)
+        ]
+        # Duplicate uniqueid, only this write should fail
+        failed_write = self.db.submit_create_account(
+            {"uniqueid": "1", "email": "other@example.com", "enabled": 1},
+            {"lock_state": LDAP_LOCK},
+        )
+        for write in writes:
+            self.assertTrue(write.result())
+        self.assertRaises(sqlite3.IntegrityError, failed_write.result)
+        self.assertEqual(len(self.db.get_db_accounts()), 101)
+        write_stats = self.db.writer.get_write_stats()
+        self.assertEqual(write_stats["writes"], 102)
+        self.assertTrue(write_stats["commits"] < write_stats["writes"])
+
+    def test_schema_migrations(self):
+        db_conn = self.db._get_connection()
+        self.assertEqual(
+            migrations.schema_version(db_conn),
+            migrations.SCHEMA_VERSION,
+        )
+        indexes = [
+            row[0] for row in db_conn.execute(
+                "select name from sqlite_master where type = 'index'",
+            )
+        ]
+        self.assertIn("ix_semaphor_account_lock_state", indexes)
+        self.assertIn("ix_ldap_account_enabled", indexes)
+        # Schema is current, the schema file is not needed anymore
+        self.db.close()
+        self.db = local_db.LocalDB("no-such-schema.sql", self.db_file)
+
+    def test_schema_migrations_legacy_db(self):
+        self.db.close()
         os.remove(self.db_file)
+        # DB created before migrations existed
+        db_conn = sqlite3.connect(self.db_file)
+        with open(SCHEMA_FILE, "r") as schema_file:
+            db_conn.executescript(schema_file.read())
+        db_conn.execute(
+            "insert into ldap_account (id, uniqueid, email, enabled) "
+            "values (7, '1', 'john@example.com', 1)",
+        )
+        db_conn.execute(
+            "insert into semaphor_account (ldap_account, lock_state) "
+            "values (7, %d)" % FULL_LOCK,
+        )
+        db_conn.commit()
+        db_conn.close()
+        self.db = local_db.LocalDB(SCHEMA_FILE, self.db_file)
+        account = self.db.get_account("john@example.com")
+        self.assertEqual(account["uniqueid"], "1")
+        self.assertEqual(account["lock_state"], FULL_LOCK)
+        self.assertEqual(
+            migrations.schema_version(self.db._get_connection()),
+            migrations.SCHEMA_VERSION,
+        )
+
+    def test_changeset_backup(self):
+        ldap_entries = [
+            {"uniqueid": "1", "email": "john@example.com", "enabled": 1},
+            {"uniqueid": "2", "email": "alice@example.com", "enabled": 1},
+        ]
+        self.create_account_db_entries([
+            ("1", "john@example.com", True, UNLOCK),
+            ("2", "alice@example.com", True, UNLOCK),
+        ])
+        self.db.update_snapshot(ldap_entries)
+        # Collects the query planner statistics
+        self.db.run_maintenance(step_sleep=0)
+        self.assertEqual(self.db.get_backup_progress(), None)
+        backup_filename, change_seq = self.db.run_backup(step_rows=1)
+        self.assertTrue(local_db.is_full_backup(backup_filename))
+        backup_progress = self.db.get_backup_progress()
+        self.assertFalse(backup_progress["running"])
+        # 2 ldap_account + 2 semaphor_account + 2 ldap_snapshot rows
+        self.assertEqual(backup_progress["rows"], 6)
+        self.assertEqual(backup_progress["total_rows"], 6)
+        self.db.commit_backup(change_seq)
+        # No changes since the full backup
+        self.assertEqual(self.db.run_changeset_backup(), (None, 0))
+        # Alice is disabled and gets a new uniqueid, carl is new
+        ldap_entries[1] = {
+            "uniqueid": "3", "email": "alice@example.com", "enabled": 0,
+        }
+        ldap_entries.append(
+            {"uniqueid": "4", "email": "carl@example.com", "enabled": 1},
+        )
+        update_lock = self.run_delta(ldap_entries)["update_lock"]
+        self.assertEqual(len(update_lock), 1)
+        self.db.update_lock(update_lock[0])
+        self.create_account_db_entries([
+            ("4", "carl@example.com", True, LDAP_LOCK),
+        ])
+        changeset_filename, change_seq = self.db.run_changeset_backup()
+        self.assertFalse(local_db.is_full_backup(changeset_filename))
+        self.db.commit_backup(change_seq)
+        self.assertEqual(self.db.run_changeset_backup(), (None, 0))
+        accounts = self.db.get_db_accounts()
+        # Restore on an empty DB
+        self.db.close()
+        os.remove(self.db_file)
+        self.db = local_db.LocalDB(SCHEMA_FILE, self.db_file)
+        self.db.restore_backup(backup_filename, [changeset_filename])
+        self.assertEqual(self.db.get_db_accounts(), accounts)
+        # The query planner statistics were restored
+        self.assertTrue(self.db._get_connection().execute(
+            "select count(*) from sqlite_stat1",
+        ).fetchone()[0])
+        # Restored changes are not tracked
+        self.assertEqual(self.db.run_changeset_backup(), (None, 0))
+        # The snapshot was restored too
+        delta_entries = self.run_delta(ldap_entries)
+        self.assertFalse(delta_entries["setup"])
+        self.assertFalse(delta_entries["update_lock"])
+
+    def test_export_import(self):
+        ldap_entries = [
+            {"uniqueid": "1", "email": "john@example.com", "enabled": 1},
+            {"uniqueid": "2", "email": "alice@example.com", "enabled": 0},
+            {"uniqueid": "3", "email": "carl@example.com", "enabled": 1},
+        ]
+        self.create_account_db_entries([
+            ("1", "john@example.com", True, UNLOCK),
+            ("2", "alice@example.com", False, FULL_LOCK),
+            ("3", "carl@example.com", True, LDAP_LOCK),
+        ])
+        self.db.update_snapshot(ldap_entries)
+        export_filename = self.db_file + local_db.EXPORT_FILENAME_SUFFIX
+        self.assertEqual(self.db.export_db(export_filename), 3)
+        accounts = self.db.get_db_accounts()
+        # The DB must have no accounts
+        self.assertRaises(Exception, self.db.import_db, export_filename)
+        # Import on an empty DB
+        self.db.close()
+        os.remove(self.db_file)
+        self.db = local_db.LocalDB(SCHEMA_FILE, self.db_file)
+        self.assertEqual(
+            self.db.import_db(export_filename, chunk_size=2),
+            3,
+        )
+        self.assertEqual(self.db.get_db_accounts(), accounts)
+        # Imported rows are tracked for the incremental backups:
+        # 3 ldap_account + 3 semaphor_account + 3 ldap_snapshot rows
+        changeset_filename, _ = self.db.run_changeset_backup()
+        with open(changeset_filename, "r") as changeset_file:
+            self.assertEqual(len(changeset_file.readlines()), 1 + 9)
+        # The snapshot was seeded from the imported accounts
+        delta_entries = self.run_delta(ldap_entries)
+        self.assertFalse(delta_entries["setup"])
+        self.assertFalse(delta_entries["update_lock"])
+
+    def test_query_stats(self):
+        self.create_account_db_entries([
+            ("1", "john@example.com", True, UNLOCK),
+        ])
+        self.run_delta([
+            {"uniqueid": "1", "email": "john@example.com", "enabled": 0},
+        ])
+        self.db.get_account("john@example.com")
+        self.db.get_account("john@example.com")
+        stats = self.db.query_stats.get_stats()
+        # The second get_account is served from the cache
+        self.assertEqual(stats["get_account"]["count"], 2)
+        self.assertEqual(stats["read_account"]["count"], 1)
+        # Writes are named after their function
+        self.assertEqual(stats["create_account"]["count"], 1)
+        self.assertEqual(stats["update_snapshot"]["count"], 1)
+        self.assertEqual(stats["entries_to_update_lock"]["count"], 1)
+        histogram = stats["entries_to_update_lock"]["histogram"]
+        self.assertEqual(sum(count for _, count in histogram), 1)
+        self.assertTrue(
+            stats["get_account"]["max_ms"] <=
+            stats["get_account"]["total_ms"],
+        )
+
+    def test_maintenance(self):
+        self.db.update_snapshot([
+            {"uniqueid": str(i), "email": "user%d@example.com" % i,
+             "enabled": 1}
+            for i in range(2000)
+        ])
+        db_conn = sqlite3.connect(self.db_file)
+        db_conn.execute("delete from ldap_snapshot")
+        db_conn.commit()
+        free_pages = db_conn.execute("pragma freelist_count").fetchone()[0]
+        self.assertTrue(free_pages > 0)
+        self.assertEqual(
+            self.db.get_maintenance_stats()["free_pages"],
+            free_pages,
+        )
+        freed_pages = self.db.run_maintenance(vacuum_pages=4, step_sleep=0)
+        # ANALYZE may reuse some free pages for its statistics
+        self.assertTrue(0 < freed_pages <= free_pages)
+        maintenance_stats = self.db.get_maintenance_stats()
+        self.assertEqual(maintenance_stats["free_pages"], 0)
+        self.assertEqual(maintenance_stats["freed_pages"], freed_pages)
+        self.assertFalse(maintenance_stats["running"])
+        # Planner statistics were collected
+        self.assertTrue(db_conn.execute(
+            "select count(*) from sqlite_stat1",
+        ).fetchone()[0])
+        db_conn.close()
+
+    def test_enable_incremental_vacuum(self):
+        # A DB created before incremental auto vacuum
+        self.db.close()
+        os.remove(self.db_file)
+        db_conn = sqlite3.connect(self.db_file)
+        db_conn.execute("create table t (id integer primary key)")
+        db_conn.close()
+        self.db = local_db.LocalDB(SCHEMA_FILE, self.db_file)
+        db_conn = sqlite3.connect(self.db_file)
+        self.assertEqual(
+            db_conn.execute("pragma auto_vacuum").fetchone()[0],
+            local_db.AUTO_VACUUM_INCREMENTAL,
+        )
+        db_conn.close()
+
+    def tearDown(self):
+        self.db.close()
+        for suffix in ["", "-wal", "-shm",
+                       local_db.BACKUP_FILENAME_SUFFIX,
+                       local_db.CHANGESET_FILENAME_SUFFIX,
+                       local_db.EXPORT_FILENAME_SUFFIX]:
+            if os.path.exists(self.db_file + suffix):
+                os.remove(self.db_file + suffix)
 
 
 if __name__ == '__main__':
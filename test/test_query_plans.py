@@ -0,0 +1,294 @@
+#! /usr/bin/env python
+"""
+Query plan regression tests: every statement run by LocalDB is
+checked with EXPLAIN QUERY PLAN against a populated DB.
+"""
+import sys
+import os
+import re
+import argparse
+import traceback
+import unittest
+
+import sqlite3
+
+# flow-ldap root dir
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT_DIR)
+
+from src.db import local_db
+
+import bench_local_db
+
+
+TEST_DIR = os.path.join(
+    ROOT_DIR,
+    "test",
+)
+
+# Tables that must never be fully scanned
+NO_SCAN_TABLES = ("ldap_account", "semaphor_account", "ldap_snapshot")
+
+# LocalDB methods that read whole tables by design
+FULL_SCAN_METHODS = {
+    # Exports every account
+    "export_db": NO_SCAN_TABLES,
+    # First backup step, in rowid order with a limit
+    "_copy_table": NO_SCAN_TABLES,
+    # Counts the rows to copy, for the backup progress
+    "run_backup": NO_SCAN_TABLES,
+    # Marks the entries not seen by the snapshot run as removed
+    "_end_snapshot": ("ldap_snapshot",),
+}
+
+# Table names and aliases of a statement,
+# e.g. 'from ldap_account la' or 'join semaphor_account as sa'
+TABLE_RE = re.compile(
+    r"\b(?:from|join|update|into)\s+(\w+)(?:\s+(?:as\s+)?(\w+))?",
+    re.IGNORECASE,
+)
+# Full scan plan details, e.g. 'SCAN la' or 'SCAN TABLE ldap_account'
+SCAN_RE = re.compile(r"^SCAN (?:TABLE )?(\w+)(?: AS (\w+))?(.*)$")
+SQL_KEYWORDS = set([
+    "where", "on", "set", "left", "join", "inner", "order",
+    "group", "limit", "values", "select", "using",
+])
+
+
+def executing_method():
+    """Returns the name of the LocalDB method running the statement."""
+    for filename, _, function, _ in reversed(traceback.extract_stack()):
+        if filename.endswith("local_db.py") and function != "<genexpr>":
+            return function
+    return None
+
+
+class RecordingCursor(sqlite3.Cursor):
+    """Cursor that records the executed statements on its connection."""
+
+    def execute(self, sql, *args):
+        self.connection.record(sql, args[0] if args else ())
+        return sqlite3.Cursor.execute(self, sql, *args)
+
+    def executemany(self, sql, seq_of_params):
+        seq_of_params = list(seq_of_params)
+        if seq_of_params:
+            self.connection.record(sql, seq_of_params[0])
+        return sqlite3.Cursor.executemany(self, sql, seq_of_params)
+
+
+class RecordingConnection(sqlite3.Connection):
+    """Connection that records the executed statements."""
+
+    statements = []
+
+    def cursor(self, factory=RecordingCursor):
+        return sqlite3.Connection.cursor(self, factory)
+
+    def record(self, sql, params):
+        self.statements.append((sql, params, executing_method()))
+
+
+class RecordingLocalDB(local_db.LocalDB):
+    connection_class = RecordingConnection
+
+
+def table_aliases(sql):
+    """Returns a dict with the table name of each table alias
+    (and name) on the given statement.
+    """
+    aliases = {}
+    for table, alias in TABLE_RE.findall(sql):
+        aliases[table] = table
+        if alias and alias.lower() not in SQL_KEYWORDS:
+            aliases[alias] = table
+    return aliases
+
+
+def full_scans(sql, plan):
+    """Returns the tables fully scanned on the given query plan
+    of 'sql'. Scanning a whole index is a full scan too, unless
+    the statement stops after a limit (e.g. a keyset page read
+    in index order).
+    """
+    if re.search(r"\blimit\b", sql, re.IGNORECASE):
+        plan = [detail for detail in plan if "INDEX" not in detail]
+    aliases = table_aliases(sql)
+    tables = []
+    for detail in plan:
+        match = SCAN_RE.match(detail)
+        if match:
+            name = match.group(2) or match.group(1)
+            tables.append(aliases.get(name, name))
+    return tables
+
+
+class TestQueryPlans(unittest.TestCase):
+
+    # Below ~5000 rows, the planner scans ldap_snapshot instead of
+    # searching a snapshot page (SNAPSHOT_PAGE_SIZE uniqueids)
+    ACCOUNTS = 5000
+
+    def setUp(self):
+        self.db_file = os.path.join(
+            TEST_DIR,
+            "DMA%s.sqlite" % self.id(),
+        )
+        RecordingConnection.statements = []
+        self.db = RecordingLocalDB(
+            bench_local_db.SCHEMA_FILE,
+            self.db_file,
+        )
+        options = argparse.Namespace(
+            seed=1, new=0.05, disabled=0.05, renamed=0.02, locked=0.05,
+        )
+        self.previous, self.current = bench_local_db.gen_directories(
+            self.ACCOUNTS,
+            options,
+        )
+        locked = set(entry["uniqueid"] for entry in self.previous[:100])
+        self.db.writer.submit(
+            bench_local_db.populate_db,
+            self.previous,
+            locked,
+        ).result()
+        self.db.update_snapshot(self.previous)
+        self.db.update_snapshot(self.previous)
+        # Plans are checked with the statistics of the scheduled maintenance
+        self.db.run_maintenance(step_sleep=0)
+
+    def run_statements(self):
+        """Runs the LocalDB operations, but the restore.
+        Returns the backup and changeset file names.
+        """
+        delta_entries = self.db.delta(self.current)
+        actions = dict(
+            (label, list(entries))
+            for label, entries in delta_entries.items()
+        )
+        for entry in actions["update_lock"][:2]:
+            self.db.update_lock(entry)
+        list(self.db.retry_delta()["retry_setup"])
+        email = self.previous[200]["email"]
+        self.db.get_account(email)
+        self.db.update_semaphor_account(email, {
+            "id": "G" * 52,
+            "password": "PW" * 16,
+            "L2": "L2" * 22,
+            "lock_state": bench_local_db.UNLOCK,
+        })
+        self.db.create_account(
+            {"uniqueid": "new", "email": "new@example.com", "enabled": 1},
+            {"lock_state": bench_local_db.LDAP_LOCK},
+        )
+        self.db.get_db_accounts(limit=100)
+        self.db.get_db_accounts(
+            limit=100,
+            after=email,
+            lock_state=bench_local_db.UNLOCK,
+            enabled=True,
+        )
+        self.db.get_enabled_ldaped_accounts()
+        self.db.get_account_changes(0)
+        self.db.set_sync_state("key", "value")
+        self.db.get_sync_state("key")
+        backup_filename, change_seq = self.db.run_backup()
+        self.db.commit_backup(change_seq)
+        self.db.update_lock(actions["update_lock"][2])
+        changeset_filename, _ = self.db.run_changeset_backup()
+        self.db.export_db(self.db_file + local_db.EXPORT_FILENAME_SUFFIX)
+        self.db.check_db()
+        self.db.check_maintenance()
+        return backup_filename, changeset_filename
+
+    def check_plans(self, statements, checked):
+        """Explains the given recorded statements (but the ones
+        in 'checked'), returns the list of full scan failures.
+        """
+        db_conn = sqlite3.connect(self.db_file)
+        # Temporary table of the writer connection
+        db_conn.execute(local_db.SNAPSHOT_SEEN_TABLE_SQL)
+        failures = []
+        for sql, params, method in statements:
+            if (sql, method) in checked or not re.match(
+                    r"\s*(select|insert|update|delete)\b", sql, re.I):
+                continue
+            checked.add((sql, method))
+            plan = [
+                row[3] for row in
+                db_conn.execute("explain query plan " + sql, params)
+            ]
+            scanned = [
+                table for table in full_scans(sql, plan)
+                if table in NO_SCAN_TABLES and
+                table not in FULL_SCAN_METHODS.get(method, ())
+            ]
+            if scanned:
+                failures.append(
+                    "%s() scans %s:\n%s\n-- plan:\n%s" % (
+                        method,
+                        ", ".join(scanned),
+                        sql.strip(),
+                        "\n".join(plan),
+                    ),
+                )
+        db_conn.close()
+        return failures
+
+    def test_no_full_scans(self):
+        backup_filename, changeset_filename = self.run_statements()
+        statements = list(RecordingConnection.statements)
+        checked = set()
+        # Explained before the restore replaces the DB statistics
+        failures = self.check_plans(statements, checked)
+        self.db.restore_backup(backup_filename, [changeset_filename])
+        failures.extend(self.check_plans(
+            RecordingConnection.statements[len(statements):],
+            checked,
+        ))
+        methods = set(method for _, _, method in statements)
+        # The delta and userlist queries were checked
+        self.assertTrue(set([
+            "entries_to_setup",
+            "entries_to_retry_setup",
+            "entries_to_update_lock",
+            "update_uids",
+            "_db_accounts_cursor",
+            "get_enabled_ldaped_accounts",
+            "get_account_changes",
+            "_read_account",
+        ]) <= methods)
+        self.assertFalse(failures, "\n\n".join(failures))
+
+    def test_full_scans(self):
+        sql = """select email from ldap_account la
+            left join semaphor_account sa on sa.ldap_account = la.id
+            """
+        self.assertEqual(
+            full_scans(sql, ["SCAN la", "SEARCH sa USING INTEGER PRIMARY "
+                             "KEY (rowid=?) LEFT-JOIN"]),
+            ["ldap_account"],
+        )
+        plan = [
+            "SCAN TABLE ldap_account AS la USING INDEX "
+            "sqlite_autoindex_ldap_account_1",
+        ]
+        self.assertEqual(full_scans(sql, plan), ["ldap_account"])
+        self.assertEqual(full_scans(sql + "limit ?", plan), [])
+        self.assertEqual(
+            full_scans(sql, ["SEARCH la USING INDEX ix_email (email>?)"]),
+            [],
+        )
+
+    def tearDown(self):
+        self.db.close()
+        for suffix in ["", "-wal", "-shm",
+                       local_db.BACKUP_FILENAME_SUFFIX,
+                       local_db.CHANGESET_FILENAME_SUFFIX,
+                       local_db.EXPORT_FILENAME_SUFFIX]:
+            if os.path.exists(self.db_file + suffix):
+                os.remove(self.db_file + suffix)
+
+
+if __name__ == '__main__':
+    unittest.main()
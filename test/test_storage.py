@@ -0,0 +1,361 @@
+#! /usr/bin/env python
+import sys
+import os
+import unittest
+
+# flow-ldap root dir
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT_DIR)
+
+from src.db import local_db, pg_db, storage
+
+
+SCHEMA_FILE = os.path.join(
+    ROOT_DIR,
+    "schema/dma.sql",
+)
+PG_SCHEMA_FILE = os.path.join(
+    ROOT_DIR,
+    "schema/dma_pg.sql",
+)
+TEST_DIR = os.path.join(
+    ROOT_DIR,
+    "test",
+)
+# PostgreSQL server of the postgresql engine tests,
+# e.g. "host=localhost dbname=dma_test user=dma_test"
+PG_DSN = os.environ.get("SEMAPHOR_LDAP_TEST_PG_DSN")
+PG_TEST_SCHEMA = "dma_storage_test"
+
+UNLOCK = 0
+FULL_LOCK = 1
+LDAP_LOCK = 2
+
+
+class StorageTests(object):
+    """Tests every storage engine must pass,
+    engine test cases implement 'new_db'.
+    """
+
+    PASSWORD = "PW" * 16
+    L2 = "L2" * 22
+
+    def setUp(self):
+        self.db = self.new_db()
+
+    def tearDown(self):
+        self.db.close()
+
+    def new_db(self):
+        """Returns a new empty DB of the tested engine."""
+        raise NotImplementedError()
+
+    def create_accounts(self, entries):
+        for i, entry in enumerate(entries):
+            semaphor_data = {"lock_state": entry[3]}
+            if entry[3] != LDAP_LOCK:
+                semaphor_data = {
+                    "id": "%052d" % i,
+                    "password": self.PASSWORD,
+                    "L2": self.L2,
+                    "lock_state": entry[3],
+                }
+            self.db.create_account({
+                "uniqueid": entry[0],
+                "email": entry[1],
+                "enabled": entry[2],
+            }, semaphor_data)
+
+    def run_delta(self, ldap_entries):
+        delta_entries = self.db.delta(ldap_entries)
+        return dict(
+            (label, list(entries))
+            for label, entries in delta_entries.items()
+        )
+
+    def test_accounts(self):
+        self.create_accounts([
+            ("1", "John@example.com", True, UNLOCK),
+        ])
+        account = self.db.get_account("john@EXAMPLE.com")
+        self.assertEqual(account["uniqueid"], "1")
+        self.assertEqual(account["email"], "John@example.com")
+        self.assertEqual(account["L2"], self.L2)
+        self.assertEqual(account["lock_state"], UNLOCK)
+        self.assertIsNone(self.db.get_account("alice@example.com"))
+        self.assertTrue(self.db.update_semaphor_account("john@example.com", {
+            "id": "g" * 52,
+            "password": self.PASSWORD,
+            "L2": self.L2,
+            "lock_state": FULL_LOCK,
+        }))
+        self.assertFalse(self.db.update_semaphor_account(
+            "alice@example.com",
+            {"id": "a" * 52, "password": None, "L2": None, "lock_state": 0},
+        ))
+        account = self.db.get_account("john@example.com")
+        self.assertEqual(account["semaphor_guid"], "g" * 52)
+        self.assertEqual(account["lock_state"], FULL_LOCK)
+        # Same email, the account is replaced
+        self.create_accounts([
+            ("2", "JOHN@example.com", True, LDAP_LOCK),
+        ])
+        account = self.db.get_account("john@example.com")
+        self.assertEqual(account["uniqueid"], "2")
+        self.assertIsNone(account["semaphor_guid"])
+
+    def test_delta(self):
+        self.create_accounts([
+            ("1", "john@example.com", True, UNLOCK),
+            ("2", "alice@example.com", True, UNLOCK),
+            ("3", "carl@example.com", True, LDAP_LOCK),
+            ("4", "back@example.com", True, UNLOCK),
+        ])
+        delta_entries = self.run_delta([
+            {"uniqueid": "1", "email": "john@example.com", "enabled": 1},
+            {"uniqueid": "2", "email": "alice@example.com", "enabled": 0},
+            {"uniqueid": "3", "email": "carl@example.com", "enabled": 1},
+            # uniqueid updated
+            {"uniqueid": "5", "email": "Back@example.com", "enabled": 1},
+            {"uniqueid": "6", "email": "neil@example.com", "enabled": 1},
+        ])
+        self.assertEqual(
+            [entry["email"] for entry in delta_entries["setup"]],
+            ["neil@example.com"],
+        )
+        self.assertEqual(
+            [entry["email"] for entry in delta_entries["retry_setup"]],
+            ["carl@example.com"],
+        )
+        update_lock = delta_entries["update_lock"]
+        self.assertEqual(
+            [entry["email"] for entry in update_lock],
+            ["alice@example.com"],
+        )
+        self.assertEqual(self.db.get_account("back@example.com")["uniqueid"],
+                         "5")
+        self.assertTrue(self.db.update_lock(update_lock[0]))
+        account = self.db.get_account("alice@example.com")
+        self.assertEqual(account["enabled"], 0)
+        self.assertEqual(account["lock_state"], FULL_LOCK)
+        # Reconciled entries are not on the next delta
+        delta_entries = self.run_delta([
+            {"uniqueid": "1", "email": "john@example.com", "enabled": 1},
+            {"uniqueid": "2", "email": "alice@example.com", "enabled": 0},
+            {"uniqueid": "3", "email": "carl@example.com", "enabled": 1},
+            {"uniqueid": "5", "email": "Back@example.com", "enabled": 1},
+        ])
+        self.assertFalse(delta_entries["setup"])
+        self.assertFalse(delta_entries["update_lock"])
+        self.assertEqual(len(delta_entries["retry_setup"]), 1)
+        self.assertEqual(len(list(self.db.retry_delta()["retry_setup"])), 1)
+
+    def test_snapshot_entries(self):
+        self.create_accounts([
+            ("1", "john@example.com", True, UNLOCK),
+            ("2", "alice@example.com", True, UNLOCK),
+            ("3", "carl@example.com", True, UNLOCK),
+            ("4", "neil@example.com", False, FULL_LOCK),
+        ])
+        self.db.update_snapshot([
+            {"uniqueid": "1", "email": "john@example.com", "enabled": 1},
+            {"uniqueid": "2", "email": "alice@example.com", "enabled": 1},
+            {"uniqueid": "3", "email": "carl@example.com", "enabled": 1},
+        ])
+        self.assertEqual(self.db.update_snapshot_entries(
+            [
+                {"uniqueid": "1", "email": "john@example.com", "enabled": 0},
+                # Unchanged entries are not written
+                {"uniqueid": "3", "email": "carl@example.com", "enabled": 1},
+                # Nor entries removed from the snapshot
+                {"uniqueid": "4", "email": "neil@example.com", "enabled": 1},
+            ],
+            ["2"],
+        ), 2)
+        delta_entries = dict(
+            (label, list(entries))
+            for label, entries in self.db.delta_changes().items()
+        )
+        self.assertEqual(
+            sorted(entry["email"] for entry in delta_entries["update_lock"]),
+            ["alice@example.com", "john@example.com"],
+        )
+        self.assertEqual(self.db.update_snapshot_entries([], ["2"]), 0)
+
+    def test_db_accounts(self):
+        self.create_accounts([
+            ("1", "john@example.com", True, UNLOCK),
+            ("2", "Alice@example.com", True, LDAP_LOCK),
+            ("3", "carl@example.com", False, FULL_LOCK),
+        ])
+        accounts = self.db.get_db_accounts(limit=2)
+        self.assertEqual(
+            [account["email"] for account in accounts],
+            ["Alice@example.com", "carl@example.com"],
+        )
+        self.assertEqual(
+            self.db.get_db_accounts(after="CARL@example.com"),
+            [{
+                "email": "john@example.com",
+                "uniqueid": "1",
+                "enabled": 1,
+                "semaphor_guid": "%052d" % 0,
+                "lock_state": UNLOCK,
+            }],
+        )
+        self.assertEqual(
+            [row[0] for row in self.db.iter_db_accounts(enabled=False)],
+            ["carl@example.com"],
+        )
+        self.assertEqual(
+            [row[0] for row in self.db.iter_db_accounts(lock_state=UNLOCK)],
+            ["john@example.com"],
+        )
+        self.assertEqual(
+            self.db.get_enabled_ldaped_accounts(),
+            ["%052d" % 0],
+        )
+
+    def test_sync_state(self):
+        self.assertIsNone(self.db.get_sync_state("userlist-digest"))
+        self.db.set_sync_state("userlist-digest", "abc")
+        self.db.set_sync_state("userlist-digest", "def")
+        self.assertEqual(self.db.get_sync_state("userlist-digest"), "def")
+
+    def test_account_changes(self):
+        self.assertEqual(self.db.get_account_change_seq(), 0)
+        self.assertEqual(self.db.get_account_changes(0), [])
+        self.create_accounts([
+            ("1", "john@example.com", True, UNLOCK),
+            ("2", "carl@example.com", True, LDAP_LOCK),
+        ])
+        seq = self.db.get_account_change_seq()
+        self.db.update_semaphor_account("carl@example.com", {
+            "id": "c" * 52,
+            "password": self.PASSWORD,
+            "L2": self.L2,
+            "lock_state": UNLOCK,
+        })
+        for enabled in (0, 1):
+            self.db.update_lock({
+                "uniqueid": "1",
+                "enabled": enabled,
+                "lock_state": UNLOCK,
+            })
+        self.assertEqual(
+            sorted(
+                (change["change"], change["email"])
+                for change in self.db.get_account_changes(seq)
+            ),
+            [
+                ("reenabled", "john@example.com"),
+                ("relinked", "carl@example.com"),
+                ("unlocked", "carl@example.com"),
+                ("unlocked", "john@example.com"),
+            ],
+        )
+        self.assertEqual(self.db.run_maintenance(), 0)
+        self.assertTrue(self.db.get_maintenance_stats()["size"] > 0)
+        self.assertTrue(self.db.check_db().startswith("OK"))
+
+    def test_export_import(self):
+        ldap_entries = [
+            {"uniqueid": "1", "email": "john@example.com", "enabled": 1},
+            {"uniqueid": "2", "email": "alice@example.com", "enabled": 0},
+            {"uniqueid": "3", "email": "carl@example.com", "enabled": 1},
+        ]
+        self.create_accounts([
+            ("1", "john@example.com", True, UNLOCK),
+            ("2", "alice@example.com", False, FULL_LOCK),
+            ("3", "carl@example.com", True, LDAP_LOCK),
+        ])
+        self.db.update_snapshot(ldap_entries)
+        export_filename = os.path.join(
+            TEST_DIR,
+            "DMA%s%s" % (self.id(), local_db.EXPORT_FILENAME_SUFFIX),
+        )
+        try:
+            self.assertEqual(self.db.export_db(export_filename), 3)
+            accounts = self.db.get_db_accounts()
+            self.assertRaises(Exception, self.db.import_db, export_filename)
+            self.db.close()
+            self.db = self.new_db()
+            self.assertEqual(
+                self.db.import_db(export_filename, chunk_size=2),
+                3,
+            )
+        finally:
+            os.remove(export_filename)
+        self.assertEqual(self.db.get_db_accounts(), accounts)
+        self.assertEqual(self.db.get_account_changes(0), [])
+        delta_entries = self.run_delta(ldap_entries)
+        self.assertFalse(delta_entries["setup"])
+        self.assertFalse(delta_entries["update_lock"])
+        # New accounts get new ids
+        self.create_accounts([
+            ("4", "neil@example.com", True, UNLOCK),
+        ])
+        self.assertEqual(len(self.db.get_db_accounts()), 4)
+
+
+class TestSQLiteStorage(StorageTests, unittest.TestCase):
+
+    def new_db(self):
+        db_file = os.path.join(
+            TEST_DIR,
+            "DMA%s.sqlite" % self.id(),
+        )
+        if os.path.exists(db_file):
+            os.remove(db_file)
+        return local_db.LocalDB(SCHEMA_FILE, db_file)
+
+    def tearDown(self):
+        super(TestSQLiteStorage, self).tearDown()
+        os.remove(self.db.db_file_name)
+
+    def test_engine(self):
+        self.assertEqual(self.db.engine, storage.ENGINE_SQLITE)
+        self.assertTrue(self.db.supports_backup)
+
+
+@unittest.skipUnless(
+    PG_DSN and pg_db.psycopg2,
+    "SEMAPHOR_LDAP_TEST_PG_DSN not set or psycopg2 not installed",
+)
+class TestPostgreSQLStorage(StorageTests, unittest.TestCase):
+
+    def new_db(self, pool_size=4):
+        # Each DB is a new schema of the test server
+        db_conn = pg_db.psycopg2.connect(PG_DSN)
+        db_conn.autocommit = True
+        cur = db_conn.cursor()
+        cur.execute("drop schema if exists %s cascade" % PG_TEST_SCHEMA)
+        cur.execute("create schema %s" % PG_TEST_SCHEMA)
+        db_conn.close()
+        return pg_db.PostgreSQLDB(
+            PG_SCHEMA_FILE,
+            "%s options='-c search_path=%s'" % (PG_DSN, PG_TEST_SCHEMA),
+            pool_size=pool_size,
+        )
+
+    def test_engine(self):
+        self.assertEqual(self.db.engine, storage.ENGINE_POSTGRESQL)
+        self.assertFalse(self.db.supports_backup)
+        # The schema is only created once
+        self.db.migrate()
+
+    def test_small_pool(self):
+        self.db.close()
+        self.db = self.new_db(pool_size=1)
+        self.assertEqual(self.db.pool_size, pg_db.MIN_POOL_SLOTS)
+        # Actions are written while the delta rows are read
+        for entry in self.db.delta([
+            {"uniqueid": "1", "email": "john@example.com", "enabled": 1},
+            {"uniqueid": "2", "email": "alice@example.com", "enabled": 1},
+        ])["setup"]:
+            self.db.create_account(entry, {"lock_state": LDAP_LOCK})
+        self.assertEqual(len(self.db.get_db_accounts()), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()